@@ -28,7 +28,6 @@ setup(
         'requests>=2.0.1',
         'urlnorm==custom,<99999',
         'charade',
-        'html5lib',
         'reppy==custom,<99999',
         'blessings==1.5.1'
     ],
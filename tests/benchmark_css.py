@@ -0,0 +1,117 @@
+"""Compares the regular expression scanner of :class:`CSSParser` with
+the character by character scanner built on :class:`ParserKit` that it
+replaced, on a real minified stylesheet (jQuery UI's theme, MIT
+licensed; see the header of the file). Run with::
+
+    $ python -m tests.benchmark_css
+
+The stylesheet is parsed as it is, and repeated to a size more like
+that of a large site's bundle.
+"""
+
+from os import path
+import timeit
+from track.parser import CSSParser, ParserKit
+
+
+FIXTURES = path.join(path.dirname(__file__), 'fixtures')
+
+
+def read_fixture(filename):
+    with open(path.join(FIXTURES, filename), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+class ParserKitCSSParser(CSSParser):
+    """The stylesheet scanner as it was before the regular expressions,
+    but for its comment skipper. That moved two characters at a time,
+    so it could miss the end of a comment, like the one heading the
+    fixture, and find nothing after it.
+    """
+
+    def _parse(self):
+        p = ParserKit(self.as_text(self.data))
+
+        peek = p.peek
+        cur = p.cur
+        match = p.match
+        next = p.next
+
+        while cur():
+            # Skip comments
+            if cur() == '/' and peek() == '*':
+                next(2)
+                while cur() is not None and (cur() != '*' or peek() != '/'):
+                    next()
+
+            # @import without url()
+            if match('@import'):
+                p.skip_whitespace()
+                if cur() in '"\'':
+                    # Have the element include the quotes, for we need to
+                    # be able to properly escape a replacement url.
+                    yield p.switch_element()
+                    quote_chr = next()
+
+                    # Find the actual url
+                    url = p.skip_until(quote_chr+'\n\r', escape_chr='\\')
+
+                    # If there is a closing quote, include it
+                    p.next_if(quote_chr)
+                    yield p.switch_element(type='url', url=url)
+                continue
+
+            # url() instructions
+            if match('url('):
+                p.skip_whitespace()
+
+                # Start new element with opening quote included
+                yield p.switch_element()
+                quote_chr = None
+                if cur() in '"\'':
+                    quote_chr = next()
+
+                # Find the actual url
+                url = p.skip_until(quote_chr or ')', '\n\r', escape_chr='\\')
+
+                # If there is a closing quote, include it
+                # (a closing bracket is not included).
+                if quote_chr:
+                    p.next_if(quote_chr)
+                yield p.switch_element(type='url', url=url)
+                continue
+
+            next()
+
+        # Complete the final element
+        yield p.switch_element()
+
+
+def bench(css, number):
+    results = {}
+    for parser_class in (ParserKitCSSParser, CSSParser):
+        def find():
+            return list(parser_class(css, 'http://example.org/'))
+
+        def replace():
+            parser = parser_class(css, 'http://example.org/')
+            return parser.replace_urls(lambda url: url + '?x')
+
+        results[parser_class.__name__] = (
+            min(timeit.repeat(find, number=number, repeat=3)) / number,
+            min(timeit.repeat(replace, number=number, repeat=3)) / number)
+    return results
+
+
+def main():
+    css = read_fixture('jquery-ui.min.css')
+    for times, number in ((1, 20), (32, 1)):
+        print('{} KB:'.format(len(css) * times // 1024))
+        results = bench(css * times, number)
+        for name, (find, replace) in results.items():
+            print('    {:<20} find {:8.2f} ms    replace {:8.2f} ms'.format(
+                name, find * 1000, replace * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,19 @@
 from collections import Counter
 from contextlib import contextmanager
 from io import BytesIO, TextIOWrapper
+from os import path
+import shutil
+import tempfile
 from urllib.parse import urldefrag
+import weakref
 import pytest
 import requests.adapters
+import requests.exceptions
 from requests_testadapter import TestSession, Resp
 import urlnorm
 from track.parser import get_parser_for_mimetype, HeaderLinkParser
 from track.spider import Spider as BaseSpider, Rules as BaseRules, Link, get_content_type
+from track.index import UrlIndex
 from track.mirror import Mirror as BaseMirror
 
 
@@ -43,7 +49,8 @@ class TestAdapter(requests.adapters.HTTPAdapter, metaclass=Internet):
         url, fragment = urldefrag(request.url)
         self.requests.update({url: 1})
         if not url in self.urls:
-            raise ConnectionError('no such virtual url', request.url)
+            raise requests.exceptions.ConnectionError(
+                'no such virtual url', request.url)
         resp = Resp(**self.urls[url])
         r = self.build_response(request, resp)
         if not stream:
@@ -98,6 +105,12 @@ class MemoryMirror(BaseMirror):
     def open_shelve(self, filename):
         return {}
 
+    def open_index(self, filename):
+        # The index is a file we map into memory, keep it out of the way
+        directory = tempfile.mkdtemp()
+        weakref.finalize(self, shutil.rmtree, directory, ignore_errors=True)
+        return UrlIndex(path.join(directory, filename))
+
     def flush(self):
         pass
 
@@ -236,6 +249,22 @@ class arglogger:
         return [kwargs.get(name) for args, kwargs in self.calls]
 
 
+class fakeclock:
+    """Replaces the clock of a spider; sleeping advances the time
+    immediately.
+    """
+    def __init__(self, spider=None):
+        self.now = 0
+        self.sleeps = []
+        if spider is not None:
+            spider.clock, spider.sleep = self.time, self.sleep
+    def time(self):
+        return self.now
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
 @pytest.fixture(scope='function')
 def spider(**kwargs):
     defaults = dict(rules=rules(), mirror=MemoryMirror())
@@ -5,7 +5,7 @@ from track.cli.tests import Redirect
 from track.spider import Link
 
 # Import fixtures
-from .helpers import spider, spiderfactory, fake_response
+from .helpers import spider, spiderfactory, fake_response, fakeclock
 from track.cli.tests import TestImpl
 from track.utils import NoneDict
 
@@ -103,6 +103,13 @@ class TestRules(object):
 
         assert test('http://www.example.org/path/#fragment') == 'fragment'
 
+    def test_heuristic(self):
+        test = lambda **info: TestImpl.heuristic(
+            Link('http://example.org/a.png', **info))
+
+        assert test(heuristic=True) is True
+        assert test() is False
+
     def test_size(self):
         test = lambda **kw: TestImpl.size(
             fake_resolve_link(
@@ -120,6 +127,37 @@ class TestRules(object):
             Redirect,
             test, headers={'content-length': 'foo'}, redirects=['http://foo'])
 
+    def test_size_reads_only_what_it_needs(self, spiderfactory):
+        """Without a content-length header, the size test stops reading
+        the body once the threshold has been crossed. If the url is
+        followed anyway, the rest of the body is read from the same
+        response.
+        """
+        urlspec = {'http://example.org/big': dict(
+            stream=b'x' * 100000, headers={'content-type': 'text/plain'},
+            no_defaults=True)}
+
+        with internet(**urlspec) as net:
+            spider = spiderfactory(
+                rules=testable_cli_rules(follow=['+', '-size>10k']))
+            spider.add(net[0], source=None)
+            link = spider._link_queue[0]
+            spider.process_one()
+
+            assert link.response.truncated
+            assert len(link.response._partial_content) < 100000
+            assert len(spider.mirror.encountered_urls) == 0
+
+        with internet(**urlspec) as net:
+            spider = spiderfactory(
+                rules=testable_cli_rules(follow=['+', '-size<10k']))
+            spider.add(net[0], source=None)
+            spider.process_one()
+
+            # HEAD, then a single GET
+            assert net.requests[net[0]] == 2
+            assert spider.mirror.get_file(net[0]) == b'x' * 100000
+
 
 def test_requisite_test(spiderfactory):
     """The requisite test is special in that it interacts with the
@@ -148,6 +186,63 @@ def test_requisite_test(spiderfactory):
             assert len(spider.mirror.stored_urls) == 0
 
 
+def test_robots_test(spiderfactory):
+    """robots.txt files are fetched ahead of time, kept in the mirror,
+    and their crawl-delay slows us down.
+    """
+    with internet(**{
+            'robots.txt': dict(
+                stream='User-agent: *\nDisallow: /private\nCrawl-delay: 5',
+                headers={'content-type': 'text/plain'}),
+            'index': dict(links=['public', 'private']),
+            'public': dict(),
+            'private': dict(),
+        }) as net:
+            spider = spiderfactory()
+            clock = fakeclock(spider)
+            spider.rules = testable_cli_rules(follow=['+', '-robots'])
+            spider.add('http://example.org/index')
+            spider.loop()
+            assert set(spider.mirror.stored_urls) == {
+                'http://example.org/index', 'http://example.org/public'}
+            assert net.requests['http://example.org/robots.txt'] == 1
+            assert clock.sleeps and set(clock.sleeps) == {5}
+
+            # The next run does not need to ask again
+            mirror = spider.mirror
+            spider = spiderfactory(mirror=mirror)
+            fakeclock(spider)
+            spider.rules = testable_cli_rules(follow=['+', '-robots'])
+            spider.add('http://example.org/index')
+            spider.loop()
+            assert net.requests['http://example.org/robots.txt'] == 1
+
+
+def test_robots_fetching(spiderfactory):
+    """robots.txt is fetched with the scheme of the url, without cookies,
+    and counts as a request to the host.
+    """
+    with internet(**{
+            'https://example.org/robots.txt': dict(
+                stream='User-agent: *\nDisallow: /private',
+                headers={'content-type': 'text/plain',
+                         'set-cookie': 'id=1; Path=/'}),
+            'https://example.org/index': dict(
+                links=['https://example.org/private']),
+            'https://example.org/private': dict(),
+        }) as net:
+            spider = spiderfactory()
+            fakeclock(spider)
+            spider.rules = testable_cli_rules(follow=['+', '-robots'])
+            spider.add('https://example.org/index')
+            spider.loop()
+            assert net.requests['https://example.org/robots.txt'] == 1
+            assert net.requests['https://example.org/private'] == 0
+            assert spider.get_host(
+                Link('https://example.org/index')).requests == 2
+            assert not spider.session.cookies
+
+
 class TestOperators(object):
 
     def test_numeric(self):
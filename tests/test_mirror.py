@@ -1,7 +1,9 @@
 import pytest
-from tests.helpers import fake_response
-from track.mirror import Mirror
-from track.spider import Link
+from tests.helpers import fake_response, arglogger
+from track.index import IndexEntry, UrlIndex
+from track.mirror import Mirror, ParseCache
+from track.spider import Events, Link
+from track.warc import WarcMirror, read_record
 
 
 @pytest.fixture(scope='function')
@@ -74,4 +76,192 @@ class TestConvertLinks:
         <a href="./index.html#FOO">
         """
 
+    def test_heuristic_urls_only_made_local(self, mirror):
+        """Strings in a script that merely look like urls are pointed
+        at local copies, but otherwise left as they are.
+        """
+        mirror.convert_links = True
+
+        link = Link('http://example.org/app.js')
+        response = fake_response(
+            link, 'fetch("/api/x"); img = "/logo.png"; import("/lib.js")',
+            headers={'content-type': 'application/javascript'})
+        mirror.add(link, response)
+        logo = Link('http://example.org/logo.png')
+        mirror.add(logo, fake_response(
+            logo, '', headers={'content-type': 'image/png'}))
+
+        mirror._convert_links()
+        assert get_mirror_file(mirror, link.url) == (
+            'fetch("/api/x"); img = "./logo.png"; '
+            'import("http://example.org/lib.js")')
+
+    def test_parallel(self, tmpdir):
+        """Converting the whole mirror in several processes has the
+        same result as doing it here.
+        """
+        def build(directory, **options):
+            mirror = Mirror(directory, write_at_once=False)
+            for name, attr in options.items():
+                setattr(mirror, name, attr)
+            for i in range(5):
+                link = Link('http://example.org/{}'.format(i))
+                response = fake_response(link, """
+                <a href="/{}"><a href="/missing"><a href="http://other.org/">
+                <style>body {{ background: url(/{}) }}</style>
+                """.format((i + 1) % 5, i))
+                mirror.add(link, response)
+            mirror.add_redirect(
+                Link('http://example.org/missing'),
+                Link('http://example.org/0'), 301)
+            return mirror
+
+        events = Events()
+        events.links_converted = arglogger()
+        sequential = build(tmpdir.join('a').strpath)
+        parallel = build(tmpdir.join('b').strpath,
+                         convert_workers=2, convert_batch_size=2)
+        sequential.finish()
+        parallel.finish(events)
+
+        for url in sequential.stored_urls:
+            assert get_mirror_file(parallel, url) == \
+                get_mirror_file(sequential, url)
+        assert events.links_converted.calls[-1] == ((5, 5), {})
+
+    def test_parse_cache(self, mirror):
+        """A page linking to many others is converted each time one of
+        them is added; it is parsed only once.
+        """
+        mirror.convert_links = True
+        mirror.write_at_once = True
+
+        hub = Link('http://example.org/')
+        mirror.add(hub, fake_response(
+            hub, '<a href="/a"><a href="/b"><a href="/c">'))
+        for name in 'abc':
+            link = Link('http://example.org/' + name)
+            mirror.add(link, fake_response(link, ''))
+
+        assert get_mirror_file(mirror, hub.url) == \
+            '<a href="./a.html"><a href="./b.html"><a href="./c.html">'
+        assert mirror.parse_cache.stats['misses'] == 1
+        assert mirror.parse_cache.stats['hits'] == 2
+
+        # Not if it would need more memory than allowed
+        mirror.parse_cache = ParseCache(10)
+        mirror._convert_links()
+        mirror._convert_links()
+        assert len(mirror.parse_cache) == 0
+        assert mirror.parse_cache.stats['hits'] == 0
+
+
+class TestUrlIndex:
+
+    def test_lookup_and_scan(self, tmpdir):
+        index = UrlIndex(tmpdir.join('index').strpath)
+        assert index.get('http://example.org/') is None
+        assert list(index.scan('http://example.org/')) == []
+
+        def entry(url):
+            return IndexEntry(url, url.split('//')[1], 'text/html', None, None)
+        urls = ['http://example.org/blog/2', 'http://www.example.org/',
+                'http://example.org/blog/1', 'http://sub.example.org/a b',
+                'http://example.com/', 'http://example.org/About']
+        index.update({url: entry(url) for url in urls})
+        index.update({'http://example.com/': None,
+                      'http://example.org/blog/3': entry(
+                          'http://example.org/blog/3')})
+
+        assert index.get('http://example.org/blog/1') == \
+            entry('http://example.org/blog/1')
+        assert index.get('http://sub.example.org/a b').filename == \
+            'sub.example.org/a b'
+        assert 'http://example.com/' not in index
+        # Same key, different url
+        assert 'http://example.org/about' not in index
+        assert [e.url for e in index.scan('http://example.org/blog/')] == [
+            'http://example.org/blog/1', 'http://example.org/blog/2',
+            'http://example.org/blog/3']
+        assert len(list(index.scan('https://example.org/'))) == 5
+        assert [e.url for e in UrlIndex(index.filename)] == [
+            'http://www.example.org/', 'http://example.org/About',
+            'http://example.org/blog/1', 'http://example.org/blog/2',
+            'http://example.org/blog/3', 'http://sub.example.org/a b']
+
+    def test_mirror(self, tmpdir):
+        """The mirror keeps the index up to date, and builds it again
+        if a run did not get to write it.
+        """
+        mirror = Mirror(tmpdir.strpath)
+        for url in ('http://example.org/a', 'http://example.org/b'):
+            link = Link(url)
+            mirror.add(link, fake_response(link, '', headers={'etag': 'x'}))
+        mirror.finish()
+        assert mirror.url_index.get('http://example.org/a') == IndexEntry(
+            'http://example.org/a', mirror.encountered_urls[
+                'http://example.org/a'], 'text/html', 'x', None)
+
+        mirror = Mirror(tmpdir.strpath)
+        mirror.encounter_url(Link('http://example.org/b'))
+        mirror.delete_unencountered()
+        assert [e.url for e in mirror.url_index] == ['http://example.org/b']
+
+        mirror.write_at_once = False
+        link = Link('http://example.org/c')
+        mirror.add(link, fake_response(link, ''))
+        mirror.flush()
+        mirror = Mirror(tmpdir.strpath)
+        assert [e.url for e in mirror.url_index] == [
+            'http://example.org/b', 'http://example.org/c']
+
+
+class TestWarcMirror:
+
+    def test_records_and_index(self, tmpdir):
+        """Responses go into WARC files, a new one once a file is full;
+        the index is sorted by url, and leads to the records.
+        """
+        def add(mirror, url, content):
+            link = Link(url)
+            mirror.add(link, fake_response(link, content))
+
+        mirror = WarcMirror(tmpdir.strpath, max_segment_size=1)
+        add(mirror, 'http://example.org/b', 'b' * 1000)
+        add(mirror, 'http://example.org/a', '<a href="/b">')
+        mirror.finish()
+        assert sorted(name for name in tmpdir.listdir()
+                      if name.ext == '.gz') == [
+            tmpdir.join('track-00000.warc.gz'),
+            tmpdir.join('track-00001.warc.gz')]
+        assert mirror.url_info['http://example.org/a']['links'][0][0] == \
+            'http://example.org/b'
+
+        # A later run adds to the index
+        mirror = WarcMirror(tmpdir.strpath)
+        add(mirror, 'http://example.org/c', 'c')
+        mirror.finish()
+
+        lines = tmpdir.join('track.cdx').read().splitlines()
+        assert lines[0] == ' CDX N b a m s k r M S V g'
+        entries = [line.split(' ') for line in lines[1:]]
+        assert [entry[0] for entry in entries] == [
+            'org,example)/a', 'org,example)/b', 'org,example)/c']
+        assert entries[2][-1] == 'track-00002.warc.gz'
+
+        headers, block = read_record(
+            tmpdir.join(entries[1][-1]).strpath, int(entries[1][-2]))
+        assert headers['WARC-Type'] == 'response'
+        assert headers['WARC-Target-URI'] == 'http://example.org/b'
+        assert block.startswith(b'HTTP/1.1 200')
+        assert block.endswith(b'\r\n\r\n' + b'b' * 1000)
+
+        entry = mirror.url_index.get('http://example.org/b')
+        assert (entry.filename, entry.offset) == (
+            entries[1][-1], int(entries[1][-2]))
 
+        # A location without an offset
+        mirror.stored_urls['http://example.org/c'] = {'track-00002.warc.gz'}
+        mirror.encountered_urls.pop('http://example.org/c', None)
+        entry = mirror._index_entry('http://example.org/c')
+        assert (entry.filename, entry.offset) == ('track-00002.warc.gz', None)
@@ -1,5 +1,9 @@
 # coding: utf-8
-from track.parser import CSSParser, HTMLParser
+import codecs
+from tests.benchmark_css import ParserKitCSSParser, read_fixture
+from track.parser import CSSParser, HTMLParser, HTMLLinkStream, \
+    JavaScriptParser, SVGParser, FeedParser, ManifestParser, \
+    ParserRegistry, detect_encoding, get_parser_for_mimetype, parsers
 
 
 class TestCSSParser(object):
@@ -26,6 +30,176 @@ class TestCSSParser(object):
                 'url with double quotes'] == [url for url, _ in css]
 
 
+    def test_comments(self):
+        """Urls in comments are ignored; the end of a comment is
+        always found [regression].
+        """
+        css = CSSParser("""/* a */url(x)/* url(y) */url(z)/* url(""", '')
+        assert [url for url, _ in css] == ['x', 'z']
+
+    def test_minified(self):
+        css = CSSParser(
+            '@import "a.css";.b{background:url(b.png) no-repeat}'
+            '.c{background-image:url("c.png")}@import url(\'d.css\');',
+            'http://example.org/')
+        assert [url for url, _ in css.get_urls()] == [
+            'a.css', 'b.png', 'c.png', 'd.css']
+        assert css.replace_urls(lambda url: url + '?x') == (
+            '@import "http://example.org/a.css?x";.b{background:url('
+            '"http://example.org/b.png?x") no-repeat}.c{background-image:'
+            'url("http://example.org/c.png?x")}@import url('
+            '"http://example.org/d.css?x");')
+
+    def test_real_minified(self):
+        """On a real minified stylesheet, the results are those of the
+        scanner that came before, see :mod:`tests.benchmark_css`.
+        """
+        data = read_fixture('jquery-ui.min.css')
+        css = CSSParser(data, 'http://example.org/css/')
+        before = ParserKitCSSParser(data, 'http://example.org/css/')
+        assert list(css) == list(before)
+        assert 'http://example.org/css/images/ui-icons_444444_256x240.png' \
+            in [url for url, _ in css]
+        replacer = lambda url: url + '?x'
+        assert css.replace_urls(replacer) == before.replace_urls(replacer)
+
+
+class TestJavaScriptParser(object):
+
+    def test_imports(self):
+        js = JavaScriptParser(
+            'import a from "./a.js";import "lib";import("./b.js");'
+            'new URL("c.wasm", import.meta.url)\n'
+            '//# sourceMappingURL=app.js.map', 'http://example.org/js/app.js')
+        assert list(js) == [
+            ('http://example.org/js/a.js', {'inline': True}),
+            ('http://example.org/js/b.js', {'inline': True}),
+            ('http://example.org/js/c.wasm', {'inline': True}),
+            ('http://example.org/js/app.js.map', {'inline': True})]
+        assert get_parser_for_mimetype('application/javascript') is \
+            JavaScriptParser
+
+    def test_strings(self):
+        """Strings that look like urls are found, as a guess; comments,
+        regular expressions and other strings are skipped.
+        """
+        js = JavaScriptParser(
+            r"""var a = "/img/a.png", b = 'https:\/\/example.com\/b',
+            c = /"\/d.png"/, d = 1 / 2, e = "click me", f = "text/html";
+            // "/g.png"
+            /* "/h.png" */ i = "i.min.js" + "1.2.3";""",
+            'http://example.org/js/app.js')
+        assert list(js) == [
+            ('http://example.org/img/a.png',
+             {'inline': True, 'heuristic': True}),
+            ('https://example.com/b', {'inline': False, 'heuristic': True}),
+            ('http://example.org/js/i.min.js',
+             {'inline': True, 'heuristic': True})]
+
+    def test_replace(self):
+        js = JavaScriptParser(
+            """x = '/a.png'; import("./b.js")""", 'http://example.org/')
+        assert js.replace_urls(lambda url: None) == js.data
+        assert js.replace_urls(lambda url: url + "?'") == (
+            """x = 'http://example.org/a.png?\\''; """
+            """import("http://example.org/b.js?'")""")
+
+
+class TestXMLParsers(object):
+
+    def test_svg(self):
+        svg = ('<svg><image xlink:href="a.png"/><use href="#b"/>'
+               '<a href="c.html?d=1&amp;e=2">c</a></svg>')
+        parser = SVGParser(svg, 'http://example.org/')
+        assert list(parser) == [
+            ('http://example.org/a.png', {'inline': True,
+                                          'tag': 'image.xlink:href'}),
+            ('http://example.org/c.html?d=1&e=2', {'inline': False,
+                                                   'tag': 'a.href'})]
+        assert parser.replace_urls(lambda url: None) == svg
+        assert parser.replace_urls(lambda url: 'f?g&h') == (
+            '<svg><image xlink:href="f?g&amp;h"/><use href="#b"/>'
+            '<a href="f?g&amp;h">c</a></svg>')
+
+    def test_feeds(self):
+        rss = ('<rss><channel><link>http://example.org/</link><item>'
+               '<link>\n  /post </link><enclosure url="/a.mp3"/>'
+               '</item></channel></rss>')
+        assert [url for url, _ in FeedParser(rss, 'http://example.org/')] == [
+            'http://example.org/', 'http://example.org/post',
+            'http://example.org/a.mp3']
+        atom = '<feed><link href="/a"/><logo>/b.png</logo></feed>'
+        assert list(FeedParser(atom, 'http://example.org/')) == [
+            ('http://example.org/a', {'inline': False, 'tag': 'link.href'}),
+            ('http://example.org/b.png', {'inline': True, 'tag': 'logo'})]
+
+    def test_manifest(self):
+        manifest = '{"icons": [{"src": "i.png"}], "start_url": "/", "x": "y"}'
+        parser = ManifestParser(manifest, 'http://example.org/app/')
+        assert list(parser) == [
+            ('http://example.org/app/i.png', {'inline': True, 'tag': 'src'}),
+            ('http://example.org/', {'inline': False, 'tag': 'start_url'})]
+        assert parser.replace_urls(lambda url: url + '"') == (
+            '{"icons": [{"src": "http://example.org/app/i.png\\""}], '
+            '"start_url": "http://example.org/\\"", "x": "y"}')
+
+
+class TestParserRegistry(object):
+
+    def test_lookup(self):
+        assert get_parser_for_mimetype('application/xhtml+xml') is HTMLParser
+        assert get_parser_for_mimetype('image/svg+xml') is SVGParser
+        assert get_parser_for_mimetype('image/png') is None
+        # Too expensive
+        assert get_parser_for_mimetype('text/javascript', max_cost=2) is None
+
+    def test_sniff(self):
+        assert parsers.sniff(b'\n<!DOCTYPE html><p>') is HTMLParser
+        assert parsers.sniff(
+            '<?xml version="1.0"?><!-- x --><svg></svg>') is SVGParser
+        assert parsers.sniff('<rss version="2.0">') is FeedParser
+        assert parsers.sniff('{"start_url": "/"}') is ManifestParser
+        assert parsers.sniff('just some text') is None
+
+    def test_entry_points(self, monkeypatch):
+        class EntryPoint(object):
+            def load(self):
+                return CSSParser
+        monkeypatch.setattr('track.parser._iter_entry_points',
+                            lambda group: [EntryPoint()])
+        registry = ParserRegistry()
+        assert registry.get('text/css') is CSSParser
+        # Registered by hand, replacing the plugin
+        registry.register(HTMLParser, ['text/css'])
+        assert registry.get('text/css') is HTMLParser
+
+
+class TestDetectEncoding(object):
+
+    def test_bom(self):
+        assert detect_encoding(codecs.BOM_UTF8 + b'<meta charset=latin1>') \
+            == 'utf-8'
+
+    def test_meta(self):
+        assert detect_encoding(b'<meta charset="ISO-8859-1">') == 'iso8859-1'
+        assert detect_encoding(
+            b'<meta http-equiv="Content-Type" '
+            b'content="text/html; charset=windows-1252">') == 'cp1252'
+        # Only declarations early in the document count
+        assert detect_encoding(
+            b' ' * 2000 + b'<meta charset="latin1">') != 'iso8859-1'
+
+    def test_guess_remembered(self, monkeypatch):
+        guesses = []
+        def detect(data):
+            guesses.append(data)
+            return {'encoding': 'windows-1252', 'confidence': 0.9}
+        monkeypatch.setattr('charade.detect', detect)
+        for url in ('http://example.org/news/1', 'http://example.org/news/2'):
+            assert detect_encoding(b'caf\xe9', url) == 'windows-1252'
+        assert len(guesses) == 1
+
+
 class TestHTMLParser(object):
 
     def _make_parser(self, html, url='http://example.org'):
@@ -52,6 +226,26 @@ class TestHTMLParser(object):
     def replace(self, html, replacer):
         return self._make_parser(html).replace_urls(replacer)
 
+    def test_parsed_once(self):
+        """Finding urls and replacing them, however often, tokenizes
+        the document only once.
+        """
+        html = '<a href="/a"><style>b { background: url(/b) }</style>'
+        parser = HTMLParser(html, 'http://example.org')
+        calls = []
+        parse = parser._parse
+        parser._parse = lambda: calls.append(1) or parse()
+
+        assert [url for url, _ in parser] == [
+            'http://example.org/a', 'http://example.org/b']
+        assert parser.replace_urls(lambda url: url + '?x') == \
+            '<a href="http://example.org/a?x"><style>b { background: ' \
+            'url("http://example.org/b?x") }</style>'
+        # Each replacement starts from the original
+        assert parser.replace_urls(lambda url: None) == html
+        list(parser)
+        assert len(calls) == 1
+
     def test_entities(self):
         urls, opts = self.urls_with_opts(b"""
             <a href="f&quot;oo">""")
@@ -146,6 +340,37 @@ class TestHTMLParser(object):
         assert self.replace(doc, lambda u: 'bar.gif') == \
             b"""<style>h1 { background-image: url("bar.gif") }</style>"""
 
+    def test_srcset(self):
+        doc = b"""<img src="a.png" srcset="b.png 2x,c, d.png 480w">"""
+        urls, opts = self.urls_with_opts(doc)
+        assert urls == ['http://example.org/a.png', 'http://example.org/b.png',
+                        'http://example.org/c', 'http://example.org/d.png']
+        assert all(o.get('inline') for o in opts)
+        assert opts[1]['tag'] == 'img.srcset'
+
+        # The descriptors are kept
+        assert self.replace(doc, lambda u: u.rsplit('/', 1)[1] + ' x') == \
+            b"""<img src="a.png x" srcset="b.png%20x 2x,c%20x, d.png%20x 480w">"""
+
+    def test_picture_and_media(self):
+        assert self.urls(b"""
+        <picture><source srcset="a.webp" type="image/webp"></picture>
+        <video poster="b.jpg"><source src="c.mp4"><track src="d.vtt">
+        </video>
+        <img data-src="e.jpg" data-srcset="f.jpg 1x">""") == [
+            'http://example.org/a.webp', 'http://example.org/b.jpg',
+            'http://example.org/c.mp4', 'http://example.org/d.vtt',
+            'http://example.org/e.jpg', 'http://example.org/f.jpg']
+
+    def test_preload(self):
+        urls, opts = self.urls_with_opts(b"""
+            <link rel="preload" href="font.woff2" as="font">
+            <link rel="modulepreload" href="app.js">""")
+        assert urls == ['http://example.org/font.woff2',
+                        'http://example.org/app.js']
+        assert opts[0].get('inline') is True
+        assert opts[1].get('inline') is True
+
     # HTML Tokenization issues
 
     def test_unclosed_style_tag(self):
@@ -174,3 +399,60 @@ class TestHTMLParser(object):
         assert tokens[3]['type'] == 'tag-open-end'
         assert len(tokens) == 4
 
+
+    def test_document_ends_within_tag(self):
+        """[regression]"""
+        assert self.urls_with_opts(b'<a href=')[0] == []
+        assert self.urls_with_opts(b'<script>x</script')[0] == []
+
+
+class TestHTMLLinkStream(object):
+
+    def test_chunks(self):
+        """Urls are found as soon as their tag is complete, even if it
+        is split between chunks.
+        """
+        html = (b'<a href="/a"><script>x = "<a href=/no>"</script>'
+                b'<img src="/b"><!-- <a href="/c"> --><a href="/d">')
+        stream = HTMLLinkStream('http://example.org/', 'utf-8')
+        assert stream.feed(html[:9]) == []
+        assert stream.feed(html[9:30]) == [
+            ('http://example.org/a', {'inline': False, 'tag': 'a.href'})]
+        assert stream.feed(html[30:]) == [
+            ('http://example.org/b', {'inline': True, 'tag': 'img.src'}),
+            ('http://example.org/d', {'inline': False, 'tag': 'a.href'})]
+        assert stream.close() == []
+
+        # The full document need not be parsed again
+        parser = stream.parser(html)
+        expected = HTMLParser(html, 'http://example.org/', 'utf-8')
+        assert list(parser) == list(expected)
+        assert parser.replace_urls(lambda url: url + '?x') == \
+            expected.replace_urls(lambda url: url + '?x')
+
+    def test_encoding(self):
+        """Without a transport encoding, the stream decides on the same
+        one as a parser of the whole document, however it is chunked.
+        """
+        def stream(html, size):
+            # Guesses are remembered by site and directory; not here
+            stream = HTMLLinkStream('http://example.org/{}/'.format(size))
+            urls = []
+            for i in range(0, len(html), size):
+                urls.extend(stream.feed(html[i:i+size]))
+            urls.extend(stream.close())
+            return stream.parser(html), urls
+
+        declared = ('<meta charset="iso-8859-7"><a href="α">'
+                    + 'x' * 2000).encode('iso-8859-7')
+        # Not declared, and plain ASCII for the first kilobyte
+        undeclared = ('x' * 2000 + '<a href="été">'
+                      + 'café crème ' * 1000).encode('latin-1')
+        for html in (declared, undeclared):
+            expected = HTMLParser(html, 'http://example.org/all/')
+            for size in (7, 1000, 16 * 1024, len(html)):
+                parser, urls = stream(html, size)
+                assert parser.encoding == expected.encoding
+                assert [url for url, _ in urls] == [
+                    url.replace('/all/', '/{}/'.format(size))
+                    for url, _ in expected]
@@ -1,7 +1,20 @@
+import datetime
+from functools import partial
+import gzip
+import pickle
 import pytest
-from .helpers import rules, internet, arglogger, block
+from .helpers import rules, internet, arglogger, block, fakeclock, \
+    TestableSpider, \
+    fake_response
 from tests.test_cli import testable_cli_rules
 from track.cli import CLIRules, Script
+from track.frontier import PriorityFrontier, requisites_first, by_depth
+from track.mirror import Mirror
+from track.parser import HTMLParser
+from track.shard import ShardedCrawl, ShardChannel, ShardMirror, shard_of
+from track.sitemap import add_sitemap
+from track.spider import Link, Budget
+from track.utils import url_cache_stats
 
 # Import fixtures
 from .helpers import spider, spiderfactory
@@ -54,6 +67,20 @@ class TestNormalizeUrl:
             assert b'"./foo.html#some-fragment"' in content
 
 
+def test_url_cache():
+    """Normalizing the same url again is answered from the cache; the
+    links do not share their data.
+    """
+    hits = url_cache_stats()['normalize_url']['hits']
+    first = Link('http://example.org/cached#a')
+    second = Link('http://example.org/cached#a')
+    assert url_cache_stats()['normalize_url']['hits'] == hits + 1
+
+    second.lossy_url_data['fragment'] = 'b'
+    assert first.lossy_url_data['fragment'] == 'a'
+    assert Link('http://example.org/cached#a').lossy_url_data['fragment'] == 'a'
+
+
 class TestDuplicateHandling:
     """This is a bit more tricky than you might think because while
     we want to minimize any duplicate processing, we might have to
@@ -115,6 +142,26 @@ class TestDuplicateHandling:
             assert spider._link_queue[0].url == 'http://example.org/link'
             assert spider._link_queue[1].url == 'http://example.org/link'
 
+    def test_repeated_links_in_a_page(self, spider):
+        """A page linking to the same url the same way more than
+        once adds it to the queue once.
+        """
+        urlspec = {'http://example.org': '<a href="/link"><a href="/link">'
+                                         '<img src="/link"><a href="/link#top">',
+                   'http://example.org/link': ''}
+        with internet(**urlspec) as uris:
+            spider.events.bail_state_changed = arglogger()
+            spider.add('http://example.org')
+            spider.process_one()
+
+            assert sorted((l.original_url, l.info['tag'])
+                          for l in spider._link_queue) == [
+                ('http://example.org/link', 'a.href'),
+                ('http://example.org/link', 'img.src'),
+                ('http://example.org/link#top', 'a.href')]
+            assert spider.events.bail_state_changed.kwarg('links_total') == [4]
+            assert spider.events.bail_state_changed.kwarg('links_followed') == [3]
+
     def test_duplicates_in_user_api(self, spider):
         """Duplicates and the public spider.add() method.
         """
@@ -173,6 +220,30 @@ def test_error_code(spider):
         assert len(spider) == 0
 
 
+def test_unread_bodies_are_released(spider):
+    """Bodies nobody was interested in are not left on the connection.
+    Small ones are read, so the connection can be reused, for large
+    ones the connection is closed.
+    """
+    with internet(**{
+        'http://example.org/small': dict(
+            stream=b'x' * 100, headers={'content-type': 'image/png'}),
+        'http://example.org/large': dict(
+            stream=b'x' * 100000, headers={'content-type': 'image/png'}),
+    }) as net:
+        spider.rules._save = lambda l: False
+        spider.add('http://example.org/small')
+        spider.add('http://example.org/large')
+        large, small = list(spider._link_queue)
+        spider.loop()
+
+        assert small.response.content == b'x' * 100
+        assert large.response.raw.closed
+        assert net.requests == {
+            'http://example.org/small': 1, 'http://example.org/large': 1}
+        assert spider.stats['connections_discarded'] == 1
+
+
 def test_http_header_links(spiderfactory):
     """The HTTP headers may include links.
     """
@@ -203,6 +274,160 @@ def test_http_header_links(spiderfactory):
         assert spider._link_queue[-1].info['inline'] == True
 
 
+def test_priority_frontier(spiderfactory):
+    """The order in which urls are processed can be customized."""
+    with internet(
+            index='<a href="/page">page</a><img src="/pic">',
+            page=dict(links=['deep']), pic='', deep=''):
+        for frontier, expected in (
+                (None, ['index', 'page', 'pic', 'deep']),
+                (PriorityFrontier(requisites_first, by_depth),
+                    ['index', 'pic', 'page', 'deep'])):
+            spider = spiderfactory(frontier=frontier)
+            spider.events.taken_by_processor = arglogger()
+            spider.add('http://example.org/index')
+            spider.loop()
+            assert [link.url.rsplit('/', 1)[1] for link in
+                    spider.events.taken_by_processor.arg(0)] == expected
+
+
+def test_delayed_links_keep_their_place(spiderfactory):
+    """A link that had to wait for its host does not jump the queue
+    once the host is ready again.
+    """
+    spider = spiderfactory(frontier=PriorityFrontier(by_depth))
+    fakeclock(spider)
+    page = Link('http://example.org/page', previous=Link('http://example.org/'))
+    deep = Link('http://example.org/deep', previous=page)
+    spider._delay_link(deep, 0)
+    spider._link_queue.add(Link('http://other.org/', source=None))
+    assert spider._next_link().url == 'http://other.org/'
+    assert spider._next_link() is deep
+
+
+def test_links_added_while_downloading(spider):
+    """The links of an HTML page are added to the queue while the page
+    is still coming in.
+    """
+    page = b'<a href="/first">' + b' ' * 100000 + b'<a href="/last">'
+    with internet(**{
+            'http://example.org/': dict(
+                stream=page, headers={'content-type': 'text/html'}),
+            'http://example.org/first': '',
+            'http://example.org/last': ''}) as net:
+        # How much of the page had arrived when a link was queued
+        received = {}
+        def added_to_queue(link):
+            if link.previous:
+                received[link.url] = len(getattr(
+                    link.previous.response, '_partial_content', page))
+        spider.events.added_to_queue = added_to_queue
+        spider.add('http://example.org/')
+        spider.loop()
+
+        assert received['http://example.org/first'] < len(page)
+        assert received['http://example.org/last'] == len(page)
+        assert set(spider.mirror.stored_urls) == set(net)
+        assert b'href="./first.html"' in \
+            spider.mirror.get_file('http://example.org/')
+
+
+def test_streamed_links_withdrawn(spider):
+    """The links added while a page downloads are taken out of the
+    queue again if the @stop rules refuse the page.
+    """
+    page = b'<a href="/a">' + b' ' * 100000 + b'<a href="/b">'
+    with internet(**{
+            'http://example.org/': dict(
+                stream=page, headers={'content-type': 'text/html'}),
+            'http://example.org/a': '', 'http://example.org/b': ''}) as net:
+        spider.rules._stop = True
+        spider.events.withdrawn_from_queue = arglogger()
+        spider.add('http://example.org/')
+        spider.loop()
+
+        assert [link.url for link in
+                spider.events.withdrawn_from_queue.arg(0)] == [
+            'http://example.org/a', 'http://example.org/b']
+        assert net.requests['http://example.org/a'] == 0
+        assert net.requests['http://example.org/b'] == 0
+
+
+def test_parse_workers(spider):
+    """Documents can be parsed in other processes, while the spider
+    goes on with the next url.
+    """
+    with internet(index=dict(links=['a', 'b']), a=dict(links=['c']),
+                  b='', c='') as net:
+        spider.parse_workers = 2
+        spider.min_offload_size = 0
+        spider.add('http://example.org/index')
+        spider.loop()
+        assert set(spider.mirror.stored_urls) == set(net)
+        assert {url for url, _ in spider.mirror.url_info[
+            'http://example.org/index']['links']} == {
+            'http://example.org/a', 'http://example.org/b'}
+        assert not hasattr(spider, '_parse_pool')
+
+
+def test_parse_workers_parse_once(spider, monkeypatch):
+    """A document parsed in another process is not parsed here again
+    when the mirror converts its links as it saves it.
+    """
+    parsed_here = []
+    parse = HTMLParser._parse
+    def logged_parse(self):
+        parsed_here.append(self.base_url)
+        return parse(self)
+    monkeypatch.setattr(HTMLParser, '_parse', logged_parse)
+
+    with internet(index=dict(links=['a']), a=''):
+        spider.parse_workers = 2
+        spider.min_offload_size = 0
+        spider.mirror.convert_links = spider.mirror.write_at_once = True
+        spider.rules._follow = lambda link: link.url.endswith('/index')
+        spider.add('http://example.org/index')
+        # Not loop(), finishing the mirror converts all files again
+        while len(spider):
+            spider.process_one()
+        spider.shutdown()
+        assert b'href="http://example.org/a"' in \
+            spider.mirror.get_file('http://example.org/index')
+        assert parsed_here == []
+
+
+def test_parser_registry(spiderfactory):
+    """A document the server does not label properly is recognized by
+    its content. Parsers can be too expensive for a crawl.
+    """
+    with internet(
+            index=dict(stream='<!DOCTYPE html><a href="/a">a</a>',
+                       headers={'content-type': 'text/plain'}),
+            a='') as net:
+        spider = spiderfactory()
+        spider.add('http://example.org/index')
+        spider.loop()
+        assert set(spider.mirror.stored_urls) == set(net)
+        assert spider.mirror.url_info['http://example.org/index'][
+            'sniffed_type'] == 'text/html'
+
+        spider = spiderfactory()
+        spider.max_parse_cost = 1
+        spider.add('http://example.org/index')
+        spider.loop()
+        assert set(spider.mirror.stored_urls) == {'http://example.org/index'}
+
+    # Guessing reads only the start of a document we do not keep
+    with internet(big=dict(stream=b'x' * 100000,
+                           headers={'content-type': 'text/plain'})) as net:
+        spider = spiderfactory(rules=rules(save=False))
+        spider.add(net[0], source=None)
+        link = spider._link_queue[0]
+        spider.process_one()
+        assert link.response.truncated
+        assert len(link.response._partial_content) < 100000
+
+
 class TestRedirects:
     """Make sure redirects are handled correctly.
 
@@ -230,6 +455,22 @@ class TestRedirects:
             assert calls[0].url == 'http://example.org/foo'
             assert calls[1].url == 'http://example.org/baz'
 
+    def test_redirect_target_is_enqueued(self, spider):
+        """The redirect target is queued like any other link, e.g. its
+        robots.txt is fetched ahead of time.
+        """
+        with internet(**{
+            'http://example.org/foo': dict(
+                    status=302, headers={'Location': 'http://other.org/bar'}),
+            'http://other.org/bar': dict(stream='ok'),
+        }):
+            spider._new_in_queue = arglogger()
+            spider.add('http://example.org/foo')
+            spider.loop()
+
+            assert [link.url for link in spider._new_in_queue.arg(0)] == [
+                'http://example.org/foo', 'http://other.org/bar']
+
     def test_redirects_in_mirror(self, spider):
         """Test that links to urls that redirect are properly resolved
         in the local copy.
@@ -297,6 +538,62 @@ class TestRedirects:
             # matching the size filter
             assert len(spider.mirror.encountered_urls) == 1
 
+    def test_permanent_redirects_are_remembered(self, spiderfactory):
+        """The mirror remembers permanent redirects, so an update does
+        not need to ask the server about them again.
+        """
+        urlspec = {
+            'http://example.org/foo': dict(
+                    status=301,
+                    headers={'Location': 'http://example.org/bar'}),
+            'http://example.org/bar': {}
+        }
+        with internet(**urlspec):
+            spider = spiderfactory()
+            spider.add('http://example.org/foo')
+            spider.loop()
+
+        with internet(**urlspec) as net:
+            spider = spiderfactory(mirror=spider.mirror)
+            spider.reuse_redirects = True
+            spider.add('http://example.org/foo')
+            spider.loop()
+
+            assert net.requests['http://example.org/foo'] == 0
+            assert net.requests['http://example.org/bar'] == 1
+            assert 'http://example.org/bar' in spider.mirror.encountered_urls
+
+        # Unless this is an update, we ask again
+        with internet(**urlspec) as net:
+            spider = spiderfactory(mirror=spider.mirror)
+            spider.add('http://example.org/foo')
+            spider.loop()
+            assert net.requests['http://example.org/foo'] == 1
+
+    def test_redirect_to_same_normalized_url(self, spiderfactory):
+        """A redirect from http to https is not remembered; the urls
+        are the same to us, and we would go in circles.
+        """
+        urlspec = {
+            'http://example.org/foo': dict(
+                    status=301,
+                    headers={'Location': 'https://example.org/foo'}),
+            'https://example.org/foo': {}
+        }
+        with internet(**urlspec):
+            spider = spiderfactory()
+            spider.add('http://example.org/foo')
+            spider.loop()
+            # The HEAD request to the target counts, too
+            assert spider.stats['requests'] == 3
+
+        with internet(**urlspec) as net:
+            spider = spiderfactory(mirror=spider.mirror)
+            spider.reuse_redirects = True
+            spider.add('http://example.org/foo')
+            spider.loop()
+            assert net.requests['http://example.org/foo'] == 1
+
     def test_ident_redirect(self, spider):
         """A url redirecting to itself.
         """
@@ -363,6 +660,294 @@ class TestSkipDownload:
             assert net.requests[net[0]] == 0
 
 
+    def test_sitemap_lastmod(self, spiderfactory):
+        """Urls from a sitemap are starting points, and are not
+        downloaded again if the sitemap says they have not changed.
+        """
+        sitemap = """<?xml version="1.0" encoding="UTF-8"?>
+            <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+              <url><loc>http://example.org/foo</loc>
+                   <lastmod>2005-01-01</lastmod></url>
+              <url><loc>http://example.org/bar</loc></url>
+            </urlset>"""
+        with internet(**{
+                'sitemap.xml.gz': dict(
+                    stream=gzip.compress(sitemap.encode('utf-8')),
+                    headers={'content-type': 'application/x-gzip'}),
+                'foo': '', 'bar': ''}) as net:
+            spider = spiderfactory()
+            # Even though we do not follow anything
+            spider.rules = testable_cli_rules(follow=['-'])
+            assert add_sitemap(spider, 'http://example.org/sitemap.xml.gz') == 2
+            spider.loop()
+            assert net.requests['http://example.org/foo'] == 1
+            assert net.requests['http://example.org/bar'] == 1
+
+            spider = spiderfactory(mirror=spider.mirror)
+            spider.rules = testable_cli_rules(follow=['-'])
+            add_sitemap(spider, 'http://example.org/sitemap.xml.gz')
+            spider.loop()
+            assert net.requests['http://example.org/foo'] == 1
+            assert net.requests['http://example.org/bar'] == 2
+
+
+    def test_update_budget(self, spiderfactory):
+        """With a budget, only the urls most likely to have changed
+        are checked again.
+        """
+        with internet(
+                index=dict(links=['often', 'rarely']),
+                often='', rarely='') as net:
+            spider = spiderfactory()
+            spider.rules = testable_cli_rules(follow=['+'])
+            spider.add(net[0])
+            spider.loop()
+            assert net.requests == {url: 1 for url in net}
+
+            # Pretend we have been watching these for a while
+            a_while_ago = datetime.datetime.utcnow() - datetime.timedelta(days=5)
+            for url, changes in ((net[0], 20), (net[1], 20), (net[2], 0)):
+                info = spider.mirror.url_info[url]
+                info.update(since=a_while_ago - datetime.timedelta(days=30),
+                            checked=a_while_ago, changes=changes)
+                spider.mirror.url_info[url] = info
+
+            spider = spiderfactory(mirror=spider.mirror)
+            spider.rules = testable_cli_rules(follow=['+'], update_budget=2)
+            spider.add(net[0])
+            spider.loop()
+            assert net.requests[net[0]] == 2
+            assert net.requests['http://example.org/often'] == 2
+            assert net.requests['http://example.org/rarely'] == 1
+
+    def test_update_budget_order(self, spiderfactory):
+        """The urls most likely to have changed are checked first, even
+        those far from the starting url.
+        """
+        with internet(
+                index=dict(links=['page']), page=dict(links=['deep']),
+                deep='') as net:
+            spider = spiderfactory()
+            spider.rules = testable_cli_rules(follow=['+'])
+            spider.add('http://example.org/index')
+            spider.loop()
+
+            a_while_ago = datetime.datetime.utcnow() - datetime.timedelta(days=5)
+            for url, changes in (('index', 5), ('page', 0), ('deep', 20)):
+                url = 'http://example.org/' + url
+                info = spider.mirror.url_info[url]
+                info.update(since=a_while_ago - datetime.timedelta(days=30),
+                            checked=a_while_ago, changes=changes)
+                spider.mirror.url_info[url] = info
+
+            rules = testable_cli_rules(follow=['+'], update_budget=2)
+            planner = rules.get_planner(spider.mirror)
+            assert planner.plan() == [
+                'http://example.org/deep', 'http://example.org/index']
+
+            # Seeded like the command line does it
+            spider = spiderfactory(mirror=spider.mirror)
+            spider.rules = rules
+            spider.events.completed = arglogger()
+            for url in planner.plan():
+                spider.add(url)
+            spider.add('http://example.org/index')
+            spider.loop()
+            completed = [link.url for link in spider.events.completed.arg(0)]
+            assert completed[0] == 'http://example.org/deep'
+            assert net.requests['http://example.org/deep'] == 2
+            assert net.requests['http://example.org/page'] == 1
+
+
+class TestRetries:
+    """Urls that fail at the connection stage are tried again later.
+    """
+
+    def test_backoff(self, spider):
+        """Retries are spaced out further and further.
+        """
+        clock = fakeclock(spider)
+        spider.host_failure_threshold = 100
+        with internet() as net:
+            spider.add('http://example.org/')
+            spider.loop()
+
+            assert net.requests['http://example.org/'] > spider.max_retries
+            assert len(clock.sleeps) == net.requests['http://example.org/'] - 1
+            # Each delay is at least half of its exponential share
+            for attempt, pause in enumerate(clock.sleeps):
+                assert pause >= spider.retry_delay * 2 ** attempt / 2
+
+    def test_failing_host_does_not_block_others(self, spider):
+        """A host that keeps failing is given a break, during which the
+        urls of other hosts are processed.
+        """
+        clock = fakeclock(spider)
+        spider.events.completed = arglogger()
+        with internet(**{'http://healthy.org/': ''}):
+            for i in range(5):
+                spider.add('http://dead.org/{}'.format(i))
+            spider.add('http://healthy.org/')
+            spider.loop()
+
+            completed = [link.url for link in spider.events.completed.arg(0)]
+            # After three failures, the remaining dead.org urls had to
+            # wait for the healthy host.
+            assert completed.index('http://healthy.org/') == 3
+            assert spider.get_host(Link('http://dead.org/')).breaks > 0
+            # Then they waited for the break to be over
+            assert clock.sleeps
+
+
+class TestThrottling:
+    """Hosts that signal overload are slowed down.
+    """
+
+    def test_retry_after(self, spider):
+        """A url answering 429 is tried again, but not before the
+        host's Retry-After allows it.
+        """
+        clock = fakeclock(spider)
+        spider.events.host_state_changed = arglogger()
+        with internet(**{'http://example.org/': dict(
+                status=429, headers={'Retry-After': '120'})}) as net:
+            spider.add('http://example.org/')
+            spider.loop()
+
+            assert net.requests['http://example.org/'] > 1
+            assert clock.sleeps[0] >= 120
+            assert spider.events.host_state_changed.kwarg('throttled')[0]
+
+    def test_aimd(self, spider):
+        """The delay between requests doubles on overload, and shrinks
+        in small steps otherwise.
+        """
+        link = Link('http://example.org/')
+        host = spider.get_host(link)
+        overloaded = fake_response(link, '', status=503)
+        fine = fake_response(link, '')
+
+        host.responded(0, overloaded)
+        host.responded(0, overloaded)
+        assert host.delay == spider.host_delay_step * 2
+        host.responded(0, fine)
+        assert host.delay == spider.host_delay_step
+        host.responded(0, fine)
+        assert host.delay == spider.min_host_delay
+        assert not host.is_throttled(0)
+
+
+class TestBudget:
+    """The spider stops when it runs out of budget, and can resume."""
+
+    def test_global_budget(self, spiderfactory):
+        with internet(index=dict(links=['a', 'b', 'c']), a='', b='', c='') as net:
+            spider = spiderfactory()
+            spider.budget = Budget(requests=2)
+            spider.add(net[-1])
+            spider.loop()
+            assert spider.limit_reached == 'requests'
+            assert sum(net.requests.values()) == 2
+
+            # The links we did not get to survive being stored
+            left = spider.mirror.frontier['links']
+            assert len(left) == 2
+            left = pickle.loads(pickle.dumps(left))
+            assert left[0].previous.url == 'http://example.org/index'
+            spider.mirror.frontier['links'] = left
+
+            spider = spiderfactory(mirror=spider.mirror)
+            assert spider.resume() == 2
+            spider.loop()
+            assert spider.limit_reached is None
+            assert net.requests == {url: 1 for url in net}
+            assert not 'links' in spider.mirror.frontier
+
+    def test_resume_does_not_fetch_again(self, spiderfactory):
+        """Pages the stopped run saved are not fetched again when the
+        resumed run finds links to them.
+        """
+        with internet(index=dict(links=['a', 'b']), a='',
+                      b=dict(links=['a'])) as net:
+            spider = spiderfactory()
+            spider.budget = Budget(requests=2)
+            spider.add(net[-1])
+            spider.loop()
+            assert spider.mirror.frontier['links'][0].url == \
+                'http://example.org/b'
+
+            spider = spiderfactory(mirror=spider.mirror)
+            assert spider.resume() == 1
+            spider.loop()
+            assert net.requests == {url: 1 for url in net}
+            assert set(spider.mirror.encountered_urls) == set(net)
+
+    def test_host_budget(self, spider):
+        with internet(**{
+                'index': dict(links=['a', 'b', 'http://example.com/']),
+                'a': '', 'b': '', 'http://example.com/': ''}) as net:
+            spider.host_budget = Budget(requests=2)
+            spider.add('http://example.org/index')
+            spider.loop()
+            assert net.requests['http://example.com/'] == 1
+            assert sum(net.requests.values()) == 3
+            assert len(spider.mirror.frontier['links']) == 1
+
+
+class ShardWorkerMirror(ShardMirror, Mirror):
+    pass
+
+
+def make_shard_spider(directory, channel):
+    return TestableSpider(
+        rules(), mirror=ShardWorkerMirror(channel, directory),
+        frontier=channel.frontier())
+
+
+def test_sharded_crawl(tmpdir):
+    """Workers each crawl their own hosts, the coordinator maintains
+    the mirror.
+    """
+    with internet(**{
+            'http://a.org/': dict(links=['http://b.org/', 'http://c.org/']),
+            'http://b.org/': dict(links=['http://a.org/x']),
+            'http://c.org/': '',
+            'http://a.org/x': ''}) as net:
+        mirror = Mirror(str(tmpdir))
+        crawl = ShardedCrawl(
+            mirror, partial(make_shard_spider, str(tmpdir)), 3)
+        crawl.add('http://a.org/')
+        crawl.loop()
+
+        assert set(mirror.stored_urls) == set(net)
+        assert set(mirror.encountered_urls) == set(net)
+        for url in net:
+            assert tmpdir.join(mirror.encountered_urls[url]).check()
+        assert len({shard_of(url, 3) for url in net}) > 1
+
+
+def test_shard_mirror_leaves_index_alone(tmpdir):
+    """A worker does not write the url index, even if it is stale; it
+    only knows the urls of its own shard.
+    """
+    mirror = Mirror(str(tmpdir))
+    for url in ('http://a.org/', 'http://b.org/'):
+        mirror.add(Link(url), fake_response(Link(url), ''))
+    mirror.finish()
+    with open(mirror.url_index.filename, 'rb') as f:
+        index = f.read()
+
+    conn = arglogger()
+    conn.send = arglogger()
+    channel = ShardChannel(0, 2, conn, {
+        'urls': {'http://a.org/': mirror.stored_urls['http://a.org/']},
+        'info': {'index_stale': True}})
+    ShardWorkerMirror(channel, str(tmpdir))
+    with open(mirror.url_index.filename, 'rb') as f:
+        assert f.read() == index
+    assert not conn.send.calls
+
+
 class TestLocalFiles:
 
     def test_basic_dealing_with_localfile(self, spider, tmpdir):
@@ -1,7 +1,9 @@
 from collections import namedtuple
 from contextlib import closing
+from functools import partial
 import hashlib
 import inspect
+from itertools import chain
 import numbers
 import shelve
 import string
@@ -9,8 +11,15 @@ import sys
 import fnmatch
 from os.path import normpath, abspath, join
 import argparse
+from xml.etree.ElementTree import ParseError
+from requests.exceptions import RequestException
+from ..frontier import PriorityFrontier, get_scorer
 from ..mirror import Mirror
-from ..spider import Spider, DefaultRules
+from ..shard import ShardedCrawl, ShardMirror
+from ..spider import Spider, DefaultRules, Budget
+from ..planner import UpdatePlanner
+from ..sitemap import add_sitemap
+from ..warc import WarcMirror
 from .tests import AvailableTests, Redirect
 from track.cli.events import CLIEvents, LiveLogEvents, SequentialEvents
 from .utils import BlessedString, BetterTerminal, ElasticString
@@ -23,6 +32,32 @@ UNITS = {
     'K': 1000
 }
 
+DURATIONS = {
+    'd': 24*60*60,
+    'h': 60*60,
+    'm': 60,
+    's': 1
+}
+
+
+def size_argument(value):
+    """An argparse type for sizes like ``20G``."""
+    size = OperatorImpl._norm(0, value)[1]
+    if size is False:
+        raise argparse.ArgumentTypeError('{} is not a valid size'.format(value))
+    return size
+
+
+def duration_argument(value):
+    """An argparse type for durations like ``90``, ``30m``, ``2h``, in
+    seconds."""
+    unit = DURATIONS.get(value[-1:].lower())
+    try:
+        return float(value[:-1] if unit else value) * (unit or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            '{} is not a valid duration'.format(value))
+
 
 class OperatorImpl:
     @classmethod
@@ -136,6 +171,9 @@ class CLIRules(DefaultRules):
             lambda f: self._parse_rule(f), arguments.save))
         self.stop_rules = list(map(
             lambda f: self._parse_rule(f), arguments.stop))
+        self.uses_robots = any(
+            rule.test is self.get_test('robots') for rule in
+            chain(self.follow_rules, self.save_rules, self.stop_rules))
 
     def _parse_rule(self, rule):
         """Parse a rule like ``+depth>3`` into a 4-tuple.
@@ -172,6 +210,9 @@ class CLIRules(DefaultRules):
 
         return Rule(action, is_stop_action, test, op, value, rule)
 
+    def respect_robots(self, spider):
+        return self.uses_robots
+
     @classmethod
     def get_test(cls, name):
         try:
@@ -190,7 +231,12 @@ class CLIRules(DefaultRules):
         """
         args = [link]
         if len(inspect.getargspec(test).args) == 2:
-            args.append(ctx)
+            # Let the test know the number its result will be compared
+            # against, if any. Some tests can use this to avoid work,
+            # e.g. size does not need to read a body past the threshold.
+            threshold = OperatorImpl._norm(0, value)[1] if op else False
+            args.append(dict(
+                ctx, threshold=None if threshold is False else threshold))
         test_result = test(*args)
         return Operators[op](test_result, value)
 
@@ -252,8 +298,25 @@ class CLIRules(DefaultRules):
         if self.arguments.no_modified_check:
             return 'exists'
 
-        if self.arguments.trust_expires:
-            return self.expiration_check(link, spider)
+        if self.arguments.trust_expires and \
+                self.expiration_check(link, spider):
+            return 'not-expired'
+
+        if self.lastmod_check(link, spider):
+            return 'not-modified'
+
+        # Spend a limited number of requests on the urls most
+        # likely to have changed.
+        if self.arguments.update_budget is not None:
+            if not self.get_planner(spider.mirror).should_check(link):
+                return 'deferred'
+
+    def get_planner(self, mirror):
+        """The :class:`UpdatePlanner` for ``--update-budget``."""
+        if not hasattr(self, '_planner'):
+            self._planner = UpdatePlanner(
+                mirror, self.arguments.update_budget)
+        return self._planner
 
     def configure_session(self, session, spider):
         super().configure_session(session, spider)
@@ -337,6 +400,10 @@ class CLIMirror(Mirror):
             convert_links=not namespace.no_link_conversion)
 
         self.layout = namespace.layout
+        self.convert_workers = namespace.parse_workers
+        self.max_parse_cost = namespace.max_parse_cost
+        if namespace.parse_cache_size is not None:
+            self.parse_cache.max_size = namespace.parse_cache_size
         self._url_formatter = URLFormatter()
 
     def get_filename(self, link, response):
@@ -345,6 +412,58 @@ class CLIMirror(Mirror):
         return Mirror.get_filename(self, link, response)
 
 
+class CLIWarcMirror(WarcMirror):
+    """Writes WARC files rather than a copy of the site, for ``--warc``.
+    """
+
+    def __init__(self, namespace):
+        WarcMirror.__init__(
+            self, normpath(abspath(namespace.path or 'tracked')),
+            max_segment_size=namespace.warc_size)
+        self.max_parse_cost = namespace.max_parse_cost
+
+
+class WorkerMirror(ShardMirror, CLIMirror):
+    """The mirror of a worker process, see :class:`ShardedCrawl`.
+    """
+
+
+def build_frontier(namespace):
+    """Return the frontier asked for by ``--order``, or ``None`` for
+    the default one.
+    """
+    if not namespace.order:
+        return None
+    scorers = []
+    for name in namespace.order.split(','):
+        scorer = get_scorer(name.strip())
+        if not scorer:
+            raise ValueError('{} is not a valid --order'.format(name))
+        scorers.append(scorer)
+    return PriorityFrontier(*scorers)
+
+
+def build_spider(namespace, rules, mirror, events, frontier):
+    spider = Spider(rules, mirror=mirror, events=events, frontier=frontier)
+    spider.budget = Budget(
+        namespace.max_requests, namespace.max_size, namespace.max_time)
+    spider.host_budget = Budget(
+        namespace.max_host_requests, namespace.max_host_size,
+        namespace.max_host_time)
+    spider.parse_workers = namespace.parse_workers
+    spider.max_parse_cost = namespace.max_parse_cost
+    spider.reuse_redirects = namespace.update or namespace.resume
+    return spider
+
+
+def make_worker_spider(namespace, channel):
+    """Runs in a worker process."""
+    return build_spider(
+        namespace, CLIRules(namespace), WorkerMirror(channel, namespace),
+        SequentialEvents(namespace, stream=sys.__stdout__),
+        channel.frontier(build_frontier(namespace)))
+
+
 class MyArgumentParser(argparse.ArgumentParser):
 
     class HelpFormatter(argparse.HelpFormatter):
@@ -410,6 +529,10 @@ class Script:
         urls_group.add_argument(
             '-F', '--from-file', action='append', metavar='FILE',
             help='Add urls from the file, one per line; can be given multiple times')
+        urls_group.add_argument(
+            '--sitemap', action='append', metavar='URL',
+            help='add the urls listed in a sitemap (or sitemap index); '
+                 'can be given multiple times')
         urls_group.add_argument(
             'url', nargs='*', metavar='url',
             help='urls to be added to the queue initially as a starting point')
@@ -433,6 +556,18 @@ class Script:
         mirror_group.add_argument(
             '--no-live-update', action='store_true',
             help='delay local mirror modifications until the spider is done')
+        mirror_group.add_argument(
+            '--parse-cache-size', type=size_argument, metavar='SIZE',
+            help='memory to use for keeping parsed documents around while '
+                 'converting links; e.g. 500M, default 64M')
+        mirror_group.add_argument(
+            '--warc', action='store_true',
+            help='store the requests and responses in WARC files, with a '
+                 'CDX index, for archival tools, rather than a copy of the '
+                 'site to browse')
+        mirror_group.add_argument(
+            '--warc-size', type=size_argument, metavar='SIZE',
+            help='start a new WARC file once one has SIZE bytes; default 1G')
 
         # How to deal with existing files
         update_group = parser.add_argument_group('updating a mirror')
@@ -450,6 +585,28 @@ class Script:
         update_group.add_argument(
             '--trust-expires', action='store_true',
             help='skip checking files for updates if the expires header allows')
+        update_group.add_argument(
+            '--resume', action='store_true',
+            help='continue a run that was stopped by one of the limits, '
+                 'with the urls it did not get to; implies --update')
+        update_group.add_argument(
+            '--update-budget', type=int, metavar='N',
+            help='check at most N known urls for modifications, those most '
+                 'likely to have changed; the others are checked on a '
+                 'later run')
+
+        # How much the crawl may cost
+        limits_group = parser.add_argument_group('limits')
+        for prefix, which in (('max', 'in total'), ('max-host', 'per host')):
+            limits_group.add_argument(
+                '--{}-requests'.format(prefix), type=int, metavar='N',
+                help='stop after N requests {}'.format(which))
+            limits_group.add_argument(
+                '--{}-size'.format(prefix), type=size_argument, metavar='SIZE',
+                help='stop after downloading SIZE bytes {}; e.g. 20G'.format(which))
+            limits_group.add_argument(
+                '--{}-time'.format(prefix), type=duration_argument,
+                metavar='TIME', help='stop after TIME {}; e.g. 2h'.format(which))
 
         # Affecting the UA behaviour, browsing process
         browing_group = parser.add_argument_group('browsing options')
@@ -464,6 +621,27 @@ class Script:
                  "accept = forget when finished, refuse = no not accept new"
                  "cookies, but use previous cookies from disk, block = "
                  "additionally ignore disk cookies")
+        browing_group.add_argument(
+            '--workers', type=int, default=1, metavar='N',
+            help='crawl with N processes, each taking care of some of the '
+                 'hosts; limits apply to each process separately')
+        browing_group.add_argument(
+            '--parse-workers', type=int, default=0, metavar='N',
+            help='parse large documents in N separate processes, while '
+                 'downloading continues; also used to convert links at the '
+                 'end')
+        browing_group.add_argument(
+            '--max-parse-cost', type=int, metavar='N',
+            help='only look for urls in documents that are cheap enough to '
+                 'parse: 1 for stylesheets, feeds and sitemaps, 2 to add '
+                 'HTML and SVG, 3 to add scripts; the default is all')
+        browing_group.add_argument(
+            '--order', metavar='SCORERS',
+            help="the order in which to process urls, as a comma-separated "
+                 "list of: 'requisites' (a page's assets first), 'depth' "
+                 "(shallow pages first), 'hosts' (alternate between hosts); "
+                 "later ones break ties. By default, the most recently "
+                 "found url is processed first")
 
         rules_group = parser.add_argument_group('rules')
         rules_group.add_argument(
@@ -517,10 +695,12 @@ class Script:
         namespace = parser.parse_args(argv[1:])
 
         # Setup the mirror
-        if namespace.update:
+        if namespace.update or namespace.resume:
             if not CLIMirror.is_valid_mirror(namespace.path):
-                print(('error: --update requested, but {} is not an '
-                       'existing mirror').format(namespace.path))
+                print(('error: --{} requested, but {} is not an '
+                       'existing mirror').format(
+                    'resume' if namespace.resume else 'update',
+                    namespace.path))
                 return
 
             info = CLIMirror.read_info(namespace.path)
@@ -533,7 +713,9 @@ class Script:
             for attr in dir(last_ns):
                 if attr.startswith('_'):
                     continue
-                if attr in ['path']:
+                if attr in ['path', 'update_budget', 'resume', 'workers',
+                            'parse_workers', 'parse_cache_size'] or \
+                        attr.startswith('max_'):
                     continue
                 setattr(namespace, attr, getattr(last_ns, attr))
 
@@ -544,7 +726,13 @@ class Script:
 
 
         # Open the local mirror
-        mirror = CLIMirror(namespace)
+        if namespace.warc:
+            if namespace.workers > 1:
+                print('error: --warc cannot be used with --workers')
+                return
+            mirror = CLIWarcMirror(namespace)
+        else:
+            mirror = CLIMirror(namespace)
 
         # Output to console differently if we have a tty vs piping
         if not sys.stdout.isatty():
@@ -552,22 +740,56 @@ class Script:
         else:
             events = LiveLogEvents(namespace, stream=sys.__stdout__)
 
-        # Setup the spider
+        # Setup the spider; with multiple workers, each has its own,
+        # and we coordinate.
         try:
-            spider = Spider(CLIRules(namespace), mirror=mirror, events=events)
+            rules = CLIRules(namespace)
+            frontier = build_frontier(namespace)
         except RuleError as e:
             print('error: {1}: {0}'.format(*e.args))
             return
+        except ValueError as e:
+            print('error: {}'.format(e))
+            return
+        if namespace.workers > 1:
+            spider = ShardedCrawl(
+                mirror, partial(make_worker_spider, namespace),
+                namespace.workers, shared_shelves=('cookies',), events=events)
+        else:
+            spider = build_spider(namespace, rules, mirror, events, frontier)
 
-        # Add the urls specified at the command line
-        for url in namespace.url:
-            spider.add(url)
-
-        # Load urls from additional files specified
-        for filename in namespace.from_file or ():
-            with open(filename, 'r') as f:
-                for url in f.readlines():
-                    spider.add(url.strip())
+        if namespace.resume:
+            # Rather than starting over
+            if not spider.resume():
+                print('error: there is nothing to resume')
+                return
+        else:
+            # With a budget for checking known urls, start with those
+            # most likely to have changed
+            if namespace.update_budget is not None:
+                for url in rules.get_planner(mirror).plan():
+                    spider.add(url)
+
+            # Add the urls specified at the command line
+            for url in namespace.url:
+                spider.add(url)
+
+            # Load urls from additional files specified
+            for filename in namespace.from_file or ():
+                with open(filename, 'r') as f:
+                    for url in f.readlines():
+                        spider.add(url.strip())
+
+            # Sitemaps, which can be large, are read as they come in
+            for url in namespace.sitemap or ():
+                if isinstance(spider, ShardedCrawl):
+                    spider.add_sitemap(url)
+                    continue
+                try:
+                    add_sitemap(spider, url)
+                except (RequestException, ParseError) as e:
+                    print('error: cannot read sitemap {}: {}'.format(url, e))
+                    return
 
         if not len(spider):
             parser.print_usage()
@@ -577,7 +799,7 @@ class Script:
         # Before we start, store the cli arguments in the mirror so
         # it can be updated without specifying them again.
         # TODO: Absolutize filenames before storing them.
-        if not namespace.update:
+        if not (namespace.update or namespace.resume):
             mirror.info['cli-ns'] = namespace
             mirror.info['cli-argv'] = argv[1:]
 
@@ -587,9 +809,14 @@ class Script:
         except:
             # Be sure the console cursor is set such that
             # nothing will be overwritten
-            spider.events.finalize()
+            events.finalize()
             raise
 
+        num_left = len(mirror.frontier.get('links', ()))
+        if num_left:
+            print('Stopped by a limit with {} urls left; continue with '
+                  '--resume'.format(num_left))
+
         # If so desired, we can delete files from the mirror that no
         # longer exist online.
         # TODO: This needs to happen before Mirror.finish()
@@ -14,6 +14,8 @@ class CLIEvents(Events):
 
         self.links = {}
         self.stats = Counter({'in_queue': 0, 'saved': 0})
+        # Hosts the spider is currently going easy on
+        self.throttled_hosts = {}
 
     def init_db(self, link):
         self.links.setdefault(link, {
@@ -26,6 +28,10 @@ class CLIEvents(Events):
         self.init_db(link)
         self.stats['in_queue'] += 1
 
+    def withdrawn_from_queue(self, link):
+        self.links.pop(link, None)
+        self.stats['in_queue'] -= 1
+
     def taken_by_processor(self, link):
         self.update_processor_status(link)
 
@@ -48,6 +54,29 @@ class CLIEvents(Events):
         self.display_link_completed(link)
         self.stats['in_queue'] -= 1
 
+    def host_state_changed(self, host, **kwargs):
+        if kwargs.get('throttled'):
+            self.throttled_hosts[host.name] = kwargs
+        else:
+            self.throttled_hosts.pop(host.name, None)
+
+    def links_converted(self, num_done, num_total):
+        self.stream.write(self.term.clear_eol)
+        self.stream.write('Converting links: {}/{} files\r'.format(
+            num_done, num_total))
+        if num_done == num_total:
+            self.stream.write('\n')
+
+    def _format_throttled_hosts(self):
+        """List the hosts we are currently going easy on."""
+        hosts = []
+        for name, state in sorted(self.throttled_hosts.items()):
+            if state['blocked_for']:
+                hosts.append('{} (paused)'.format(name))
+            else:
+                hosts.append('{} ({:.1f}s)'.format(name, state['delay']))
+        return ', '.join(hosts)
+
     def update_processor_status(self, link):
         raise NotImplementedError()
 
@@ -100,15 +129,16 @@ class CLIEvents(Events):
             if follow_state['failed'] == 'redirect':
                 result = ' → '
                 status_style = success
-            elif follow_state['failed'] in ('http-error', 'connect-error'):
+            elif follow_state['failed'] in ('http-error', 'connect-error', 'throttled'):
                 result = 'err'
                 status_style = error
                 url_style = error
+                response = follow_state['response'] or link.response
                 if isinstance(follow_state['exception'], ConnectionError):
                     error_msg = 'connection refused'
-                elif link.response.status_code:
-                    result = str(link.response.status_code)
-                    error_msg = link.response.reason
+                elif response and response.status_code:
+                    result = str(response.status_code)
+                    error_msg = response.reason
             elif follow_state['failed'] == 'not-modified':
                 pass
             else:
@@ -172,7 +202,11 @@ class LiveLogEvents(CLIEvents):
         self.stream.write(msg.format(self.term.width))
         # Move to next line, output spider status
         self.stream.write(self.term.move_down)
-        self.stream.write('  [{0[in_queue]} queued, {0[saved]} files saved, ? downloaded]'.format(self.stats))
+        status = '  [{0[in_queue]} queued, {0[saved]} files saved, ? downloaded'.format(self.stats)
+        if self.throttled_hosts:
+            status += ', slowed down: ' + self._format_throttled_hosts()
+        self.stream.write(ElasticString(
+            ElasticString.elastic(status), ']').format(self.term.width))
         # Move back
         self.stream.write('\033M')
         self.stream.write('\r')
@@ -221,6 +255,13 @@ class SequentialEvents(CLIEvents):
     def finalize(self):
         pass
 
+    def host_state_changed(self, host, **kwargs):
+        was_throttled = host.name in self.throttled_hosts
+        super().host_state_changed(host, **kwargs)
+        if kwargs.get('throttled') and not was_throttled:
+            self.stream.write('  [slowing down: {}]\n'.format(
+                self._format_throttled_hosts()))
+
     def display_link_completed(self, link):
         msg = self._format_link(link)
         if not msg:
@@ -1,6 +1,6 @@
 from genericpath import commonprefix
 from os.path import basename, splitext
-from track.spider import get_content_type
+from track.spider import get_content_type, read_content
 
 
 class Redirect(Exception):
@@ -55,7 +55,7 @@ class TestImpl(object):
     def robots(link, ctx):
         """Passes if the url is disallowed by robots instructions.
         """
-        return not ctx['spider'].robots.allowed(link.url)
+        return not ctx['spider'].robots.allowed(link.original_url)
 
     @staticmethod
     def depth(link):
@@ -319,7 +319,8 @@ class TestImpl(object):
 
         Note: This will execute a HEAD request to the url to determine
         the size. If the HEAD request does not include information about
-        the size, the full url needs to be fetched.
+        the size, the url needs to be fetched, though only until the
+        size you are testing against has been exceeded.
         """
         response = link.resolve(ctx['spider'], 'head')
         if not response:
@@ -333,8 +334,8 @@ class TestImpl(object):
                 return None
             length = safe_int(response.headers.get('content-length', None))
             if not length:
-                # Force downloading the content
-                length = len(response.content)
+                # Read the content, but stop once we know enough
+                length = read_content(response, limit=ctx.get('threshold'))
         return length
 
 
@@ -361,6 +362,8 @@ class TestImpl(object):
         response = link.resolve(ctx['spider'], 'full')
         if not response:
             return None
+        # A size test may have only read part of the body
+        read_content(response)
         return response.text
 
     @staticmethod
@@ -375,6 +378,16 @@ class TestImpl(object):
         """
         return link.extra.get('tag', '')
 
+    @staticmethod
+    def heuristic(link):
+        """Passes if the url is only a guess: something in a script
+        that looks like a url, but may well be something else. To not
+        follow these::
+
+            @follow -heuristic
+        """
+        return bool(link.info.get('heuristic', False))
+
 
 AvailableTests = {
     '': TestImpl.default,
@@ -411,4 +424,5 @@ AvailableTests = {
     'tag': TestImpl,
     'requisite': TestImpl,
     'robots': TestImpl,
+    'heuristic': TestImpl,
 }
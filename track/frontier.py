@@ -0,0 +1,133 @@
+"""The frontier is the collection of links the spider has yet to process.
+
+A frontier supports::
+
+    frontier.add(link)               # A newly found link
+    frontier.add(link, urgent=True)  # A link to process as soon as possible
+    frontier.pop()                   # The link to process next
+    len(frontier)
+
+and may support::
+
+    frontier.withdraw(links)         # Take links out again, unprocessed
+
+:class:`DequeFrontier` is the default. It processes the most recently
+found links first.
+
+:class:`PriorityFrontier` orders the links by one or more scoring
+functions. A scoring function takes a link and returns a number; links
+with a lower score are processed first. When several scoring functions
+are given, the first one decides, the others break ties.
+"""
+
+from collections import deque
+import heapq
+from itertools import count
+
+
+__all__ = ('DequeFrontier', 'PriorityFrontier', 'by_depth',
+           'requisites_first', 'HostFairness', 'get_scorer')
+
+
+class DequeFrontier(deque):
+    """Links are taken from the right; new ones are added to the left,
+    urgent ones to the right.
+    """
+
+    def add(self, link, urgent=False):
+        if urgent:
+            self.append(link)
+        else:
+            self.appendleft(link)
+
+    def withdraw(self, links):
+        withdrawn = set(map(id, links))
+        kept = [link for link in self if not id(link) in withdrawn]
+        self.clear()
+        self.extend(kept)
+
+
+class PriorityFrontier(object):
+    """A heap of links, ordered by ``scorers``; for links that score
+    the same, the one found first is processed first. Urgent links come
+    before all others.
+
+    Scores are calculated once, when a link is added. A heap entry is a
+    small tuple, so this can hold millions of links.
+    """
+
+    def __init__(self, *scorers):
+        self.scorers = scorers
+        self._heap = []
+        self._counter = count()
+
+    def add(self, link, urgent=False):
+        if urgent:
+            key = (0,)
+        else:
+            key = (1,) + tuple(scorer(link) for scorer in self.scorers)
+        heapq.heappush(self._heap, (key, next(self._counter), link))
+
+    def pop(self):
+        if not self._heap:
+            raise IndexError('pop from an empty frontier')
+        return heapq.heappop(self._heap)[-1]
+
+    def withdraw(self, links):
+        withdrawn = set(map(id, links))
+        self._heap = [
+            entry for entry in self._heap if not id(entry[-1]) in withdrawn]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        """In no particular order."""
+        return (entry[-1] for entry in self._heap)
+
+
+def by_depth(link):
+    """Shallow pages first. Under a crawl budget, this gives a better
+    overview of a site than following a single path deep down.
+    """
+    return link.depth
+
+
+def requisites_first(link):
+    """Images, stylesheets etc. of a page first, so the page is complete
+    and the mirror can convert links to them sooner.
+    """
+    return 0 if link.info.get('inline') else 1
+
+
+class HostFairness(object):
+    """Alternate between hosts, rather than processing all the links of
+    one host before getting to the next; with each link we find for a
+    host, its later links move further back.
+    """
+
+    def __init__(self):
+        self.counts = {}
+
+    def __call__(self, link):
+        host = link.parsed.netloc
+        self.counts[host] = self.counts.get(host, 0) + 1
+        return self.counts[host]
+
+
+SCORERS = {
+    'depth': by_depth,
+    'requisites': requisites_first,
+    'hosts': HostFairness,
+}
+
+
+def get_scorer(name):
+    """Return the scoring function registered as ``name``, or ``None``.
+    """
+    scorer = SCORERS.get(name)
+    if isinstance(scorer, type):
+        # Stateful, each frontier needs its own
+        scorer = scorer()
+    return scorer
@@ -0,0 +1,194 @@
+"""A sorted index of the urls in a mirror.
+
+The databases of a :class:`track.mirror.Mirror` are keyed by url, which
+answers "is this url stored, and where" well enough, but anything else,
+like all urls of a host, or below a path, means going through all of
+them, unpickling each record on the way.
+
+:class:`UrlIndex` is a text file with a line per url, sorted by the
+:func:`track.utils.surt` form of the url, so that the urls of a site,
+and of a directory within it, are next to each other. The file is
+memory-mapped and searched with a binary search; neither a lookup nor
+a scan needs to read more of it than the lines it returns.
+
+Changes are not written one by one, which would mean rewriting the
+file each time, but collected, sorted, and merged into the file in a
+single pass with :meth:`UrlIndex.update`.
+"""
+
+from collections import namedtuple
+import heapq
+import mmap
+import os
+from os import path
+from track.utils import surt
+
+
+__all__ = ('UrlIndex', 'IndexEntry')
+
+
+IndexEntry = namedtuple(
+    'IndexEntry', ('url', 'filename', 'mimetype', 'etag', 'offset'))
+IndexEntry.__doc__ = """A url in the index; ``offset`` is the position of
+the response within ``filename``, for a mirror storing many in a file,
+like a :class:`track.warc.WarcMirror`; otherwise ``None``.
+"""
+
+
+def _escape(value):
+    if value is None:
+        return '-'
+    return str(value).replace('%', '%25').replace(' ', '%20').replace(
+        '\n', '%0A') or '%'
+
+
+def _unescape(value):
+    if value == '-':
+        return None
+    if value == '%':
+        return ''
+    return value.replace('%0A', '\n').replace('%20', ' ').replace('%25', '%')
+
+
+def _format_line(entry):
+    return ' '.join(
+        [_escape(surt(entry.url))] + [_escape(field) for field in entry]
+    ) + '\n'
+
+
+def _parse_line(line):
+    fields = [_unescape(field) for field in line.rstrip('\n').split(' ')]
+    entry = IndexEntry(*fields[1:])
+    if entry.offset is not None:
+        entry = entry._replace(offset=int(entry.offset))
+    return entry
+
+
+class UrlIndex(object):
+    """The index file ``filename``, created when first written to.
+
+    ``update()`` replaces the file; an index opened elsewhere keeps
+    seeing the old one until it is opened again.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+        self._map = None
+        self._open()
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+    def __iter__(self):
+        return self._iter_from(0)
+
+    def get(self, url):
+        """Return the :class:`IndexEntry` of ``url``, or ``None``.
+        """
+        key = _escape(surt(url)).encode('utf-8') + b' '
+        # Different urls may have the same key, e.g. differ in case only
+        for entry in self._iter_prefix(key):
+            if entry.url == url:
+                return entry
+        return None
+
+    def scan(self, prefix):
+        """Yield the entries of all urls starting with ``prefix``, which
+        is itself a url, e.g. ``http://example.org/blog/``, in the order
+        of the index. Only the scheme is ignored, like in the keys.
+        """
+        key = _escape(surt(prefix)).encode('utf-8')
+        return self._iter_prefix(key)
+
+    def update(self, changes):
+        """Apply ``changes``, a dict of an :class:`IndexEntry` for each
+        url to add or replace, and ``None`` for each url to remove.
+
+        The entries of the file are not sorted again, only the changes
+        are, and merged into them, which makes this O(n) for n urls in
+        the index, in a single sequential read and write.
+        """
+        if not changes:
+            return
+        new_lines = sorted(
+            _format_line(entry) for entry in changes.values() if entry)
+
+        def unchanged():
+            for line in self._iter_lines(0):
+                line = line.decode('utf-8')
+                url = _unescape(line.split(' ', 2)[1])
+                if url not in changes:
+                    yield line
+
+        directory = path.dirname(self.filename)
+        if directory and not path.exists(directory):
+            os.makedirs(directory)
+        new_filename = self.filename + '.new'
+        with open(new_filename, 'w', encoding='utf-8', newline='') as f:
+            f.writelines(heapq.merge(unchanged(), new_lines))
+        self.close()
+        os.replace(new_filename, self.filename)
+        self._open()
+
+    def rebuild(self, entries):
+        """Replace the index with ``entries``, in any order.
+        """
+        self.close()
+        if path.exists(self.filename):
+            os.unlink(self.filename)
+        self._open()
+        self.update({entry.url: entry for entry in entries})
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self):
+        if not path.exists(self.filename) or \
+                not path.getsize(self.filename):
+            return
+        self._file = open(self.filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _bisect(self, key):
+        """Return the offset of the first line not sorting before
+        ``key``, or the size of the file.
+        """
+        data = self._map
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b'\n', 0, mid) + 1
+            end = data.find(b'\n', start)
+            if data[start:end] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def _iter_lines(self, offset):
+        if self._map is None:
+            return
+        data = self._map
+        while offset < len(data):
+            end = data.find(b'\n', offset)
+            yield data[offset:end + 1]
+            offset = end + 1
+
+    def _iter_from(self, offset):
+        for line in self._iter_lines(offset):
+            yield _parse_line(line.decode('utf-8'))
+
+    def _iter_prefix(self, prefix):
+        if self._map is None:
+            return
+        for line in self._iter_lines(self._bisect(prefix)):
+            if not line.startswith(prefix):
+                break
+            yield _parse_line(line.decode('utf-8'))
+
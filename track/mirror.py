@@ -115,6 +115,9 @@ TODO: Finally, during purging, we might have to do the reverse and
 replace local urls with remote ones.
 """
 
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import datetime
 import mimetypes
 import os
 from os import path
@@ -123,6 +126,7 @@ import shelve
 from urllib.parse import urlparse
 import itertools
 import urlnorm
+from track.index import IndexEntry, UrlIndex
 from track.parser import get_parser_for_mimetype
 from track.spider import get_content_type, Link, parse_http_date_header
 
@@ -137,6 +141,19 @@ class Mirror(object):
     """Have local copy of one or multiple urls.
     """
 
+    # Converting the links of the whole mirror, at the end of a run, is
+    # done by this many processes, in batches of ``convert_batch_size``
+    # files. They work on the files on disk directly, not through
+    # :meth:`open`.
+    convert_workers = 0
+    convert_batch_size = 100
+    # The memory, in bytes, to spend on keeping parsed documents around
+    # during link conversion, see :class:`ParseCache`.
+    parse_cache_size = 64 * 1024 * 1024
+    # Files needing a parser costing more than this are not converted,
+    # see :class:`track.parser.Parser`.
+    max_parse_cost = None
+
     @classmethod
     def is_valid_mirror(cls, directory):
         """Check if the directory contains a track mirror."""
@@ -167,10 +184,32 @@ class Mirror(object):
         # a separate map that essentially marks urls as "encountered",
         # for use with the :meth:`delete_unencountered` method.
         self.encountered_urls = {}
-        # the redirects that we know about
+        # the redirects that we know about, as a 3-tuple of the status
+        # code, the target url and the original (non-normalized) target.
+        # .. is persisted so that on an update, we do not need to ask
+        #    the server again about permanent redirects.
         # TODO: Think about whether we need to separate redirects into
         # encountered and stored in the same way we handle uls.
-        self.redirects = {}
+        self.redirects = self.open_shelve('redirects')
+        # robots.txt files, as a 3-tuple of status code, content and
+        # the time they expire, by robots url.
+        self.robots = self.open_shelve('robots')
+        # links a crawl did not get to because it ran out of budget,
+        # under the key 'links'; see Spider.resume().
+        self.frontier = self.open_shelve('frontier')
+
+        # The stored urls, sorted, see :mod:`track.index`. Written by
+        # :meth:`finish`; until then, the urls that changed are kept in
+        # ``_index_changes``. Should a run not get there, the index is
+        # built again from the databases the next time.
+        self.url_index = self.open_index('index')
+        self._index_changes = set()
+        if self.info.get('index_stale') or (
+                not path.exists(self.url_index.filename) and
+                next(iter(self.stored_urls), None) is not None):
+            self._rebuild_url_index()
+
+        self.parse_cache = ParseCache(self.parse_cache_size)
 
         # Generate a maps which provide for each url a list of pages
         # that point to said url.
@@ -233,6 +272,11 @@ class Mirror(object):
 
         return shelve.open(path.join(track_dir, filename), flag=flag)
 
+    def open_index(self, filename):
+        """Open a :class:`UrlIndex`.
+        """
+        return UrlIndex(path.join(self.directory, '.track', filename))
+
     def add(self, link, response):
         """Store the given page.
         """
@@ -245,9 +289,23 @@ class Mirror(object):
         # possibly allow code injection
         assert not rel_filename.startswith('.track/')
 
+        # Whatever we knew about the old file
+        self.parse_cache.discard(rel_filename)
+
+        self._record_url(link, response, rel_filename)
+
+        # See if we should apply modifications now (as opposed to waiting
+        # until the last response has been added). The document itself
+        # we convert while we have it parsed anyway, before writing it.
+        content = response.content
+        if self.write_at_once and self.convert_links and response.parsed:
+            converter = LinkConverter(
+                self.encountered_urls, self.redirects, self.url_usage)
+            content = converter.convert_parsed(response.parsed, rel_filename)
+
         # Store the file
         with self.open(rel_filename, 'wb') as f:
-            f.write(response.content)
+            f.write(content)
 
         # We also add a copy that will not be affected by any link
         # converting for debugging purposes. It'll allow us to validate
@@ -256,14 +314,37 @@ class Mirror(object):
             with self.open(path.join('.backups', rel_filename), 'wb') as f:
                 f.write(response.content)
 
-        # Add to database: data about the url
+        # Make sure database is saved
+        self.flush()
+
+        if self.write_at_once:
+            self._convert_links(link.url, itself=False)
+            self._create_index()
+
+    def _record_url(self, link, response, location):
+        """Add the url of ``link`` to the databases, as stored at
+        ``location``, usually the filename.
+        """
+        # Add to database: data about the url. Also keep track of how
+        # often it changes, which helps to plan updates.
+        now = datetime.datetime.utcnow()
+        previous = self.url_info.get(link.url) or {}
+        content_hash = hashlib.md5(response.content).hexdigest()
+        changed = previous.get('hash') not in (None, content_hash)
         url_info = {
             'original_url': link.original_url,
             'mimetype': get_content_type(response),
+            'sniffed_type': getattr(response, 'sniffed_type', None),
             'etag': response.headers.get('etag'),
             'encoding': response.encoding,
             'last-modified': response.headers.get('last-modified'),
             'expires': parse_http_date_header(response.headers.get('expires')),
+            'fetched': now,
+            'checked': now,
+            'since': previous.get('since', now),
+            'checks': previous.get('checks', 0) + 1,
+            'changes': previous.get('changes', 0) + changed,
+            'hash': content_hash,
             'links': []
         }
         for url, info in itertools.chain(
@@ -275,29 +356,30 @@ class Mirror(object):
                 pass
         self.url_info[link.url] = url_info
         # The url itself
-        self.encountered_urls[link.url] = rel_filename
+        self.encountered_urls[link.url] = location
         self.stored_urls.setdefault(link.url, set())
-        self.stored_urls[link.url] |= {rel_filename}
+        self.stored_urls[link.url] |= {location}
+        self._url_changed(link.url)
         # Be sure to to update the reverse cache
         self._insert_into_url_usage(link.url, url_info['links'])
-        # Make sure database is saved
-        self.flush()
-
-        # See if we should apply modifications now (as opposed to waiting
-        # until the last response has been added).
-        if self.write_at_once:
-            self._convert_links(link.url)
-            self._create_index()
 
-    def encounter_url(self, link):
+    def encounter_url(self, link, revalidated=False):
         """Add a url to the list of encountered urls.
 
         This is like add(), except it doesn't actually save anything. It
         will protect this url from being deleted by
         :meth:`delete_unencountered`.
+
+        If ``revalidated`` is set, the server just confirmed that our
+        copy is still current.
         """
         url = link.url
         assert url in self.stored_urls
+        if revalidated:
+            url_info = self.url_info[url]
+            url_info['checked'] = datetime.datetime.utcnow()
+            url_info['checks'] = url_info.get('checks', 0) + 1
+            self.url_info[url] = url_info
         # When storing the same url using a different mirror layout without
         # using delete_unregistred() to get rid of the old one, it is
         # possible to end up with a single url being stored multiple times.
@@ -311,25 +393,64 @@ class Mirror(object):
         # the 304 status response may suffice.
         self.encountered_urls[url] = list(self.stored_urls[url])[0]
 
-    def add_redirect(self, link, target_link, code):
+    def add_redirect(self, link, target_link, code, response=None):
         """Register a redirect.
 
         Will make sure that any links pointing to ``url`` can be rewritten
-        to the file behind ``target_url``.
+        to the file behind ``target_url``. ``response`` is the redirect
+        itself, if there was one.
         """
-        self.redirects[link.url] = (code, target_link.url)
+        self.redirects[link.url] = \
+            (code, target_link.url, target_link.original_url)
         self.flush()
 
-    def finish(self):
-        self._convert_links()
+    def finish(self, events=None):
+        self._convert_links(events=events)
         self._create_index()
         self.flush()
 
+    def _index_entry(self, url):
+        """Return the :class:`IndexEntry` of ``url``, or ``None`` if
+        it is not stored.
+        """
+        filenames = self.stored_urls.get(url)
+        if not filenames:
+            return None
+        filename = self.encountered_urls.get(url) or sorted(filenames)[0]
+        url_info = self.url_info.get(url) or {}
+        return IndexEntry(url, filename, url_info.get('mimetype'),
+                          url_info.get('etag'), None)
+
+    def _url_changed(self, url):
+        if not self._index_changes:
+            self.info['index_stale'] = True
+        self._index_changes.add(url)
+
+    def _update_url_index(self):
+        """Merge the changed urls into the index.
+        """
+        if not self._index_changes:
+            return
+        self.url_index.update({
+            url: self._index_entry(url) for url in self._index_changes})
+        self._index_changes = set()
+        self.info['index_stale'] = False
+
+    def _rebuild_url_index(self):
+        self.url_index.rebuild(
+            entry for entry in map(self._index_entry, self.stored_urls)
+            if entry)
+        self._index_changes = set()
+        self.info['index_stale'] = False
+
     def flush(self):
         """Write the internal mirror data structures to disk.
         """
         self.stored_urls.sync()
         self.url_info.sync()
+        self.redirects.sync()
+        self.robots.sync()
+        self.frontier.sync()
         self.info.sync()
 
     def _insert_into_url_usage(self, url, links):
@@ -340,15 +461,20 @@ class Mirror(object):
     def _create_index(self):
         """Create an index file of all pages in the mirror.
         """
+        self._update_url_index()
         result = ''
-        for url, filenames in self.stored_urls.items():
-            result += '<a href="{0}">{0}</a><br>'.format(list(filenames)[0])
+        for entry in self.url_index:
+            result += '<a href="{0}">{0}</a><br>'.format(entry.filename)
         with self.open('index.html', 'w') as f:
             f.write(result)
 
-    def _convert_links(self, for_url=None):
+    def _convert_links(self, for_url=None, events=None, itself=True):
         """Convert links in all downloaded files, or all files
-        that are known to link to ``for_url``.
+        that are known to link to ``for_url``, and unless ``itself``
+        is false, the file of ``for_url``.
+
+        Progress of converting all files is reported to ``events``, see
+        :meth:`Events.links_converted`.
         """
         if not self.convert_links:
             return
@@ -380,83 +506,102 @@ class Mirror(object):
         url_database = self.encountered_urls
 
         if not for_url:
-            files_to_process = url_database.items()
-        else:
-            files_to_process = itertools.chain(
-                # The url itself
-                ((for_url, url_database[for_url]),),
-                # All files pointing to the url
-                [(u, url_database[u])
-                 for u in self.url_usage.get(for_url, [])
-                 if u in url_database])
+            self._convert_all_links(url_database, events)
+            return
+
+        files_to_process = itertools.chain(
+            # The url itself
+            ((for_url, url_database[for_url]),) if itself else (),
+            # All files pointing to the url
+            [(u, url_database[u])
+             for u in self.url_usage.get(for_url, [])
+             if u in url_database])
+        converter = LinkConverter(url_database, self.redirects, self.url_usage)
         for url, filename in files_to_process:
-            self._convert_links_in_file(filename, url, url_database)
+            self._convert_links_in_file(filename, url, converter)
 
-    def _convert_links_in_file(self, file, url, url_database):
-        mimetype = self.url_info[url]['mimetype']
-        parser_class = get_parser_for_mimetype(mimetype)
+    def _convert_links_in_file(self, file, url, converter):
+        url_info = self.url_info[url]
+        parser_class = self.get_parser_class(url_info)
         if not parser_class:
             return
 
+        # Pages linked from everywhere are converted again and again,
+        # so keep some of the parsed documents around.
+        parsed = self.parse_cache.get(file, self.file_stamp(file))
         with self.open(file, 'rb+') as f:
-            # A simple way to speed this up would also be to keep a
-            # certain contingent of previously-parsed documents in memory.
-            parsed = parser_class(
-                f.read(),
-                self.url_info[url].get('original_url', url),
-                encoding=self.url_info[url].get('encoding'))
-
-            def replace_link(raw_url):
-                # Abuse the URL class to normalize the url for matching
-                try:
-                    link = Link(raw_url)
-                except urlnorm.InvalidUrl:
-                    return
-
-                # See what we know about this link. Is the target url
-                # saved locally? Is it a known redirect?
-                local_filename = redir_url = redir_code = None
-                if link.url in url_database:
-                    local_filename = url_database[link.url]
-                else:
-                    if link.url in self.redirects:
-                        redir_code, redir_url = self.redirects[link.url]
-                        if redir_url in url_database:
-                            local_filename = url_database[redir_url]
-
-                # We have the document behind this link available locally
-                if local_filename:
-                    rel_link = path.relpath(local_filename, path.dirname(file))
-                    if link.lossy_url_data.get('fragment'):
-                        rel_link += '#' + link.lossy_url_data['fragment']
-                    return './{0}'.format(rel_link)
-
-                # It is a permanent redirect, use the redirect target
-                elif redir_url and redir_code == 301:
-                    return redir_url
-
-                else:
-                    # We do not have a local copy. We need the make sure
-                    # we set an absolute url with a host part instead.
-                    #
-                    # We mustn't do this however for links that have
-                    # already previously been replaced with a local
-                    # link. We can find out if that is the case by
-                    # checking our url usage database. If the url is not
-                    # in it, then it must we one of ours.
-                    # TODO: Not sure if this is fool-proof, or if we could
-                    # in theory imagine a server-side link constructed in
-                    # such a way that a match would occur here.
-                    if link.url in self.url_usage:
-                        # The url has already been absolutized by the
-                        # parser,  we can simply set it.
-                        return raw_url
-            new_content = parsed.replace_urls(replace_link)
+            if parsed is None:
+                parsed = parser_class(
+                    f.read(), url_info.get('original_url', url),
+                    encoding=url_info.get('encoding'))
+            new_content = converter.convert_parsed(parsed, file)
 
             # Write new file
             f.seek(0)
             f.write(new_content)
             f.truncate()
+        self.parse_cache.put(file, self.file_stamp(file), parsed)
+
+    def get_parser_class(self, url_info):
+        """Return the parser for a file, described by ``url_info``.
+        """
+        return get_parser_for_mimetype(
+            url_info.get('sniffed_type') or url_info['mimetype'],
+            self.max_parse_cost)
+
+    def file_stamp(self, filename):
+        """Return something that changes when the file changes, or
+        ``None`` if we cannot tell.
+        """
+        try:
+            stat = os.stat(path.join(self.directory, filename))
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _convert_all_links(self, url_database, events=None):
+        """Convert the links in all files in ``url_database``, which
+        for a large mirror takes a while; with :attr:`convert_workers`
+        set, it is shared between processes.
+        """
+        files = [(url, filename) for url, filename in url_database.items()
+                 if self.get_parser_class(self.url_info[url])]
+        batch_size = self.convert_batch_size
+
+        def report(num_done):
+            if events:
+                events.links_converted(num_done, len(files))
+
+        if self.convert_workers < 2 or len(files) <= batch_size:
+            converter = LinkConverter(
+                url_database, self.redirects, self.url_usage)
+            for num_done, (url, filename) in enumerate(files, 1):
+                self._convert_links_in_file(filename, url, converter)
+                if num_done % batch_size == 0 or num_done == len(files):
+                    report(num_done)
+            return
+
+        # The workers get a copy of what they need to know of the
+        # mirror once, rather than with each batch.
+        converter = LinkConverter(
+            dict(url_database), dict(self.redirects), frozenset(self.url_usage))
+        tasks = []
+        for url, filename in files:
+            url_info = self.url_info[url]
+            tasks.append((filename, url_info.get('original_url', url),
+                          url_info.get('sniffed_type') or url_info['mimetype'],
+                          url_info.get('encoding')))
+        with ProcessPoolExecutor(
+                self.convert_workers, initializer=_init_converter,
+                initargs=(converter,)) as executor:
+            futures = [
+                executor.submit(_convert_files, self.directory,
+                                tasks[i:i+batch_size])
+                for i in range(0, len(tasks), batch_size)]
+            num_done = 0
+            for future in as_completed(futures):
+                num_done += future.result()
+                report(num_done)
 
     def delete_unencountered(self):
         """This will delete all files in the mirror that have not
@@ -466,7 +611,11 @@ class Mirror(object):
         opened that already has urls in it, they will all be deleted
         unless :meth:`add` has been called for them.
         """
-        for url in self.stored_urls:
+        # Going through the index, rather than the database we change
+        # on the way, also does not unpickle every entry.
+        self._update_url_index()
+        for entry in self.url_index:
+            url = entry.url
             files_to_delete = []
 
             if not url in self.encountered_urls:
@@ -474,6 +623,7 @@ class Mirror(object):
                 files_to_delete = self.stored_urls[url]
                 del self.stored_urls[url]
                 del self.url_info[url]
+                self._url_changed(url)
 
             elif self.stored_urls[url] != self.encountered_urls.get(url):
                 # The local save path of the url has changed. Remove all
@@ -481,12 +631,14 @@ class Mirror(object):
                 files_to_delete = self.stored_urls[url] - {self.encountered_urls[url]}
                 # Update the stored
                 self.stored_urls[url] = {self.encountered_urls[url]}
+                self._url_changed(url)
 
             for name in files_to_delete:
                 print('deleting', name)
                 filename = path.join(self.directory, name)
                 os.unlink(filename)
                 clear_directory_structure(filename)
+        self._update_url_index()
 
         # Regenerate url link cache
         self.url_usage = {}
@@ -494,6 +646,180 @@ class Mirror(object):
             self._insert_into_url_usage(url, data['links'])
 
 
+class ParseCache(object):
+    """Keeps the most recently used parsed documents, as long as they
+    take no more than ``max_size`` bytes together.
+
+    An entry is valid for a certain *stamp* of the file, such as its
+    modification time and size; it is not used once the file changes.
+    How often the cache helped is counted in :attr:`stats`.
+    """
+
+    # Memory taken by a parsed document besides its data, per element;
+    # a rough estimate.
+    element_overhead = 400
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        # filename -> (stamp, parser, size), least recently used first
+        self._entries = OrderedDict()
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, filename, stamp):
+        """Return the parser for ``filename`` if we have it for
+        ``stamp``, or ``None``.
+        """
+        entry = self._entries.get(filename)
+        if entry is None or stamp is None or entry[0] != stamp:
+            self.stats['misses'] += 1
+            return None
+        self._entries.move_to_end(filename)
+        self.stats['hits'] += 1
+        return entry[1]
+
+    def put(self, filename, stamp, parser):
+        self.discard(filename)
+        if stamp is None:
+            return
+        # The data, and the slices of it the elements hold
+        size = 2 * len(parser.data) + \
+            self.element_overhead * len(parser._get_elements())
+        if size > self.max_size:
+            return
+        self._entries[filename] = (stamp, parser, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+            self.stats['evictions'] += 1
+
+    def discard(self, filename):
+        entry = self._entries.pop(filename, None)
+        if entry:
+            self.size -= entry[2]
+
+
+class LinkConverter(object):
+    """Replaces the urls in a file with links to the local copies of
+    the urls. Knows only as much of the mirror as it needs to, so it
+    can be sent to another process:
+
+    ``url_database``
+        maps the urls in the mirror to their files.
+    ``redirects``
+        the redirects the mirror knows about.
+    ``used_urls``
+        all urls linked to by the files in the mirror; supports ``in``.
+    """
+
+    def __init__(self, url_database, redirects, used_urls):
+        self.url_database = url_database
+        self.redirects = redirects
+        self.used_urls = used_urls
+
+    def convert(self, data, file, base_url, mimetype, encoding=None):
+        """Return ``data``, the content of ``file`` in the mirror, with
+        the urls replaced.
+        """
+        parser_class = get_parser_for_mimetype(mimetype)
+        return self.convert_parsed(
+            parser_class(data, base_url, encoding=encoding), file)
+
+    def convert_parsed(self, parsed, file):
+        """Like :meth:`convert`, for a document that has been parsed
+        already, see :class:`track.parser.Parser`.
+        """
+        # Strings that merely look like urls (see the ``heuristic`` option)
+        # may be nothing of the kind; they are only pointed at a local
+        # copy, never made absolute.
+        guessed = set()
+        certain = set()
+        for url, opts in parsed:
+            (guessed if opts.get('heuristic') else certain).add(url)
+        guessed -= certain
+
+        def replacer(url):
+            return self.replace_link(file, url, local_only=url in guessed)
+        return parsed.replace_urls(replacer)
+
+    def replace_link(self, file, raw_url, local_only=False):
+        """Return what to replace ``raw_url`` with in ``file``, or
+        ``None`` to leave it alone. With ``local_only``, only a link to
+        a local copy replaces it.
+        """
+        # Abuse the URL class to normalize the url for matching
+        try:
+            link = Link(raw_url)
+        except urlnorm.InvalidUrl:
+            return
+
+        # See what we know about this link. Is the target url
+        # saved locally? Is it a known redirect?
+        local_filename = redir_url = redir_code = None
+        if link.url in self.url_database:
+            local_filename = self.url_database[link.url]
+        else:
+            if link.url in self.redirects:
+                redir_code, redir_url, _ = self.redirects[link.url]
+                if redir_url in self.url_database:
+                    local_filename = self.url_database[redir_url]
+
+        # We have the document behind this link available locally
+        if local_filename:
+            rel_link = path.relpath(local_filename, path.dirname(file))
+            if link.lossy_url_data.get('fragment'):
+                rel_link += '#' + link.lossy_url_data['fragment']
+            return './{0}'.format(rel_link)
+
+        elif local_only:
+            return None
+
+        # It is a permanent redirect, use the redirect target
+        elif redir_url and redir_code == 301:
+            return redir_url
+
+        else:
+            # We do not have a local copy. We need the make sure
+            # we set an absolute url with a host part instead.
+            #
+            # We mustn't do this however for links that have
+            # already previously been replaced with a local
+            # link. We can find out if that is the case by
+            # checking our url usage database. If the url is not
+            # in it, then it must we one of ours.
+            # TODO: Not sure if this is fool-proof, or if we could
+            # in theory imagine a server-side link constructed in
+            # such a way that a match would occur here.
+            if link.url in self.used_urls:
+                # The url has already been absolutized by the
+                # parser,  we can simply set it.
+                return raw_url
+
+
+# The converter of a worker process, see Mirror._convert_all_links()
+_converter = None
+
+
+def _init_converter(converter):
+    global _converter
+    _converter = converter
+
+
+def _convert_files(directory, files):
+    for filename, base_url, mimetype, encoding in files:
+        with open(path.join(directory, filename), 'rb+') as f:
+            new_content = _converter.convert(
+                f.read(), filename, base_url, mimetype, encoding)
+            f.seek(0)
+            f.write(new_content)
+            f.truncate()
+    return len(files)
+
+
 def clear_directory_structure(filename):
     """Delete an empty directory structure from where the place
     where ``filename`` used to be located.
@@ -5,12 +5,16 @@ used during the "convert links" stage, so they cannot rely on knowledge
 of the spidering process.
 """
 
+from collections import OrderedDict
+import codecs
 import contextlib
 import html.parser
+import json
 import re
 import string
-from urllib.parse import urljoin
-from html5lib.inputstream import HTMLBinaryInputStream
+from urllib.parse import urlparse
+import charade
+from track.utils import cached_urljoin as urljoin
 
 
 class Parser(object):
@@ -57,11 +61,26 @@ class Parser(object):
     encoding.
     """
 
+    # The mimetypes this parser handles, the first being the proper one;
+    # see :class:`ParserRegistry`.
+    mimetypes = ()
+    # Roughly, how much time it takes per byte; 1 is cheap, 3 expensive.
+    # A crawl can refuse to spend more on parsing.
+    cost = 1
+
     def __init__(self, data, url, encoding=None):
         self.data = data
         self.base_url = url
         self.encoding = encoding
 
+    @classmethod
+    def sniff(cls, head):
+        """Return ``True`` if ``head``, the start of a document of an
+        unknown or generic type, as text, looks like a document this
+        parser handles.
+        """
+        return False
+
     def absurl(self, url):
         return urljoin(self.base_url, url)
 
@@ -80,9 +99,38 @@ class Parser(object):
             return self.as_bytes(data)
         return self.as_text(data)
 
+    # The absolute urls with their options, once they are known; maybe
+    # because they have been found in another process.
+    found_urls = None
+    # The elements of the document, once parsed
+    _elements = None
+
     def __iter__(self):
-        for url, opts in self.get_urls():
-            yield self.absurl(url), opts
+        if self.found_urls is None:
+            self.found_urls = [
+                (self.absurl(url), opts) for url, opts in self.get_urls()]
+        return iter(self.found_urls)
+
+    def _get_elements(self):
+        """Parse the document once, no matter how often we need to
+        look at it.
+
+        Replacing a url does not change an element's ``data``, but sets
+        its ``replacement``; so every :meth:`replace_urls` starts from
+        the original document.
+        """
+        if self._elements is None:
+            self._elements = list(self._parse())
+        return self._elements
+
+    def _join_elements(self, elements):
+        return ''.join([el.get('replacement', el['data']) for el in elements])
+
+    def discard_elements(self):
+        """Free the memory taken by the parsed document; the urls
+        are kept.
+        """
+        self._elements = None
 
     def get_urls(self):
         raise NotImplementedError()
@@ -189,6 +237,80 @@ class ParserKit:
 entity_unescape = html.parser.HTMLParser().unescape
 
 
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+)
+
+# <meta charset="..."> and <meta http-equiv="Content-Type"
+# content="text/html; charset=...">
+META_CHARSET = re.compile(
+    br'''<meta[^>]*?charset\s*=\s*["']?\s*([a-z0-9_:.-]+)''', re.IGNORECASE)
+
+# How much of a document to look at for a declared encoding, and for
+# guessing it
+META_SCAN_SIZE = 1024
+GUESS_SAMPLE_SIZE = 16 * 1024
+
+# Guessed encodings, by host and first path segment; pages made from
+# the same template tend to share their encoding.
+_guessed_encodings = OrderedDict()
+MAX_GUESSED_ENCODINGS = 1000
+
+
+def declared_encoding(data):
+    """Return the encoding the HTML document ``data`` declares with a
+    byte order mark, or in its first ``META_SCAN_SIZE`` bytes, or
+    ``None``.
+    """
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+
+    match = META_CHARSET.search(data, 0, META_SCAN_SIZE)
+    if match:
+        try:
+            encoding = codecs.lookup(match.group(1).decode('ascii')).name
+        except LookupError:
+            pass
+        else:
+            # A document that can declare it, is not in UTF-16 (the spec)
+            return 'utf-8' if encoding.startswith('utf-16') else encoding
+    return None
+
+
+def detect_encoding(data, url=None):
+    """Return the encoding of the HTML document ``data``, or ``None``.
+
+    The byte order mark decides, then an encoding declared in the first
+    bytes. Only if there is neither, we guess from a sample, which is
+    slow; guesses are remembered for other documents from the same part
+    of the same site as ``url``.
+    """
+    encoding = declared_encoding(data)
+    if encoding:
+        return encoding
+
+    key = None
+    if url:
+        parsed = urlparse(url)
+        key = parsed.netloc, parsed.path.lstrip('/').partition('/')[0]
+        if key in _guessed_encodings:
+            _guessed_encodings.move_to_end(key)
+            return _guessed_encodings[key]
+
+    encoding = charade.detect(data[:GUESS_SAMPLE_SIZE])['encoding']
+    if encoding == 'ascii':
+        # Anything beyond the sample is likelier to be UTF-8
+        encoding = None
+    if key:
+        _guessed_encodings[key] = encoding
+        if len(_guessed_encodings) > MAX_GUESSED_ENCODINGS:
+            _guessed_encodings.popitem(last=False)
+    return encoding
+
+
 class HTMLTokenizer(Parser):
     """With a heavy heart, I'm implementing a very simple HTML scanner
     myself. The problem with all existing HTML parsers is that they cannot
@@ -223,23 +345,9 @@ class HTMLTokenizer(Parser):
         # If no transport-level encoding as specified, try to find one
         # within the HTML, or fall back to utf-8 as default.
         if isinstance(data, bytes) and not encoding:
-            encoding = self._detect_encoding(data) or 'utf-8'
+            encoding = detect_encoding(data, url) or 'utf-8'
         Parser.__init__(self, data, url, encoding)
 
-    def _detect_encoding(self, data):
-        # Use a simple way to detect the encoding beforehand. This will
-        # try chardet and the BOM, but also scan some initial bytes for
-        # a metatag.
-        #
-        # There seems to a spec'ed way to do a "changeEncoding" thing
-        # during the parsing, and the html stream class has a
-        # changeEncoding() method (called by the parser when a meta
-        # encoding info is encountered). We  might want to use it.
-        stream = HTMLBinaryInputStream(data)
-        stream.defaultEncoding = ''
-        encoding, certainty = stream.detectEncoding()
-        return encoding
-
     def _parse(self):
         p = ParserKit(self.as_text(self.data))
 
@@ -302,7 +410,7 @@ class HTMLTokenizer(Parser):
                             p.skip_whitespace()
                             yield p.switch_element()
                             # http://dev.w3.org/html5/spec-LC/tokenization.html#before-attribute-value-state
-                            if cur() in '\'"':
+                            if cur() and cur() in '\'"':
                                 # http://dev.w3.org/html5/spec-LC/tokenization.html#attribute-value-double-quoted-state
                                 # http://dev.w3.org/html5/spec-LC/tokenization.html#attribute-value-single-quoted-state
                                 quote_char = next()
@@ -358,7 +466,7 @@ class HTMLTokenizer(Parser):
                         while cur():
                             # http://dev.w3.org/html5/spec-LC/tokenization.html#rawtext-end-tag-name-state
                             if match('</{}'.format(tag_name)):
-                                if cur() in ('\t\r\n />='):
+                                if cur() is None or cur() in ('\t\r\n />='):
                                     break
                             next()
                             last_pos_before_match = p.pos
@@ -381,11 +489,21 @@ class HTMLParser(HTMLTokenizer):
     """We've simply split the low-level parsing into the base class.
     """
 
+    mimetypes = ('text/html', 'application/xhtml+xml')
+    cost = 2
+    _sniff = re.compile(
+        r'^\s*(?:<!--.*?-->\s*|<\?xml[^>]*>\s*)*'
+        r'<(?:!doctype\s+html|html|head|body)\b', re.IGNORECASE | re.DOTALL)
+
+    @classmethod
+    def sniff(cls, head):
+        return bool(cls._sniff.match(head))
+
     # An argument can possibly be made that this should be defined
     # by the spider instead?
     tags = {
         'a': {'attr': ['href']},
-        'img': {'attr': ['href', 'src', 'lowsrc'], 'inline': True},
+        'img': {'attr': ['href', 'src', 'lowsrc', 'data-src'], 'inline': True},
         'script': {'attr': ['src'], 'inline': True},
         'link': {},
 
@@ -397,7 +515,7 @@ class HTMLParser(HTMLTokenizer):
         'fig': {'attr': ['src'], 'inline': True},
         'frame': {'attr': ['src'], 'inline': True},
         'form': {},
-        'iframe': {'attr': ['src'], 'inline': True},
+        'iframe': {'attr': ['src', 'data-src'], 'inline': True},
         'input': {'attr': ['src'], 'inline': True},
         'layer': {'attr': ['src'], 'inline': True},
         'meta': {},
@@ -407,12 +525,28 @@ class HTMLParser(HTMLTokenizer):
         'table': {'attr': ['background'], 'inline': True},
         'td': {'attr': ['background'], 'inline': True},
         'th': {'attr': ['background'], 'inline': True},
+
+        # <picture> has <source srcset>, <video> and <audio> <source src>
+        'source': {'attr': ['src', 'data-src'], 'inline': True},
+        'video': {'attr': ['src', 'poster', 'data-src'], 'inline': True},
+        'audio': {'attr': ['src'], 'inline': True},
+        'track': {'attr': ['src'], 'inline': True},
     }
 
+    # Attributes with a list of image candidates, each a url followed
+    # by a descriptor; see :class:`SrcsetParser`. "imagesrcset" is
+    # for <link rel="preload">, "data-srcset" for lazy loading.
+    srcset_attrs = ('srcset', 'data-srcset', 'imagesrcset')
+
+    # The urls of the document, with a setter for each
+    _url_setters = None
+
     def replace_urls(self, replacer):
-        elements = list(self._parse())
+        elements = self._get_elements()
+        for element in elements:
+            element.pop('replacement', None)
 
-        for url, kwargs, setter in self._iter_urls(elements):
+        for url, kwargs, setter in self._get_url_setters():
             if isinstance(url, Parser):
                 parser = url
                 setter(parser.replace_urls(replacer, **kwargs))
@@ -421,12 +555,11 @@ class HTMLParser(HTMLTokenizer):
                 if new_url:
                     setter(new_url)
 
-        new_data = ''.join([el['data'] for el in elements])
+        new_data = self._join_elements(elements)
         return self.same_as_input(new_data)
 
     def get_urls(self):
-        elements = self._parse()
-        for url, opts, _ in self._iter_urls(elements):
+        for url, opts, _ in self._get_url_setters():
             if isinstance(url, Parser):
                 parser = url
                 for nested_url, opts in parser:
@@ -434,17 +567,30 @@ class HTMLParser(HTMLTokenizer):
             else:
                 yield self.absurl(url), opts
 
-    def _iter_urls(self, elements):
-        """Find the urls within the token stream.
+    def discard_elements(self):
+        Parser.discard_elements(self)
+        self._url_setters = None
+
+    def _get_url_setters(self):
+        if self._url_setters is None:
+            self._url_setters = list(self._iter_urls(self._get_elements()))
+        return self._url_setters
+
+    @staticmethod
+    def _find_base(elements):
+        for e in elements:
+            if e['type'] == 'attr-value' and e['attr_name'] == 'href' and e['tag_name'] == 'base':
+                return e['value']
+        return None
+
+    def _iter_urls(self, elements, doc_base_url=None):
+        """Find the urls within the token stream. ``doc_base_url`` is
+        used if there is no <base> tag among the elements.
         """
         elements = list(elements)
 
         # Search for the base tag first
-        doc_base_url = None
-        for e in elements:
-            if e['type'] == 'attr-value' and e['attr_name'] == 'href' and e['tag_name'] == 'base':
-                doc_base_url = e['value']
-                break
+        doc_base_url = self._find_base(elements) or doc_base_url
 
         for element in elements:
             # See if this is an attribute we need to process
@@ -459,6 +605,14 @@ class HTMLParser(HTMLTokenizer):
                           {'escape': 'single'}, \
                           self._mk_attr_setter(element)
 
+                # Same for a list of image urls
+                if attr in self.srcset_attrs and value:
+                    yield SrcsetParser(
+                            value, url=urljoin(self.base_url, doc_base_url),
+                            tag='{0}.{1}'.format(tag, attr)), \
+                          {}, \
+                          self._mk_attr_setter(element)
+
                 # See if this is in the list of attributes
                 if not tag in self.tags:
                     continue
@@ -524,7 +678,7 @@ class HTMLParser(HTMLTokenizer):
             elif quote == 'double':
                 new_value = new_value.replace('"', '&quot;')
 
-            element['data'] = fmt.format(new_value)
+            element['replacement'] = fmt.format(new_value)
         return setter
 
     def _handle_text_style(self, text):
@@ -604,11 +758,156 @@ class HTMLParser(HTMLTokenizer):
         """Check if this rel identifier refers to a link that should
         be treated as inline. Note that a rel may have multiple values.
         """
-        rel = list(map(lambda s: s.strip(), rel.split(' ')))
-        ident = set(('stylesheet', 'icon', 'apple-touch-icon'))
+        rel = list(map(lambda s: s.strip(), rel.lower().split(' ')))
+        ident = set(('stylesheet', 'icon', 'apple-touch-icon', 'preload',
+                     'modulepreload'))
         return bool(set(rel) & ident)
 
 
+class HTMLLinkStream(object):
+    """Finds the urls of an HTML document while it is coming in.
+
+    :meth:`feed` it the bytes as they arrive; it returns the urls of
+    the tags completed so far, like iterating over a
+    :class:`HTMLParser` would. A tag split between two chunks is
+    found once the second one arrives. Call :meth:`close` at the end.
+
+    Only the part of the document after the last complete tag is
+    kept as text, up to ``max_pending`` characters; a longer stretch
+    without a tag boundary (an endless comment, say) is tokenized as
+    it is. A <base> tag applies to the urls that come after it.
+
+    Unless a transport encoding is given, it is decided just as
+    :func:`detect_encoding` would for the whole document, and given to
+    the final :class:`HTMLParser`; so the two cannot disagree. Until
+    there is enough of the document for that, nothing is tokenized.
+    """
+
+    max_pending = 1024 * 1024
+
+    def __init__(self, url, encoding=None):
+        self.url = url
+        self.encoding = encoding
+        self.urls = []
+        self._decoder = None
+        self._head = b''
+        self._pending = ''
+        # Don't tokenize the pending text again before it is this long
+        self._rescan_at = 0
+        self._base_url = None
+        # What we know of the document so far, so it need not be
+        # parsed again; see :meth:`parser`.
+        self._elements = []
+        self._url_setters = []
+
+    def feed(self, data):
+        if self._decoder is None:
+            self._head += data
+            if not self._start():
+                return []
+            data, self._head = self._head, b''
+        self._pending += self._decoder.decode(data)
+        return self._scan()
+
+    def close(self):
+        """Signal the end of the document, returns the last urls.
+        """
+        if self._decoder is None:
+            self._start(final=True)
+            data, self._head = self._head, b''
+        else:
+            data = b''
+        self._pending += self._decoder.decode(data, final=True)
+        return self._scan(final=True)
+
+    def parser(self, data):
+        """Return a :class:`HTMLParser` for the complete document
+        ``data``, which does not need to parse it again.
+        """
+        parser = HTMLParser(data, self.url, encoding=self.encoding)
+        parser._elements = self._elements
+        parser._url_setters = self._url_setters
+        parser.found_urls = self.urls
+        return parser
+
+    def _start(self, final=False):
+        """Set up the decoder, once the encoding can be decided;
+        returns ``False`` while it cannot.
+        """
+        head = self._head
+        if not self.encoding:
+            # Both only look at the start of the document
+            if len(head) < META_SCAN_SIZE and not final:
+                return False
+            encoding = declared_encoding(head)
+            if not encoding:
+                if len(head) < GUESS_SAMPLE_SIZE and not final:
+                    return False
+                encoding = detect_encoding(head, self.url) or 'utf-8'
+            self.encoding = encoding
+        try:
+            decoder_class = codecs.getincrementaldecoder(self.encoding)
+        except LookupError:
+            self.encoding = 'utf-8'
+            decoder_class = codecs.getincrementaldecoder(self.encoding)
+        self._decoder = decoder_class('replace')
+        return True
+
+    def _scan(self, final=False):
+        pending = self._pending
+        if not final and len(pending) < self._rescan_at:
+            return []
+
+        tokenizer = HTMLParser(pending, self.url, encoding=self.encoding)
+        elements = list(tokenizer._parse())
+        if final or len(pending) > self.max_pending:
+            num_complete = len(elements)
+        else:
+            num_complete = self._count_complete(elements, pending)
+            if not num_complete:
+                self._rescan_at = 2 * len(pending)
+                return []
+        self._rescan_at = 0
+        elements = elements[:num_complete]
+        end = elements[-1]['pos'] + len(elements[-1]['data'])
+        self._pending = pending[end:]
+
+        found = []
+        for url, opts, setter in tokenizer._iter_urls(
+                elements, self._base_url):
+            self._url_setters.append((url, opts, setter))
+            if isinstance(url, Parser):
+                found.extend(
+                    (tokenizer.absurl(nested_url), nested_opts)
+                    for nested_url, nested_opts in url)
+            else:
+                found.append((tokenizer.absurl(url), opts))
+        self._base_url = tokenizer._find_base(elements) or self._base_url
+        self._elements.extend(elements)
+        self.urls.extend(found)
+        return found
+
+    @staticmethod
+    def _count_complete(elements, text):
+        """Return the number of elements up to the last point at which
+        the tokenizer is done with a tag; it can start over from there.
+        """
+        num_complete = 0
+        for i, element in enumerate(elements):
+            end = element['pos'] + len(element['data'])
+            if element['type'] == 'tag-open-end':
+                if element['name'] not in ('style', 'script') and \
+                        element['data'].endswith('>'):
+                    num_complete = i + 1
+            elif element['type'] == 'tag-rawtext':
+                # Only if we have seen the closing tag
+                closing = '</' + element['name']
+                if text.startswith(closing, end) and \
+                        text[end+len(closing):][:1] in tuple('\t\r\n />='):
+                    num_complete = i + 1
+        return num_complete
+
+
 class CSSParser(Parser):
     """
     CSS charset detection should be:
@@ -621,91 +920,545 @@ class CSSParser(Parser):
     This currently doesn't do (2) or (3).
     """
 
+    mimetypes = ('text/css',)
+
     def replace_urls(self, replacer, escape='double'):
-        elements = list(self._parse())
+        elements = self._get_elements()
 
         for element in elements:
+            element.pop('replacement', None)
             if element['type'] == 'url':
                 new_url = replacer(self.absurl(element['url']))
                 if new_url:
                     if escape == 'single':
-                        element['data'] = "'{0}'".format(new_url.replace("'", "\\'"))
+                        element['replacement'] = "'{0}'".format(new_url.replace("'", "\\'"))
                     elif escape == 'double':
-                        element['data'] = '"{0}"'.format(new_url.replace('"', '\\"'))
+                        element['replacement'] = '"{0}"'.format(new_url.replace('"', '\\"'))
                     else:
-                        element['data'] = '{0}'.format(new_url)
+                        element['replacement'] = '{0}'.format(new_url)
 
-        return self.same_as_input(''.join([el['data'] for el in elements]))
+        return self.same_as_input(self._join_elements(elements))
 
     def get_urls(self):
-        elements = self._parse()
-        for element in elements:
+        for element in self._get_elements():
             if element['type'] == 'url':
                 yield element['url'], {'inline': True}
 
+    # What we are looking for: @import with a string, and url(). Both
+    # might appear within comments, which we skip.
+    _tokens = re.compile(r"""
+        /\*.*?(?:\*/|\Z)              # a comment, maybe unclosed
+      | @import[\t\n\r\ ]*(?=["'])    # @import "url"
+      | url\([\t\n\r\ ]*              # url(url), url("url")
+    """, re.VERBOSE | re.DOTALL)
+    # The url itself, in quotes, or the unquoted form of url(); ends at
+    # a line break. Backslashes escape the character following them.
+    _strings = {
+        '"': re.compile(r'"((?:\\+.?|[^\\"\n\r])*)"?', re.DOTALL),
+        "'": re.compile(r"'((?:\\+.?|[^\\'\n\r])*)'?", re.DOTALL),
+        None: re.compile(r'((?:\\+.?|[^\\)\n\r])*)', re.DOTALL),
+    }
+    _escape = re.compile(r'\\+(.?)', re.DOTALL)
+
     def _parse(self):
-        p = ParserKit(self.as_text(self.data))
+        # Stylesheets can have megabytes, so rather than looking at
+        # each character, let the regular expressions find the urls.
+        text = self.as_text(self.data)
+        # Where the current unknown element started
+        pos = 0
+        scan_from = 0
+        while True:
+            match = self._tokens.search(text, scan_from)
+            if not match:
+                break
+            scan_from = match.end()
+            if match.group().startswith('/*'):
+                continue
 
-        peek = p.peek
-        cur = p.cur
-        match = p.match
-        next = p.next
+            # The url element includes the quotes, for we need to be
+            # able to properly escape a replacement url; a closing
+            # bracket is not included.
+            quote_chr = text[scan_from:scan_from+1]
+            string = self._strings.get(quote_chr, self._strings[None]).match(
+                text, scan_from)
+            yield {'type': 'unknown', 'pos': pos, 'data': text[pos:scan_from]}
+            yield {'type': 'url', 'pos': scan_from, 'data': string.group(),
+                   'url': self._escape.sub(r'\1', string.group(1))}
+            pos = scan_from = string.end()
 
-        while cur():
-            # Skip comments
-            if cur() == '/' and peek() == '*':
-                next(2)
-                while cur() is not None and (cur() != '*' or peek() != '/'):
-                    next(2)
-
-            # @import without url()
-            if match('@import'):
-                p.skip_whitespace()
-                if cur() in '"\'':
-                    # Have the element include the quotes, for we need to
-                    # be able to properly escape a replacement url.
-                    yield p.switch_element()
-                    quote_chr = next()
+        # Complete the final element
+        yield {'type': 'unknown', 'pos': pos, 'data': text[pos:]}
+
+
+class SrcsetParser(Parser):
+    """The value of a ``srcset`` attribute: a comma-separated list of
+    image candidates, each a url, optionally followed by a descriptor
+    like ``2x`` or ``480w``::
+
+        small.jpg 480w, large.jpg 1080w
+
+    ``tag`` names the attribute, e.g. ``img.srcset``.
+    """
+
+    _separator = re.compile(r'[\s,]*')
+    _url = re.compile(r'\S+')
+    # Up to the next comma that is not within brackets
+    _descriptor = re.compile(r'(?:[^,(]|\([^)]*\)?)*')
+
+    def __init__(self, data, url, encoding=None, tag=None):
+        Parser.__init__(self, data, url, encoding)
+        self.tag = tag
+
+    def get_urls(self):
+        for element in self._get_elements():
+            if element['type'] == 'url':
+                yield element['url'], {'inline': True, 'tag': self.tag}
+
+    def replace_urls(self, replacer):
+        elements = self._get_elements()
+        for element in elements:
+            element.pop('replacement', None)
+            if element['type'] == 'url':
+                new_url = replacer(self.absurl(element['url']))
+                if new_url:
+                    # Whitespace and commas would end the url
+                    element['replacement'] = new_url.replace(
+                        ' ', '%20').replace(',', '%2C')
+        return self.same_as_input(self._join_elements(elements))
+
+    def _parse(self):
+        # Following the spec, loosely:
+        #   http://www.w3.org/html/wg/drafts/html/master/embedded-content.html#parse-a-srcset-attribute
+        text = self.as_text(self.data)
+        # Where we are, and where the current unknown element started
+        pos = start = 0
+        while True:
+            pos = self._separator.match(text, pos).end()
+            if pos >= len(text):
+                break
+
+            # A url ends at whitespace; trailing commas are not part
+            # of it, but mean there is no descriptor.
+            candidate = self._url.match(text, pos).group()
+            url = candidate.rstrip(',')
+            if url:
+                yield {'type': 'unknown', 'pos': start, 'data': text[start:pos]}
+                yield {'type': 'url', 'pos': pos, 'data': url, 'url': url}
+                start = pos + len(url)
+            pos += len(candidate)
+            if url == candidate:
+                pos = self._descriptor.match(text, pos).end()
+
+        # Complete the final element
+        yield {'type': 'unknown', 'pos': start, 'data': text[start:]}
+
+
+class JavaScriptParser(Parser):
+    """Finds urls in scripts, without running them, or really parsing
+    them. We look at:
+
+        import "./a.js"; import {b} from "./b.js"; import("./c.js")
+        new URL("d.png", import.meta.url)
+        //# sourceMappingURL=e.js.map
 
-                    # Find the actual url
-                    url = p.skip_until(quote_chr+'\n\r', escape_chr='\\')
+    and at any string literal that looks like a url or the path to a
+    file (``"/img/f.png"``, ``"https://example.org/g"``). The latter is
+    a guess, and flagged as ``heuristic``, so rules can skip these. Urls
+    in strings are often relative to the page running the script, not
+    to the script itself; we can only assume the script.
 
-                    # If there is a closing quote, include it
-                    p.next_if(quote_chr)
-                    yield p.switch_element(type='url', url=url)
+    Strings built at runtime (``"chunk-" + id + ".js"``) are not found.
+    """
+
+    mimetypes = (
+        'application/javascript', 'text/javascript', 'application/x-javascript',
+        'application/ecmascript', 'text/ecmascript')
+    cost = 3
+
+    # What we are looking for: strings, and the sourcemap comment. The
+    # others are matched to skip over them; a slash might start a
+    # regular expression, which has to be skipped, or be a division.
+    _tokens = re.compile(r"""
+        (?P<sourcemap>//[#@][\t\ ]*sourceMappingURL=)
+      | //[^\n\r]*
+      | /\*.*?(?:\*/|\Z)
+      | (?P<string>"(?:[^"\\\n\r]|\\.)*"|'(?:[^'\\\n\r]|\\.)*')
+      | `(?:[^`\\]|\\.)*`?
+      | /
+    """, re.VERBOSE | re.DOTALL)
+    _regex = re.compile(r'/(?:[^/\\\[\n\r]|\\.|\[(?:[^\]\\\n\r]|\\.)*\])+/')
+    # After these, a slash starts a regular expression
+    _regex_after = set('(,=:[!&|?{};+-*%<>~^')
+    _regex_keywords = re.compile(
+        r'(?:^|[^\w$.])(?:return|typeof|case|do|else|in|of|new|delete|void|'
+        r'throw|yield|await)$')
+    _sourcemap_url = re.compile(r'[^\s\'"]*')
+
+    # What makes a string an import, or relative to the script
+    _import_before = re.compile(r'(?:\bimport\s*\(|\bimport|\bfrom)\s*$')
+    _new_url_before = re.compile(r'\bnew\s+URL\s*\(\s*$')
+    _new_url_after = re.compile(r'\s*,\s*import\.meta\.url\b')
+    _context_size = 64
+
+    # What makes a string look like a url
+    _url_like = re.compile(r"""
+        ^(?:(?:https?:)?//[\w-]+(?:\.[\w-]+)*(?::\d+)?(?:[/?\#][^\s]*)?
+          | \.{0,2}/[\w$@~%-][^\s]*
+          | [\w$@~%-][^\s]*\.(?P<ext>\w+)(?:[?\#][^\s]*)?)$
+    """, re.VERBOSE)
+    _url_chars = re.compile(r"^[A-Za-z0-9\-._~:/?#\[\]@!$&'()*+,;=%]*$")
+    _import_like = re.compile(r'^(?:\.{0,2}/|https?://)')
+    # A string with one of these extensions is an asset of the page
+    asset_extensions = set((
+        'js', 'mjs', 'css', 'json', 'map', 'wasm', 'png', 'jpg', 'jpeg',
+        'gif', 'svg', 'webp', 'avif', 'ico', 'bmp', 'woff', 'woff2', 'ttf',
+        'otf', 'eot', 'mp4', 'webm', 'ogg', 'mp3', 'wav', 'vtt'))
+    # Only paths with these count; "a.b" is more often something else
+    path_extensions = asset_extensions | set((
+        'html', 'htm', 'xml', 'txt', 'pdf', 'php', 'aspx'))
+    max_url_length = 2048
+
+    _escapes = re.compile(
+        r'\\(?:u\{([0-9a-fA-F]+)\}|u([0-9a-fA-F]{4})|x([0-9a-fA-F]{2})|(.))',
+        re.DOTALL)
+    _simple_escapes = {'n': '\n', 'r': '\r', 't': '\t', 'b': '\b',
+                       'f': '\f', 'v': '\v', '0': '\0', '\n': ''}
+
+    def get_urls(self):
+        for element in self._get_elements():
+            if element['type'] == 'url':
+                yield element['url'], element['opts']
+
+    def replace_urls(self, replacer):
+        elements = self._get_elements()
+        for element in elements:
+            element.pop('replacement', None)
+            if element['type'] == 'url':
+                new_url = replacer(self.absurl(element['url']))
+                if not new_url:
+                    continue
+                quote = element['quote']
+                if quote:
+                    new_url = new_url.replace('\\', '\\\\').replace(
+                        quote, '\\' + quote)
+                    element['replacement'] = quote + new_url + quote
+                else:
+                    element['replacement'] = new_url.replace(' ', '%20')
+        return self.same_as_input(self._join_elements(elements))
+
+    def _unescape(self, string):
+        def replace(match):
+            code = match.group(1) or match.group(2) or match.group(3)
+            if code:
+                try:
+                    return chr(int(code, 16))
+                except (ValueError, OverflowError):
+                    return ''
+            char = match.group(4)
+            return self._simple_escapes.get(char, char)
+        return self._escapes.sub(replace, string)
+
+    def _is_regex_start(self, text, pos):
+        i = pos - 1
+        while i >= 0 and text[i] in ' \t\r\n':
+            i -= 1
+        if i < 0 or text[i] in self._regex_after:
+            return True
+        return bool(self._regex_keywords.search(
+            text, max(0, i - 10), i + 1))
+
+    def _classify(self, text, start, end, url):
+        """Return the options for the string ``url`` at ``start:end``,
+        or ``None`` if it does not seem to be a url.
+        """
+        # Most strings in a script are not urls, and can be told apart
+        # quickly; a url always has a slash or a dot.
+        if not url or len(url) > self.max_url_length or \
+                not ('/' in url or '.' in url) or \
+                not self._url_chars.match(url):
+            return None
+
+        before = text[max(0, start - self._context_size):start]
+        if self._import_before.search(before):
+            if self._import_like.match(url):
+                return {'inline': True}
+            # A bare module name, resolved by a bundler or import map
+            return None
+        if self._new_url_before.search(before) and \
+                self._new_url_after.match(text, end):
+            return {'inline': True}
+
+        match = self._url_like.match(url)
+        if not match:
+            return None
+        ext = (match.group('ext') or '').lower()
+        if match.group('ext') is not None and not ext in self.path_extensions:
+            return None
+        if not ext:
+            ext = url.split('?', 1)[0].split('#', 1)[0].rpartition('/')[2]
+            ext = ext.rpartition('.')[2].lower() if '.' in ext else ''
+        return {'inline': ext in self.asset_extensions, 'heuristic': True}
+
+    def _parse(self):
+        # Bundles can have megabytes; the regular expressions take us
+        # from one string to the next.
+        text = self.as_text(self.data)
+        pos = 0
+        scan_from = 0
+        while True:
+            match = self._tokens.search(text, scan_from)
+            if not match:
+                break
+            scan_from = match.end()
+
+            if match.group() == '/':
+                if self._is_regex_start(text, match.start()):
+                    regex = self._regex.match(text, match.start())
+                    if regex:
+                        scan_from = regex.end()
                 continue
 
-            # url() instructions
-            if match('url('):
-                p.skip_whitespace()
+            if match.group('sourcemap'):
+                url = self._sourcemap_url.match(text, scan_from).group()
+                if not url or url.startswith('data:'):
+                    continue
+                start, end, quote = scan_from, scan_from + len(url), None
+                opts = {'inline': True}
+            elif match.group('string'):
+                start, end = match.span()
+                quote = text[start]
+                url = self._unescape(text[start+1:end-1])
+                opts = self._classify(text, start, end, url)
+                if opts is None:
+                    continue
+            else:
+                continue
+
+            yield {'type': 'unknown', 'pos': pos, 'data': text[pos:start]}
+            yield {'type': 'url', 'pos': start, 'data': text[start:end],
+                   'url': url, 'quote': quote, 'opts': opts}
+            pos = scan_from = end
+
+        # Complete the final element
+        yield {'type': 'unknown', 'pos': pos, 'data': text[pos:]}
+
 
-                # Start new element with opening quote included
-                yield p.switch_element()
-                quote_chr = None
-                if cur() in '"\'':
-                    quote_chr = next()
+class XMLParser(Parser):
+    """Base for XML formats, where urls are in attributes, or are the
+    text of an element. Subclasses list them in ``url_attrs``, keyed by
+    ``(element, attribute)``, with ``'*'`` for any element, and in
+    ``url_texts``, keyed by element; the values are the options of the
+    urls. Names include a namespace prefix, as written in the document.
 
-                # Find the actual url
-                url = p.skip_until(quote_chr or ')', '\n\r', escape_chr='\\')
+    This does not check that the document is well-formed, and so also
+    works for one that is not.
+    """
+
+    url_attrs = {}
+    url_texts = {}
+    # The root elements of documents this parser handles
+    root_elements = ()
+
+    _tokens = re.compile(r"""
+        <!--.*?(?:-->|\Z)
+      | <!\[CDATA\[.*?(?:\]\]>|\Z)
+      | <[!?](?!xml-stylesheet\b)[^>]*>
+      | <\??(?P<tag>[\w:.-]+)(?P<attrs>(?:[^>"']|"[^"]*"|'[^']*')*)>
+    """, re.VERBOSE | re.DOTALL)
+    _attrs = re.compile(r"""([\w:.-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+    _text = re.compile(r'\s*([^<\s][^<]*?)\s*<')
+    _root = re.compile(r"""
+        ^\s*(?:<!--.*?-->\s*|<\?[^>]*>\s*|<![^>]*>\s*)*<([\w:.-]+)
+    """, re.VERBOSE | re.DOTALL)
+
+    @classmethod
+    def sniff(cls, head):
+        match = cls._root.match(head)
+        return bool(match) and match.group(1) in cls.root_elements
+
+    def get_urls(self):
+        for element in self._get_elements():
+            if element['type'] == 'url':
+                yield element['url'], element['opts']
+
+    def replace_urls(self, replacer):
+        elements = self._get_elements()
+        for element in elements:
+            element.pop('replacement', None)
+            if element['type'] == 'url':
+                new_url = replacer(self.absurl(element['url']))
+                if new_url:
+                    new_url = new_url.replace('&', '&amp;').replace(
+                        '<', '&lt;').replace('"', '&quot;').replace(
+                        "'", '&#39;')
+                    element['replacement'] = new_url
+        return self.same_as_input(self._join_elements(elements))
+
+    def _options(self, tag, attr):
+        opts = self.url_attrs.get((tag, attr))
+        if opts is None:
+            opts = self.url_attrs.get(('*', attr))
+        return opts
 
-                # If there is a closing quote, include it
-                # (a closing bracket is not included).
-                if quote_chr:
-                    p.next_if(quote_chr)
-                yield p.switch_element(type='url', url=url)
+    def _parse(self):
+        text = self.as_text(self.data)
+        pos = 0
+        for match in self._tokens.finditer(text):
+            tag = match.group('tag')
+            if not tag:
                 continue
 
-            next()
+            found = []
+            for attr in self._attrs.finditer(
+                    text, match.start('attrs'), match.end('attrs')):
+                opts = self._options(tag, attr.group(1))
+                if opts is not None:
+                    group = 2 if attr.group(2) is not None else 3
+                    found.append(
+                        (attr.start(group), attr.end(group), opts,
+                         '{0}.{1}'.format(tag, attr.group(1))))
+            if tag in self.url_texts and \
+                    not match.group('attrs').endswith('/'):
+                content = self._text.match(text, match.end())
+                if content:
+                    found.append((content.start(1), content.end(1),
+                                  self.url_texts[tag], tag))
+
+            for start, end, opts, where in found:
+                url = entity_unescape(text[start:end]).strip()
+                # A reference within the document itself
+                if not url or url.startswith('#'):
+                    continue
+                opts = dict(opts, tag=where)
+                yield {'type': 'unknown', 'pos': pos, 'data': text[pos:start]}
+                yield {'type': 'url', 'pos': start, 'data': text[start:end],
+                       'url': url, 'opts': opts}
+                pos = end
 
         # Complete the final element
-        yield p.switch_element()
+        yield {'type': 'unknown', 'pos': pos, 'data': text[pos:]}
+
+
+class SVGParser(XMLParser):
+    """Images, fonts, scripts and stylesheets an SVG image uses, and
+    its links.
+    """
+
+    mimetypes = ('image/svg+xml',)
+    cost = 2
+    root_elements = ('svg',)
+    url_attrs = {
+        ('*', 'href'): {'inline': True},
+        ('*', 'xlink:href'): {'inline': True},
+        ('a', 'href'): {'inline': False},
+        ('a', 'xlink:href'): {'inline': False},
+        ('xml-stylesheet', 'href'): {'inline': True},
+    }
+
+
+class FeedParser(XMLParser):
+    """RSS and Atom feeds. The entries are links to follow; images
+    like the feed's logo are requisites.
+    """
+
+    mimetypes = ('application/rss+xml', 'application/atom+xml',
+                 'application/rdf+xml')
+    root_elements = ('rss', 'feed', 'rdf:RDF')
+    url_attrs = {
+        # Atom
+        ('link', 'href'): {'inline': False},
+        ('atom:link', 'href'): {'inline': False},
+        ('content', 'src'): {'inline': False},
+        # RSS
+        ('enclosure', 'url'): {'inline': False},
+        ('media:content', 'url'): {'inline': False},
+        ('media:thumbnail', 'url'): {'inline': True},
+        ('xml-stylesheet', 'href'): {'inline': True},
+    }
+    url_texts = {
+        'link': {'inline': False},
+        'comments': {'inline': False},
+        'url': {'inline': True},
+        'icon': {'inline': True},
+        'logo': {'inline': True},
+    }
+
+
+class SitemapParser(XMLParser):
+    """A sitemap that was linked to, see also :mod:`track.sitemap`.
+    """
+
+    # There is no registered type for sitemaps, which come as XML; this
+    # is what we call one we recognized.
+    mimetypes = ('application/x-sitemap+xml',)
+    root_elements = ('urlset', 'sitemapindex')
+    url_attrs = {
+        ('xhtml:link', 'href'): {'inline': False},
+    }
+    url_texts = {
+        'loc': {'inline': False},
+        'image:loc': {'inline': False},
+    }
+
+
+class ManifestParser(Parser):
+    """A web app manifest, which is JSON: the icons and the pages of
+    the app.
+    """
+
+    mimetypes = ('application/manifest+json',)
+    # The keys holding a url, with their options
+    url_keys = {
+        'src': {'inline': True},
+        'start_url': {'inline': False},
+        'url': {'inline': False},
+    }
 
+    _strings = re.compile(r'"((?:[^"\\]|\\.)*)"(\s*:)?', re.DOTALL)
+    _sniff = re.compile(r'^\s*\{.*"(?:start_url|icons)"\s*:', re.DOTALL)
 
-class JavasScriptParser(Parser):
+    @classmethod
+    def sniff(cls, head):
+        return bool(cls._sniff.match(head))
+
+    def get_urls(self):
+        for element in self._get_elements():
+            if element['type'] == 'url':
+                yield element['url'], element['opts']
+
+    def replace_urls(self, replacer):
+        elements = self._get_elements()
+        for element in elements:
+            element.pop('replacement', None)
+            if element['type'] == 'url':
+                new_url = replacer(self.absurl(element['url']))
+                if new_url:
+                    element['replacement'] = json.dumps(new_url)
+        return self.same_as_input(self._join_elements(elements))
 
     def _parse(self):
-        # No parsing JavaScript for now...
-        yield from ()
+        text = self.as_text(self.data)
+        pos = 0
+        key = None
+        for match in self._strings.finditer(text):
+            if match.group(2):
+                key = match.group(1)
+                continue
+            opts, where = self.url_keys.get(key), key
+            key = None
+            if opts is None:
+                continue
+            try:
+                url = json.loads(match.group(0).rstrip())
+            except ValueError:
+                continue
+            yield {'type': 'unknown', 'pos': pos, 'data': text[pos:match.start()]}
+            yield {'type': 'url', 'pos': match.start(), 'data': match.group(0),
+                   'url': url, 'opts': dict(opts, tag=where)}
+            pos = match.end()
+
+        # Complete the final element
+        yield {'type': 'unknown', 'pos': pos, 'data': text[pos:]}
 
 
 class HeaderLinkParser(Parser):
@@ -725,9 +1478,120 @@ class HeaderLinkParser(Parser):
             yield link['url'], opts
 
 
-def get_parser_for_mimetype(mimetype):
-    if mimetype == 'text/html':
-        return HTMLParser
-    elif mimetype == 'text/css':
-        return CSSParser
-    return None
+def find_urls(parser_class, data, url, encoding=None, with_elements=False):
+    """Return the urls in ``data`` as a list, as iterating over a parser
+    would. This is how a parser is used in a separate process.
+
+    ``with_elements`` returns the parsed elements as well, as a tuple
+    ``(urls, elements)``; given to a parser of the same document, they
+    spare it parsing the document again to replace its urls.
+    """
+    parser = parser_class(data, url, encoding=encoding)
+    urls = list(parser)
+    if with_elements:
+        return urls, parser._get_elements()
+    return urls
+
+
+class ParserRegistry(object):
+    """Knows which parser to use for a mimetype.
+
+    Besides the parsers registered by hand, those of other packages are
+    found through the ``track.parsers`` entry point; each entry point
+    names a :class:`Parser` subclass, which declares its ``mimetypes``.
+
+    Servers often send a document with a generic type like
+    ``text/plain``, or ``application/xml`` for any XML format; for
+    those, :meth:`sniff` guesses the parser from the content.
+    """
+
+    entry_point_group = 'track.parsers'
+
+    # The types that do not tell us what a document is
+    generic_mimetypes = (
+        '', 'text/plain', 'application/octet-stream', 'application/xml',
+        'text/xml', 'application/json')
+    # How much of a document we look at to guess its type
+    sniff_size = 1024
+
+    def __init__(self):
+        self._parsers = OrderedDict()
+        self._entry_points_loaded = False
+
+    def register(self, parser_class, mimetypes=None):
+        """Use ``parser_class`` for ``mimetypes``, by default the
+        ones it declares. Replaces any parser registered before.
+        """
+        for mimetype in mimetypes or parser_class.mimetypes:
+            self._parsers[mimetype] = parser_class
+
+    def unregister(self, mimetype):
+        self._load_entry_points()
+        self._parsers.pop(mimetype, None)
+
+    def get(self, mimetype, max_cost=None):
+        """Return the parser for ``mimetype``, or ``None``. Parsers
+        costing more than ``max_cost`` are not used.
+        """
+        self._load_entry_points()
+        parser_class = self._parsers.get(mimetype)
+        if parser_class and max_cost is not None and \
+                parser_class.cost > max_cost:
+            return None
+        return parser_class
+
+    def sniff(self, data, max_cost=None):
+        """Return the parser for ``data``, a document of a generic type,
+        or ``None``.
+        """
+        self._load_entry_points()
+        head = data[:self.sniff_size]
+        if isinstance(head, bytes):
+            for bom in BOMS:
+                if head.startswith(bom[0]):
+                    head = head[len(bom[0]):].decode(bom[1], 'replace')
+                    break
+            else:
+                head = head.decode('latin-1')
+        for parser_class in OrderedDict.fromkeys(self._parsers.values()):
+            if max_cost is not None and parser_class.cost > max_cost:
+                continue
+            if parser_class.sniff(head):
+                return parser_class
+        return None
+
+    def _load_entry_points(self):
+        if self._entry_points_loaded:
+            return
+        self._entry_points_loaded = True
+        for entry_point in _iter_entry_points(self.entry_point_group):
+            self.register(entry_point.load())
+
+
+def _iter_entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            from pkg_resources import iter_entry_points
+        except ImportError:
+            return ()
+        return iter_entry_points(group)
+    entry_points = entry_points()
+    if hasattr(entry_points, 'select'):
+        return entry_points.select(group=group)
+    return entry_points.get(group, ())
+
+
+parsers = ParserRegistry()
+parsers.register(HTMLParser)
+parsers.register(CSSParser)
+parsers.register(JavaScriptParser)
+parsers.register(SVGParser)
+parsers.register(FeedParser)
+parsers.register(SitemapParser)
+parsers.register(ManifestParser)
+
+
+def get_parser_for_mimetype(mimetype, max_cost=None):
+    return parsers.get(mimetype, max_cost)
@@ -0,0 +1,86 @@
+"""Deciding which of the urls of an existing mirror to check for changes
+when updating it.
+
+Each check costs a request, even if only a conditional one. What we
+know about a url from previous runs (see ``Mirror.url_info``) lets us
+estimate how likely it is to have changed since we last looked, and
+spend a limited number of requests on the most promising urls.
+"""
+
+import datetime
+import heapq
+import math
+
+
+__all__ = ('UpdatePlanner',)
+
+
+class UpdatePlanner(object):
+    """Picks the urls worth checking within a budget of ``budget``
+    requests.
+
+    We assume that a url changes at a constant rate, which we estimate
+    from the number of changes we observed over the time we have known
+    it. The chance that the url changed since the last check follows
+    from that (assuming a Poisson process). Hard facts, like a sitemap's
+    ``<lastmod>`` or an ``Expires`` header, override the estimate.
+    """
+
+    # Until we have observed a url for a while, assume it changes about
+    # once in this many seconds.
+    prior_interval = 7 * 24 * 60 * 60
+
+    def __init__(self, mirror, budget, now=None):
+        self.mirror = mirror
+        self.remaining = budget
+        self.now = now or datetime.datetime.utcnow()
+
+        # The urls the budget covers, by score. Urls scoring below the
+        # cutoff would not have made it into the budget in the first place.
+        if budget <= 0:
+            self.best = []
+            self.cutoff = float('inf')
+        else:
+            self.best = heapq.nlargest(budget, (
+                (self.score(info), url)
+                for url, info in mirror.url_info.items()))
+            self.cutoff = self.best[-1][0] if len(self.best) == budget else 0
+
+    def score(self, info, lastmod=None):
+        """Return the probability that the url described by ``info``
+        has changed since we last checked it.
+        """
+        checked = info.get('checked') or info.get('fetched')
+        if not checked:
+            return 1.0
+        if lastmod:
+            return 1.0 if lastmod > checked else 0.0
+        expires = info.get('expires')
+        if expires and expires > self.now:
+            return 0.0
+
+        elapsed = max(0, (self.now - checked).total_seconds())
+        observed = (checked - info.get('since', checked)).total_seconds()
+        rate = (info.get('changes', 0) + 1) / (observed + self.prior_interval)
+        return 1 - math.exp(-rate * elapsed)
+
+    def plan(self):
+        """Return the urls the budget covers, those most likely to have
+        changed first. Seeding the queue of an update with them means
+        they are checked before any other url, and regardless of how
+        far from the starting urls they are.
+        """
+        return [url for score, url in self.best if score]
+
+    def should_check(self, link):
+        """Return ``True`` if ``link``, which the mirror knows, should be
+        checked for changes now. Uses up the budget.
+        """
+        if self.remaining <= 0:
+            return False
+        score = self.score(
+            self.mirror.url_info[link.url], link.info.get('lastmod'))
+        if score and score >= self.cutoff:
+            self.remaining -= 1
+            return True
+        return False
@@ -0,0 +1,419 @@
+"""Crawling with multiple processes.
+
+A single process is limited to one core, and parsing documents and
+converting links easily keep one busy. :class:`ShardedCrawl` instead
+runs a number of worker processes, each with a spider of its own.
+
+The hosts are partitioned between the workers (a *shard* of the hosts
+each), by a hash of the host name. A worker finding a link to a host
+it does not own sends it to the coordinator, which passes it on to the
+owner. Since all links of a host are processed by the same worker,
+per-host rate control, circuit breakers and budgets work as usual.
+
+The coordinator is also the only process writing to the mirror's
+databases: a worker gets a copy of what the mirror knows about its
+hosts, and reports any change it makes. Workers write the files of
+their urls themselves. Converting links is left until the end, when
+the coordinator has the full picture.
+"""
+
+import multiprocessing
+from multiprocessing.connection import wait
+import queue
+import shelve
+import threading
+from urllib.parse import urlparse
+import zlib
+from track.frontier import DequeFrontier
+from track.mirror import Mirror
+from track.sitemap import add_sitemap
+
+
+__all__ = ('ShardedCrawl', 'ShardMirror', 'shard_of')
+
+
+# The databases of the mirror which are keyed by url, and which a
+# worker thus only needs to know its own part of.
+SHARDED_SHELVES = ('urls', 'url_info', 'redirects', 'robots')
+
+
+def shard_of(url, num_shards):
+    """Return the shard the host of ``url`` belongs to. Unlike
+    ``hash()``, this is the same in every process.
+    """
+    netloc = urlparse(url).netloc.lower()
+    return zlib.crc32(netloc.encode('utf-8')) % num_shards
+
+
+class ShardChannel(object):
+    """The worker's end of the connection to the coordinator.
+    """
+
+    def __init__(self, shard, num_shards, conn, snapshot):
+        self.shard = shard
+        self.num_shards = num_shards
+        self.conn = conn
+        # The data of the mirror relevant to this shard, by shelve name
+        self.snapshot = snapshot
+        self.mirror = None
+
+    def frontier(self, local=None):
+        """Return a frontier for the worker's spider; ``local`` holds
+        the links of our own shard.
+        """
+        return RoutingFrontier(
+            DequeFrontier() if local is None else local, self)
+
+    def route(self, shard, link):
+        # The receiving worker will not know whether the page linking
+        # here has been saved, which the requisite test depends on.
+        saved_as = None
+        if link.previous and self.mirror:
+            saved_as = self.mirror.encountered_urls.get(link.previous.url)
+        self.conn.send(('link', shard, link, saved_as))
+
+    def send(self, *message):
+        self.conn.send(message)
+
+
+class RoutingFrontier(object):
+    """Keeps the links of our own shard, and sends all others to the
+    coordinator.
+    """
+
+    def __init__(self, frontier, channel):
+        self.frontier = frontier
+        self.channel = channel
+
+    def add(self, link, urgent=False):
+        shard = shard_of(link.original_url, self.channel.num_shards)
+        if shard == self.channel.shard:
+            self.frontier.add(link, urgent=urgent)
+        else:
+            self.channel.route(shard, link)
+
+    def pop(self):
+        return self.frontier.pop()
+
+    def __len__(self):
+        return len(self.frontier)
+
+    def __iter__(self):
+        return iter(self.frontier)
+
+
+class SyncedShelf(shelve.Shelf):
+    """An in-memory shelf; changes are also sent to the coordinator,
+    which applies them to the actual mirror.
+    """
+
+    def __init__(self, name, channel, data):
+        super().__init__({})
+        for key, value in data.items():
+            shelve.Shelf.__setitem__(self, key, value)
+        self.name = name
+        self.channel = channel
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.channel.send('set', self.name, key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.channel.send('delete', self.name, key)
+
+
+class SyncedDict(dict):
+    """Like :class:`SyncedShelf`, for the mirror's in-memory data.
+    """
+
+    def __init__(self, name, channel):
+        super().__init__()
+        self.name = name
+        self.channel = channel
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.channel.send('set', self.name, key, value)
+
+    def remember(self, key, value):
+        """Store locally only; the coordinator knows already."""
+        super().__setitem__(key, value)
+
+
+class ShardMirror(Mirror):
+    """The mirror of a worker. To be combined with the mirror class the
+    coordinator uses::
+
+        class WorkerMirror(ShardMirror, CLIMirror):
+            pass
+
+        WorkerMirror(channel, *args_for_climirror)
+    """
+
+    def __init__(self, channel, *args, **kwargs):
+        self.channel = channel
+        channel.mirror = self
+        super().__init__(*args, **kwargs)
+        self.encountered_urls = SyncedDict('encountered', channel)
+        # The coordinator does this once all urls are known
+        self.write_at_once = False
+
+    def open_shelve(self, filename, flag='c'):
+        return SyncedShelf(
+            filename, self.channel, self.channel.snapshot.get(filename, {}))
+
+    def flush(self):
+        pass
+
+    # The url index is the coordinator's; we only know our own shard,
+    # and the coordinator hears of each change anyway.
+    def _url_changed(self, url):
+        pass
+
+    def _update_url_index(self):
+        pass
+
+    def _rebuild_url_index(self):
+        pass
+
+
+def _run_worker(channel, make_spider):
+    spider = make_spider(channel)
+    started = spider.clock()
+    received = 0
+
+    def handle(message):
+        kind = message[0]
+        if kind == 'add':
+            spider.add(message[1], **message[2])
+        elif kind == 'sitemap':
+            add_sitemap(spider, message[1])
+        elif kind == 'link':
+            link, saved_as = message[1:]
+            if saved_as:
+                spider.mirror.encountered_urls.remember(
+                    link.previous.url, saved_as)
+            spider._link_queue.add(link)
+            spider.events.added_to_queue(link)
+
+    while True:
+        if channel.conn.poll():
+            message = channel.conn.recv()
+        elif len(spider) and not spider.limit_reached and \
+                not spider._out_of_budget(started):
+            spider.process_one()
+            continue
+        else:
+            # Nothing to do; unless another worker sends us a link,
+            # we are done.
+            channel.send('idle', received)
+            message = channel.conn.recv()
+
+        if message[0] == 'stop':
+            break
+        handle(message)
+        received += 1
+
+    spider.shutdown()
+    channel.send('done', spider._drain_frontier())
+    channel.conn.close()
+
+
+class _Worker(object):
+    """The coordinator's end of the connection to a worker. Sending
+    happens in a thread, so the coordinator never blocks on a worker
+    that is itself busy sending.
+    """
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.sent = 0
+        self.idle_at = None
+        self.done = False
+        self._outbox = queue.Queue()
+        self._thread = threading.Thread(target=self._send_loop, daemon=True)
+        self._thread.start()
+
+    def send(self, *message):
+        if message[0] != 'stop':
+            self.sent += 1
+        self._outbox.put(message)
+
+    def is_idle(self):
+        """Idle, and has received everything we sent."""
+        return self.idle_at == self.sent
+
+    def close(self):
+        self._outbox.put(None)
+        self._thread.join()
+
+    def _send_loop(self):
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                break
+            self.conn.send(message)
+
+
+class ShardedCrawl(object):
+    """Run a crawl in ``num_workers`` processes, writing to ``mirror``.
+
+    ``make_spider`` is called in each worker with a channel to the
+    coordinator, and must return the spider to use. That spider needs
+    a frontier from ``channel.frontier()``, and a mirror that is a
+    :class:`ShardMirror`, given ``channel``.
+
+    Budgets apply to each worker separately.
+
+    ``events`` receives the events of the coordinator, like the
+    progress of converting links; the spiders have their own.
+
+    Any shelves beyond the mirror's own that the workers are going to
+    open need to be listed in ``shared_shelves``, e.g. ``('cookies',)``.
+    """
+
+    def __init__(self, mirror, make_spider, num_workers, shared_shelves=(),
+                 events=None):
+        self.mirror = mirror
+        self.events = events
+        self.make_spider = make_spider
+        self.num_workers = num_workers
+        self.shared_shelves = shared_shelves
+        self._initial = []
+        self._stores = {
+            'urls': mirror.stored_urls,
+            'url_info': mirror.url_info,
+            'info': mirror.info,
+            'redirects': mirror.redirects,
+            'robots': mirror.robots,
+            'frontier': mirror.frontier,
+            'encountered': mirror.encountered_urls,
+        }
+
+    def __len__(self):
+        return len(self._initial)
+
+    def add(self, url, **kwargs):
+        """Add a starting url, see :meth:`Spider.add`."""
+        self._initial.append(('add', url, kwargs))
+
+    def add_sitemap(self, url):
+        """Add the urls of a sitemap, see :func:`add_sitemap`."""
+        self._initial.append(('sitemap', url))
+
+    def resume(self):
+        """See :meth:`Spider.resume`."""
+        links = self.mirror.frontier.pop('links', [])
+        # Workers do not know which urls the stopped run got to
+        self.mirror.frontier.pop('started', None)
+        for link in links:
+            self._initial.append(('link', link, None))
+        return len(links)
+
+    def loop(self):
+        workers = self._start_workers()
+        try:
+            for message in self._initial:
+                if message[0] == 'link':
+                    shard = shard_of(message[1].original_url, self.num_workers)
+                else:
+                    # Whichever worker gets it will pass it on as needed
+                    shard = 0
+                workers[shard].send(*message)
+
+            # Until all workers are idle at the same time
+            leftovers = []
+            while not all(worker.is_idle() for worker in workers):
+                self._receive(workers, leftovers)
+            for worker in workers:
+                worker.send('stop')
+            while not all(worker.done for worker in workers):
+                self._receive(workers, leftovers)
+        except BaseException:
+            for worker in workers:
+                worker.process.terminate()
+            raise
+        finally:
+            for worker in workers:
+                worker.close()
+                worker.process.join()
+
+        if leftovers:
+            self.mirror.frontier['links'] = leftovers
+        else:
+            self.mirror.frontier.pop('links', None)
+        self.mirror.finish(self.events)
+
+    def _start_workers(self):
+        snapshots = self._make_snapshots()
+        workers = []
+        for shard in range(self.num_workers):
+            conn, worker_conn = multiprocessing.Pipe()
+            channel = ShardChannel(
+                shard, self.num_workers, worker_conn, snapshots[shard])
+            process = multiprocessing.Process(
+                target=_run_worker, args=(channel, self.make_spider))
+            process.start()
+            worker_conn.close()
+            workers.append(_Worker(process, conn))
+        return workers
+
+    def _make_snapshots(self):
+        snapshots = [{} for i in range(self.num_workers)]
+        for name in list(self._stores) + list(self.shared_shelves):
+            if name in ('frontier', 'encountered'):
+                continue
+            for snapshot in snapshots:
+                snapshot[name] = {}
+            for key, value in self._store(name).items():
+                if name in SHARDED_SHELVES:
+                    shards = [snapshots[shard_of(key, self.num_workers)]]
+                else:
+                    shards = snapshots
+                for snapshot in shards:
+                    snapshot[name][key] = value
+        return snapshots
+
+    def _store(self, name):
+        if not name in self._stores:
+            self._stores[name] = self.mirror.open_shelve(name)
+        return self._stores[name]
+
+    def _receive(self, workers, leftovers):
+        """Wait for messages from the workers, and process them.
+        """
+        by_conn = {worker.conn: worker for worker in workers
+                   if not worker.done}
+        for conn in wait(list(by_conn)):
+            worker = by_conn[conn]
+            try:
+                message = conn.recv()
+            except EOFError:
+                raise RuntimeError('A worker process died: exit code {}'.format(
+                    worker.process.exitcode))
+            self._handle(workers, worker, message, leftovers)
+
+    def _handle(self, workers, worker, message, leftovers):
+        kind = message[0]
+        if kind == 'set':
+            name, key, value = message[1:]
+            self._store(name)[key] = value
+            if name == 'url_info':
+                self.mirror._insert_into_url_usage(key, value['links'])
+            elif name == 'urls':
+                self.mirror._url_changed(key)
+        elif kind == 'delete':
+            name, key = message[1:]
+            self._store(name).pop(key, None)
+            if name == 'urls':
+                self.mirror._url_changed(key)
+        elif kind == 'link':
+            shard, link, saved_as = message[1:]
+            workers[shard].send('link', link, saved_as)
+        elif kind == 'idle':
+            worker.idle_at = message[1]
+        elif kind == 'done':
+            leftovers.extend(message[1])
+            worker.done = True
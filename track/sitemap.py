@@ -0,0 +1,141 @@
+"""Reading urls from sitemaps, see http://www.sitemaps.org.
+
+Sitemaps of large sites can have hundreds of megabytes, so they are
+parsed incrementally as they arrive over the network, and are never
+held in memory as a whole.
+"""
+
+import datetime
+import re
+import zlib
+from xml.etree.ElementTree import XMLPullParser
+from track.spider import CONTENT_CHUNK_SIZE
+
+
+__all__ = ('SitemapReader', 'add_sitemap', 'parse_w3c_datetime')
+
+
+W3C_DATETIME = re.compile(r'''
+    ^(\d{4})(?:-(\d\d)(?:-(\d\d)
+    (?:T(\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?
+    (Z|[+-]\d\d:\d\d)?)?)?)?$''', re.VERBOSE)
+
+
+def parse_w3c_datetime(value):
+    """Parse the date format used by sitemaps, which may be anything
+    from ``2005`` to ``2005-01-01T12:00:00.34+01:00``. Returns a naive
+    datetime in UTC, or ``None``.
+    """
+    match = W3C_DATETIME.match((value or '').strip())
+    if not match:
+        return None
+    *parts, tz = match.groups()
+    try:
+        date = datetime.datetime(*[int(p) if p else d for p, d in zip(
+            parts, (None, 1, 1, 0, 0, 0))])
+    except ValueError:
+        return None
+    if tz and tz != 'Z':
+        offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[4:]))
+        date = date - offset if tz[0] == '+' else date + offset
+    return date
+
+
+def _local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+class SitemapReader(object):
+    """Incremental parser for sitemaps and sitemap indexes.
+
+    :meth:`feed` it the bytes of the file as they come in, gzipped or
+    not. It returns the entries completed so far, as 3-tuples of
+    ``(kind, url, lastmod)``, where ``kind`` is ``'url'`` or, for a
+    sitemap index, ``'sitemap'``.
+    """
+
+    def __init__(self):
+        self._parser = XMLPullParser(events=('start', 'end'))
+        self._root = None
+        # Undecided until we have seen the first bytes
+        self._decompressor = None
+        self._head = b''
+
+    def feed(self, data):
+        if self._decompressor is None:
+            self._head += data
+            if len(self._head) < 2:
+                return []
+            data, self._head = self._head, b''
+            self._decompressor = data[:2] == b'\x1f\x8b' and \
+                zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self._decompressor:
+            data = self._decompressor.decompress(data)
+        self._parser.feed(data)
+        return list(self._read_events())
+
+    def close(self):
+        """Signal the end of the file, returns the last entries.
+        """
+        if self._decompressor is None:
+            # Too short to be gzipped
+            self._parser.feed(self._head)
+        elif self._decompressor:
+            self._parser.feed(self._decompressor.flush())
+        self._parser.close()
+        return list(self._read_events())
+
+    def _read_events(self):
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                if self._root is None:
+                    self._root = element
+                continue
+
+            kind = _local_name(element.tag)
+            if not kind in ('url', 'sitemap') or element is self._root:
+                continue
+
+            data = {}
+            for child in element:
+                data[_local_name(child.tag)] = (child.text or '').strip()
+            if data.get('loc'):
+                yield kind, data['loc'], parse_w3c_datetime(data.get('lastmod'))
+
+            # Nothing in the tree is needed any more; don't let it grow.
+            self._root.clear()
+
+
+def add_sitemap(spider, url):
+    """Add the urls listed in the sitemap at ``url`` to the queue of
+    the spider, as starting points. A sitemap index is followed to the
+    sitemaps it lists. Returns the number of urls added.
+
+    ``<lastmod>`` is made available to the rules as ``link.info['lastmod']``.
+    """
+    num_added = 0
+    pending, seen = [url], set()
+    while pending:
+        url = pending.pop()
+        if url in seen:
+            continue
+        seen.add(url)
+
+        response = spider.session.get(url, stream=True)
+        try:
+            response.raise_for_status()
+            for kind, loc, lastmod in _read_sitemap(response):
+                if kind == 'sitemap':
+                    pending.append(loc)
+                elif spider._add(loc, source='sitemap', lastmod=lastmod):
+                    num_added += 1
+        finally:
+            response.close()
+    return num_added
+
+
+def _read_sitemap(response):
+    reader = SitemapReader()
+    for chunk in response.iter_content(CONTENT_CHUNK_SIZE):
+        yield from reader.feed(chunk)
+    yield from reader.close()
@@ -1,17 +1,31 @@
-from collections import deque
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    wait as concurrent_wait, FIRST_COMPLETED
 import datetime
 import email
 from functools import partial
+import heapq
+from itertools import count
 from itertools import chain
 import mimetypes
-import reppy.cache
+import random
+import reppy
+import reppy.parser
 import re
+import time
 import requests
-from requests.models import Response
-from urllib.parse import urlparse, urldefrag
-from requests.exceptions import ConnectionError, Timeout, TooManyRedirects
+from requests.adapters import HTTPAdapter
+from requests.models import Response, REDIRECT_STATI
+from requests.utils import requote_uri
+from urllib.parse import urlparse, urldefrag, urljoin
+from requests.exceptions import ConnectionError, Timeout, TooManyRedirects, \
+    RequestException
+import weakref
 import urlnorm
-from track.parser import get_parser_for_mimetype, HeaderLinkParser
+from track.frontier import DequeFrontier
+from track.utils import url_cache, RefuseAll
+from track.parser import get_parser_for_mimetype, HeaderLinkParser, \
+    HTMLParser, HTMLLinkStream, find_urls, parsers
 
 
 
@@ -38,6 +52,12 @@ class Events(object):
         processor returns a link to the queue to be tried again later.
         """
 
+    def withdrawn_from_queue(self, link):
+        """Called when a link is taken out of the queue again, without
+        being processed: it was found in a page while it downloaded, but
+        the @stop rules then refused the page.
+        """
+
     def taken_by_processor(self, link):
         """Called when a links goes to a processor to be downloaded
         and saved.
@@ -84,6 +104,50 @@ class Events(object):
             {'num_links': 100}
         """
 
+    def limit_reached(self, limit, host=None):
+        """Called when a budget has been used up; ``limit`` is one of
+        ``requests``, ``bytes`` or ``time``. If ``host`` is given, only
+        the links of that host are affected, otherwise the spider stops.
+        """
+
+    def links_converted(self, num_done, num_total):
+        """Called as the mirror converts the links in all of its files
+        at the end of a run; ``num_done`` of ``num_total`` files are done.
+        """
+
+    def host_state_changed(self, host, **kwargs):
+        """Called when the spider changes how it treats a host; it might
+        slow down, or pause talking to the host altogether. ``host`` is a
+        :class:`HostState` instance. Expect dicts like::
+
+            {'throttled': True, 'delay': 2.0, 'blocked_for': 0}
+        """
+
+
+@url_cache
+def normalize_url(url):
+    """Return a 3-tuple of the original url, the url, and the data
+    lost between the two, as used by :class:`Link`. The result is
+    shared, do not modify it.
+    """
+    # Apply the simple idempotent optimizations to all urls (no need to
+    # ever deal with "HTTP://.."). This means case-sensitivity, and a
+    # whole lot of other things that the urlnorm library will do for us.
+    # We call this the original url, even though it is a bit of a lie.
+    try:
+        original_url = urlnorm.norm(url)
+    except urlnorm.InvalidUrl as e:
+        raise urlnorm.InvalidUrl('{}: {}'.format(e, url))
+
+    # For the normalized url that we'll be exposing, remove the
+    # fragment, and treat https and http the same.
+    url, fragment = urldefrag(original_url)
+    lossy_url_data = {'fragment': fragment}
+    if url.startswith('https:'):
+        url = 'http' + url[5:]
+        lossy_url_data.update({'protocol': 'https'})
+    return original_url, url, lossy_url_data
+
 
 class Link(object):
     """A url we encountered in the wild, to be processed.
@@ -105,23 +169,20 @@ class Link(object):
     """
 
     def __init__(self, url, previous=None, **info):
-        # Apply the simple idempotent optimizations to all urls (no need to
-        # ever deal with "HTTP://.."). This means case-sensitivity, and a
-        # whole lot of other things that the urlnorm library will do for us.
-        # We call this the original url, even though it is a bit of a lie.
-        try:
-            self.original_url = urlnorm.norm(url)
-        except urlnorm.InvalidUrl as e:
-            raise urlnorm.InvalidUrl('{}: {}'.format(e, url))
-
-        # For the normalized url that we'll be exposing, remove the
-        # fragment, and treat https and http the same.
-        url, fragment = urldefrag(self.original_url)
-        self.lossy_url_data = {'fragment': fragment}
-        if url.startswith('https:'):
-            url = 'http' + url[5:]
-            self.lossy_url_data.update({'protocol': 'https'})
-        self.url = url
+        self._setup(normalize_url(url), previous, info)
+
+    @classmethod
+    def from_normalized(cls, normalized, previous=None, **info):
+        """Like the constructor, but for a url that has already been
+        passed through :func:`normalize_url`.
+        """
+        link = cls.__new__(cls)
+        link._setup(normalized, previous, info)
+        return link
+
+    def _setup(self, normalized, previous, info):
+        self.original_url, self.url, lossy_url_data = normalized
+        self.lossy_url_data = dict(lossy_url_data)
 
         self.set_previous(previous)
         self.info = info
@@ -196,6 +257,17 @@ class Link(object):
                     self.response.request.method != 'HEAD' or type=='head'):
             return self.response
 
+        # The HEAD response we are about to replace is of no further use
+        if self.response:
+            release_response(self.response)
+
+        # If we know from a previous run that this url permanently
+        # redirects elsewhere, we can do without a request.
+        known_redirect = self._known_redirect(spider)
+        if known_redirect:
+            self.response = known_redirect
+            return self.response
+
         try:
             if type == 'head':
                 method = 'HEAD'
@@ -207,28 +279,18 @@ class Link(object):
             spider.rules.configure_request(request, self, spider)
 
             request = spider.session.prepare_request(request)
+            spider.get_host(self).requested(spider.clock())
             response = spider.session.send(
                 request,
                 # If the url is not saved and not a document, we don't
-                # need to access the content. The question is:
-                # TODO: Is it better to close() or to keep-alive?
-                # This also affects redirects handling, if we don't close
-                # we can't use the same connection to resolve redirects.
-                stream=True,  # method=='GET'
+                # need to access the content. Whatever is left unread
+                # is dealt with by :meth:`release` once the spider is
+                # done with the link.
+                stream=True,
                 # Handle redirects manually
                 allow_redirects=False)
 
-            redirects = list(spider.session.resolve_redirects(
-                response, request,
-                # Important: We do NOT fetch the body of the final url
-                # (and hopefully `resolve_redirects` wouldn't waste any
-                # time on a large intermediary url either). This is because
-                # at this time we only care about the final url. If this
-                # url is not to be processed, we will not have wasted
-                # bandwidth.
-                # TODO: Consider doing the redirect resolving using HEAD.
-                stream=True))
-
+            redirects = self._resolve_redirects(spider, response)
             response.redirects = redirects
             if redirects and redirects[-1].url == self.original_url:
                 raise TooManyRedirects()
@@ -243,10 +305,116 @@ class Link(object):
 
         return self.response
 
+    def _resolve_redirects(self, spider, response):
+        """Follow the redirect chain starting at ``response``, return
+        the list of responses, the last one being the final url.
+
+        Important: We do NOT fetch the body of the final url, or of any
+        url in between. At this time we only care about the final url,
+        which the spider processes as a link of its own. So we use HEAD
+        requests, unless a server refuses to answer those.
+        """
+        session = spider.session
+        redirects = []
+        seen_urls = {response.url}
+        while response.status_code in REDIRECT_STATI and \
+                response.headers.get('location'):
+            if len(redirects) >= session.max_redirects:
+                raise TooManyRedirects()
+
+            url = requote_uri(urljoin(
+                response.url, response.headers['location']))
+            if url in seen_urls:
+                raise TooManyRedirects()
+            seen_urls.add(url)
+
+            # Be sure the connection is free for the next request
+            release_response(response, spider.max_drain_size)
+
+            host = spider.get_host(Link(url))
+            for method in ('HEAD', 'GET'):
+                request = session.prepare_request(requests.Request(method, url))
+                host.requested(spider.clock())
+                response = session.send(
+                    request, stream=True, allow_redirects=False)
+                if method == 'HEAD' and response.status_code in (405, 501):
+                    release_response(response)
+                    continue
+                break
+            redirects.append(response)
+
+        if redirects:
+            release_response(redirects[-1], spider.max_drain_size)
+        return redirects
+
+    def _known_redirect(self, spider):
+        """If the mirror knows this url to be a permanent redirect,
+        return a response representing it, without asking the server.
+        """
+        if spider.mirror is None or not spider.reuse_redirects or \
+                self.post is not None:
+            return None
+        known = spider.mirror.redirects.get(self.url)
+        if not known:
+            return None
+        code, target_url, target_original_url = known
+        # The target may only differ in ways we normalize away, like
+        # a http->https redirect; we need to ask the server then.
+        if code not in PERMANENT_REDIRECT_CODES or target_url == self.url:
+            return None
+
+        def make_response(url):
+            response = Response()
+            response.url = url
+            response.request = requests.Request('GET', url).prepare()
+            response._content = b''
+            response._content_consumed = True
+            return response
+
+        response = make_response(self.original_url)
+        response.status_code = code
+        response.headers['location'] = target_original_url
+        response.redirects = [make_response(target_original_url)]
+        response.redirects[-1].status_code = 200
+        response.from_mirror = True
+        return response
+
     def set_post(self, data):
         """Make this link execute as a POST."""
         self.post = data
 
+    def release(self, spider):
+        """Return the connections used by the responses of this link
+        to the pool of the session.
+
+        Since we always stream, a body that nobody was interested in
+        may still be waiting on the connection. See
+        :func:`release_response`.
+        """
+        if not self.response:
+            return
+        received = 0
+        for response in [self.response] + getattr(self.response, 'redirects', []):
+            kept_alive = release_response(response, spider.max_drain_size)
+            if kept_alive is False:
+                spider.stats['connections_discarded'] += 1
+            if response.raw is not None:
+                received += bytes_received(response)
+
+        # This is what the link cost us, as far as budgets are concerned
+        if received:
+            spider.get_host(self).bytes += received
+            spider.stats['bytes'] += received
+
+    def __getstate__(self):
+        # Runtime data does not survive being stored, see
+        # :meth:`Spider.resume`.
+        state = self.__dict__.copy()
+        state.update(response=None, exception=None)
+        state.pop('_parsed', None)
+        state.pop('_history', None)
+        return state
+
     def retry(self):
         self.retries += 1
         self.exception = None
@@ -300,6 +468,159 @@ class LocalFile(Link):
         return '<LocalFile {0}>'.format(self.url)
 
 
+# Redirects which we can remember, and do not need to check again
+PERMANENT_REDIRECT_CODES = (301, 308)
+
+# Status codes by which a server tells us to slow down
+THROTTLE_CODES = (429, 503)
+
+# How much data to read at once when consuming a response body
+CONTENT_CHUNK_SIZE = 16 * 1024
+
+# Returned by Spider._process_link for a link whose document is being
+# parsed in another process
+PARSING = object()
+
+
+def read_content(response, limit=None):
+    """Read the body of a streamed response.
+
+    If ``limit`` is given, reading stops as soon as more than ``limit``
+    bytes have been received, and the response is marked as
+    ``truncated``. The data read so far is kept around; a later call
+    without a limit (or with a larger one) continues the stream where
+    it left off, rather than fetching the url again. Once the body has
+    been read in full, it is available as ``response.content``.
+
+    Returns the number of bytes read.
+    """
+    for chunk in read_chunks(response, limit):
+        pass
+    if response._content is not False:
+        return len(response._content or b'')
+    return len(response._partial_content)
+
+
+def read_chunks(response, limit=None):
+    """Like :func:`read_content`, but yields the data as it comes in:
+    first whatever has been read before, then each chunk.
+    """
+    if response._content is not False:
+        # The body has already been read in full
+        if response._content:
+            yield response._content
+        return
+
+    if not hasattr(response, '_partial_content'):
+        response._partial_content = bytearray()
+        response._chunks = response.iter_content(CONTENT_CHUNK_SIZE)
+
+    buffer = response._partial_content
+    if buffer:
+        yield bytes(buffer)
+    for chunk in response._chunks:
+        buffer.extend(chunk)
+        yield chunk
+        if limit is not None and len(buffer) > limit:
+            response.truncated = True
+            return
+
+    response._content = bytes(buffer)
+    response.truncated = False
+    del response._partial_content, response._chunks
+
+
+def peek_content(response, size):
+    """Return the first ``size`` bytes of the body of ``response``,
+    reading no more of the stream than that; see :func:`read_content`.
+    """
+    if response._content is False:
+        read_content(response, limit=size)
+    if response._content is not False:
+        return response._content[:size]
+    return bytes(response._partial_content[:size])
+
+
+def read_html(response):
+    """Read the body of an HTML document, and yield the urls in it while
+    the data comes in. Once all are found, ``response.parsed`` is the
+    :class:`HTMLParser` of the document, which has done its work already.
+    """
+    stream = HTMLLinkStream(response.url, encoding=response.encoding)
+    for chunk in read_chunks(response):
+        yield from stream.feed(chunk)
+    yield from stream.close()
+    response.parsed = stream.parser(response.content)
+
+
+def release_response(response, max_drain_size=0):
+    """Release the connection of a streamed response.
+
+    If the body has not been read, we can either read it to the end, so
+    the connection can be used for the next request (keep-alive), or we
+    can close the connection. We do the former for bodies no larger
+    than ``max_drain_size``.
+
+    Returns ``True`` if the connection was returned to the pool, ``False``
+    if it had to be closed, and ``None`` if the response was not backed
+    by a connection at all.
+    """
+    if response.raw is None or getattr(response, '_released', False):
+        return None
+    response._released = True
+
+    if response._content is False:
+        try:
+            length = int(response.headers.get('content-length'))
+        except (TypeError, ValueError):
+            length = None
+        if response.request.method == 'HEAD' or \
+                (length is not None and length <= max_drain_size):
+            try:
+                read_content(response)
+            except RequestException:
+                pass
+
+    kept_alive = response._content is not False
+    response.close()
+    return kept_alive
+
+
+def bytes_received(response):
+    """Return how much of the body of ``response`` has been read.
+    """
+    if response._content:
+        return len(response._content)
+    return len(getattr(response, '_partial_content', b''))
+
+
+class PooledAdapter(HTTPAdapter):
+    """A transport adapter that counts how often an existing connection
+    could be reused, rather than a new one having to be opened.
+
+    The numbers are added to the ``stats`` counter given, under the keys
+    ``connections_opened`` and ``connections_reused``.
+    """
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        # Number of connections each pool had opened the last time
+        # we looked at it.
+        self._opened_by_pool = weakref.WeakKeyDictionary()
+        super().__init__(**kwargs)
+
+    def build_response(self, req, resp):
+        pool = getattr(resp, '_pool', None)
+        if pool is not None:
+            opened = pool.num_connections - self._opened_by_pool.get(pool, 0)
+            self._opened_by_pool[pool] = pool.num_connections
+            if opened:
+                self.stats['connections_opened'] += opened
+            else:
+                self.stats['connections_reused'] += 1
+        return super().build_response(req, resp)
+
+
 def get_content_type(response):
     """Helper that strips out things like ";encoding=utf-8".
     """
@@ -317,12 +638,298 @@ def parse_http_date_header(datestr):
     return datetime.datetime(*parsed[:6])
 
 
-class RobotsCache(reppy.cache.RobotsCache):
+def parse_retry_after(value):
+    """Return the number of seconds a ``Retry-After`` header asks us
+    to wait; it may be given as a number, or as a date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = parse_http_date_header(value)
+        if not date:
+            return None
+        return max(0, (date - datetime.datetime.utcnow()).total_seconds())
+
+
+class Robots(object):
+    """Knows the robots.txt rules of the hosts the spider talks to.
+
+    The robots.txt file of a host is fetched in the background as soon
+    as the host is first seen (see :meth:`prefetch`), so that usually the
+    rules are available by the time a url needs to be tested against
+    them. If there is a mirror, the files are stored there, and reused
+    on the next run until they expire.
+
+    The fetching threads use a session of their own (see
+    :attr:`session`), but the requests count towards the host's pace
+    and budget like any other.
+    """
+
+    # How long to keep a robots.txt file if the server does not say;
+    # and at least, so we do not ask again on every run.
+    default_ttl = 24 * 60 * 60
+    min_ttl = 60 * 60
+    timeout = 30
+
+    def __init__(self, spider, workers=2):
+        self.spider = spider
+        self.workers = workers
+        self.store = spider.mirror.robots if spider.mirror else {}
+        # robots url -> parsed rules
+        self._rules = {}
+        # robots url -> future of a fetch in progress
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._session = None
+
+    @property
+    def session(self):
+        """Like the spider's session, but without cookies, and with
+        connections of its own; the spider's is not safe to share with
+        the fetching threads.
+        """
+        if self._session is None:
+            spider_session = self.spider.session
+            session = requests.Session()
+            session.cookies.set_policy(RefuseAll())
+            session.headers = spider_session.headers.copy()
+            for name in ('auth', 'proxies', 'verify', 'cert', 'trust_env'):
+                setattr(session, name, getattr(spider_session, name))
+            for prefix, adapter in spider_session.adapters.items():
+                # Any other adapter is one the rules installed
+                if isinstance(adapter, PooledAdapter):
+                    adapter = HTTPAdapter(pool_maxsize=self.workers)
+                session.mount(prefix, adapter)
+            self._session = session
+        return self._session
+
+    @staticmethod
+    def get_robots_url(url):
+        parsed = urlparse(url)
+        return '{0}://{1}/robots.txt'.format(parsed.scheme, parsed.netloc)
+
+    @property
+    def agent(self):
+        return self.spider.session.headers['user-agent']
+
+    def prefetch(self, url):
+        """Start fetching the robots.txt file responsible for ``url``,
+        unless we have it already.
+        """
+        robots_url = self.get_robots_url(url)
+        if robots_url in self._pending or self._get_cached(robots_url):
+            return
+        spider = self.spider
+        spider.get_host(Link(robots_url)).requested(spider.clock())
+        # Access the session here, so it is set up in the main thread
+        self._pending[robots_url] = self._executor.submit(
+            self._fetch, self.session, robots_url)
+
+    def find(self, url):
+        """Return the rules that apply to ``url``, waiting for them
+        to arrive if necessary.
+        """
+        robots_url = self.get_robots_url(url)
+        rules = self._get_cached(robots_url)
+        if rules:
+            return rules
+
+        if not robots_url in self._pending:
+            self.prefetch(url)
+        return self._collect(robots_url)
 
     def allowed(self, url):
         # Automatically use our user-agent.
-        super().allowed(
-            url, self.session.headers['user-agent'])
+        return self.find(url).allowed(url, self.agent)
+
+    def crawl_delay(self, url):
+        """The delay the host of ``url`` asks for between two requests.
+        """
+        return self.find(url).delay(self.agent) or 0
+
+    def close(self):
+        """Keep whatever has been fetched, and stop fetching more."""
+        for robots_url, future in list(self._pending.items()):
+            if future.done():
+                self._collect(robots_url)
+        self._executor.shutdown(wait=False)
+
+    def _get_cached(self, robots_url):
+        if not robots_url in self._rules and robots_url in self.store:
+            self._load(robots_url, *self.store[robots_url])
+        rules = self._rules.get(robots_url)
+        if rules and rules.expires > time.time():
+            return rules
+        return None
+
+    def _collect(self, robots_url):
+        """Take the result of a fetch; this is where it gets stored,
+        so that only the main thread ever writes to the mirror.
+        """
+        data = self._pending.pop(robots_url).result()
+        self.store[robots_url] = data
+        return self._load(robots_url, *data)
+
+    def _load(self, robots_url, status, content, expires):
+        if status is None or not (status == 200 or 400 <= status < 500):
+            # We could not get at the file. Assume that we may crawl,
+            # but ask again soon.
+            status, content = 404, ''
+        rules = self._rules[robots_url] = reppy.parser.Rules(
+            robots_url, status, content, expires)
+        return rules
+
+    def _fetch(self, session, robots_url):
+        """Runs in a worker thread. Returns the data we need to store.
+        """
+        try:
+            response = session.get(robots_url, timeout=self.timeout)
+        except RequestException:
+            return None, '', time.time() + self.min_ttl
+        status = response.status_code
+        if not (status == 200 or 400 <= status < 500):
+            ttl = self.min_ttl
+        else:
+            ttl = max(self.min_ttl, reppy.Utility.get_ttl(
+                response.headers, self.default_ttl))
+        return status, response.text, time.time() + ttl
+
+
+class HostState(object):
+    """What the spider knows about how a host has been responding, and
+    thus when it may be contacted next.
+
+    Two mechanisms are implemented here:
+
+    A circuit breaker: After a number of consecutive connection failures,
+    we stop talking to the host for a while, so that urls on other hosts
+    can be processed in the meantime. Should the host fail again right
+    after such a break, the next break will be twice as long.
+
+    Rate control: The delay between two requests to the host is adjusted
+    AIMD-style. It doubles whenever the host signals that it is overloaded
+    (a 429 or 503 status code, or a response much slower than usual), and
+    shrinks by a small step whenever the host is doing fine. If the host
+    asks us to come back later via ``Retry-After``, we do just that.
+    A crawl-delay from robots.txt, if we respect it, is a lower bound.
+
+    The parameters are read from the spider.
+    """
+
+    def __init__(self, name, spider):
+        self.name = name
+        self.spider = spider
+        # Circuit breaker
+        self.failures = 0
+        self.breaks = 0
+        self.blocked_until = 0
+        # Rate control
+        self.delay = spider.min_host_delay
+        self.latency = None
+        self.last_request = None
+        self.crawl_delay = None
+        # What the host has cost us so far, see :class:`Budget`
+        self.requests = 0
+        self.bytes = 0
+        self.first_request = None
+        self.limit_reached = None
+
+    def failed(self, now):
+        """Register a connection failure. Returns ``True`` if this
+        causes the host to be blocked.
+        """
+        self.failures += 1
+        if self.failures >= self.spider.host_failure_threshold:
+            self.breaks += 1
+            self.blocked_until = now + min(
+                self.spider.max_host_cooldown,
+                self.spider.host_cooldown * 2 ** (self.breaks - 1))
+            return True
+        return False
+
+    def requested(self, now):
+        """Register that a request is being sent to the host."""
+        self.last_request = now
+        if self.first_request is None:
+            self.first_request = now
+        self.requests += 1
+        self.spider.stats['requests'] += 1
+
+    def responded(self, now, response):
+        """Register a response by the host, adjust our pace. Returns
+        ``True`` if this changed how we treat the host.
+        """
+        spider = self.spider
+        before = (self.delay, self.blocked_until)
+        self.failures = self.breaks = 0
+
+        latency = response.elapsed.total_seconds()
+        slow = latency > spider.slow_response or (
+            self.latency is not None and latency > 4 * max(self.latency, 0.25))
+        self.latency = latency if self.latency is None \
+            else 0.8 * self.latency + 0.2 * latency
+
+        if response.status_code in THROTTLE_CODES or slow:
+            self.delay = min(spider.max_host_delay,
+                             max(self.delay * 2, spider.host_delay_step))
+        else:
+            self.delay = max(spider.min_host_delay,
+                             self.delay - spider.host_delay_step)
+
+        retry_after = parse_retry_after(response.headers.get('retry-after'))
+        if retry_after is not None:
+            self.blocked_until = max(
+                self.blocked_until,
+                now + min(retry_after, spider.max_host_cooldown))
+
+        return (self.delay, self.blocked_until) != before
+
+    def budget_exceeded(self, now):
+        """Return the limit of the spider's host budget that this host
+        has reached, if any.
+        """
+        elapsed = 0 if self.first_request is None else now - self.first_request
+        return self.spider.host_budget.exceeded(
+            self.requests, self.bytes, elapsed)
+
+    def ready_at(self):
+        """The time at which the host may be contacted again."""
+        if self.last_request is None:
+            return self.blocked_until
+        return max(self.blocked_until, self.last_request + max(
+            self.delay, self.crawl_delay or 0))
+
+    def is_throttled(self, now):
+        return self.blocked_until > now or \
+            self.delay > self.spider.min_host_delay
+
+    def __repr__(self):
+        return '<HostState {0}>'.format(self.name)
+
+
+class Budget(object):
+    """How much a crawl, or the part of a crawl concerning a single host,
+    may cost: a number of ``requests``, a number of ``bytes`` received,
+    and a ``time`` in seconds. A limit of ``None`` does not apply.
+    """
+
+    def __init__(self, requests=None, bytes=None, time=None):
+        self.requests = requests
+        self.bytes = bytes
+        self.time = time
+
+    def exceeded(self, requests, bytes, time):
+        """Given the costs so far, return the name of the first limit
+        that has been reached, or ``None``.
+        """
+        for name, used in (
+                ('requests', requests), ('bytes', bytes), ('time', time)):
+            limit = getattr(self, name)
+            if limit is not None and used >= limit:
+                return name
+        return None
 
 
 class Rules(object):
@@ -356,6 +963,13 @@ class Rules(object):
         """
         return False
 
+    def respect_robots(self, spider):
+        """Return ``True`` if the rules consult robots.txt files. They
+        will then be fetched ahead of time, and their crawl-delay will
+        be honoured.
+        """
+        return False
+
     def configure_session(self, session, spider):
         """Allows configuring the general environment.
         """
@@ -378,8 +992,20 @@ class DefaultRules(Rules):
         if expires and expires > datetime.datetime.utcnow():
             return 'not-expired'
 
+    def lastmod_check(self, link, spider):
+        if not link.url in spider.mirror.url_info:
+            return False
+
+        # A sitemap might have told us when the url last changed.
+        info = spider.mirror.url_info[link.url]
+        lastmod = link.info.get('lastmod')
+        checked = info.get('checked') or info.get('fetched')
+        if lastmod and checked and lastmod <= checked:
+            return 'not-modified'
+
     def skip_download(self, link, spider):
-        return self.expiration_check(link.url, spider)
+        return self.expiration_check(link, spider) or \
+            self.lastmod_check(link, spider)
 
     def configure_session(self, session, spider):
         session.headers.update({
@@ -429,20 +1055,98 @@ class Spider(object):
     max_retries = 5
     session_class = requests.Session
 
-    def __init__(self, rules, mirror=None, events=None):
-        self._link_queue = deque()
+    # The number of hosts for which to keep a pool of connections, and
+    # the number of connections to keep alive for each host.
+    max_pools = 20
+    max_connections_per_host = 4
+    # Bodies that have not been read by the time we are done with a url
+    # are read to the end if not larger than this, so that the connection
+    # can be reused. Larger ones cause the connection to be closed.
+    max_drain_size = 64 * 1024
+
+    # A url that fails at the connection stage is retried after a delay
+    # (in seconds), which doubles with each attempt; plus some jitter.
+    retry_delay = 2
+    max_retry_delay = 300
+    # After this many connection failures in a row, a host is left alone
+    # for ``host_cooldown`` seconds, while other hosts keep going.
+    host_failure_threshold = 3
+    host_cooldown = 60
+    max_host_cooldown = 30 * 60
+    # The delay (in seconds) between two requests to the same host
+    # adapts to how the host is doing, within these bounds; see
+    # :class:`HostState`. A response taking longer than ``slow_response``
+    # seconds is taken as a sign of an overloaded host.
+    min_host_delay = 0
+    max_host_delay = 60
+    host_delay_step = 0.25
+    slow_response = 10
+
+    # Documents of at least ``min_offload_size`` bytes are parsed by a
+    # pool of ``parse_workers`` processes, while we go on to download
+    # the next urls. Smaller ones are quicker to parse than to send
+    # elsewhere. By default, everything is parsed here.
+    parse_workers = 0
+    min_offload_size = 64 * 1024
+    # Otherwise, the urls of an HTML document are found while it is
+    # being downloaded, and added to the queue right away; see
+    # :meth:`_stream_html`.
+    stream_html = True
+    # Parsers costing more than this are not used, see :class:`Parser`;
+    # e.g. 2 to not look into scripts.
+    max_parse_cost = None
+    # Whether to trust the permanent redirects the mirror knows from an
+    # earlier run, rather than asking the server again; for updates.
+    reuse_redirects = False
+
+    # Limits for the whole crawl, and for each host. When the crawl is
+    # stopped by a limit, the links left over are stored in the mirror,
+    # so a later run can :meth:`resume`.
+    budget = Budget()
+    host_budget = Budget()
+
+    # Allows tests to run without actually waiting
+    clock = staticmethod(time.time)
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, rules, mirror=None, events=None, frontier=None):
+        # The links yet to be processed; see :mod:`track.frontier`.
+        self._link_queue = frontier if frontier is not None \
+            else DequeFrontier()
+        # Links that may not be processed yet, as a heap of
+        # (due time, sequence number, link) tuples.
+        self._delayed_links = []
+        self._delayed_counter = count()
+        # Links of hosts that have used up their budget
+        self._exhausted_links = []
+        # Links waiting for their document to be parsed, by url, as
+        # (future, link, response) tuples.
+        self._parsing = {}
+        self._hosts = {}
         self._known_urls = set()
+        # When this run started, or the run it continues, see resume()
+        self._started_at = None
         self.rules = rules
         self.mirror = mirror
         self.events = events or Events()
+        # Instrumentation, e.g. how well connections are being reused
+        self.stats = Counter()
+        # The limit of :attr:`budget` that stopped the crawl, if any
+        self.limit_reached = None
 
     def __len__(self):
-        return len(self._link_queue)
+        return len(self._link_queue) + len(self._delayed_links) + \
+            len(self._parsing)
 
     @property
     def session(self):
         if not hasattr(self, '_session'):
             self._session = self.session_class()
+            for prefix in ('http://', 'https://'):
+                self._session.mount(prefix, PooledAdapter(
+                    self.stats,
+                    pool_connections=self.max_pools,
+                    pool_maxsize=self.max_connections_per_host))
             self.rules.configure_session(self._session, self)
         return self._session
 
@@ -452,7 +1156,7 @@ class Spider(object):
         file for a url. Will auto-fetch robots files and cache them.
         """
         if not hasattr(self, '_robots'):
-            self._robots = RobotsCache(session=self.session)
+            self._robots = Robots(self)
         return self._robots
 
     def add(self, url, **kwargs):
@@ -468,8 +1172,7 @@ class Spider(object):
             link = LinkPartial(**opts)
             if post:
                 link.set_post(post)
-        self._link_queue.appendleft(link)
-        self.events.added_to_queue(link)
+        self._enqueue(link)
 
     def _add(self, url, **opts):
         """Internal add-to-queue which refuses duplicates.
@@ -483,24 +1186,295 @@ class Spider(object):
         if link.url in self._known_urls:
             return False
 
-        self._link_queue.appendleft(link)
-        self.events.added_to_queue(link)
+        self._enqueue(link)
         return True
 
+    def _add_many(self, found, previous, added=None):
+        """Add the links found in the document of ``previous``, given as
+        ``(url, opts)`` pairs. Like :meth:`_add`, but a document may
+        contain thousands of links, most of them known already: each
+        distinct url is normalized once, a link that is a repeat of
+        one before it is ignored, and a duplicate is recognized before
+        a :class:`Link` is built.
+
+        Returns the number of links found, and the number added. The
+        links added are appended to the list ``added``, if given.
+        """
+        normalized = {}
+        seen = set()
+        num_found = num_added = 0
+        for url, opts in found:
+            num_found += 1
+            try:
+                key = url, frozenset(opts.items())
+            except TypeError:
+                pass
+            else:
+                if key in seen:
+                    continue
+                seen.add(key)
+
+            if not url in normalized:
+                try:
+                    normalized[url] = normalize_url(url)
+                except urlnorm.InvalidUrl:
+                    normalized[url] = None
+            if normalized[url] is None or \
+                    normalized[url][1] in self._known_urls:
+                continue
+
+            link = Link.from_normalized(
+                normalized[url], previous=previous, **opts)
+            self._enqueue(link)
+            if added is not None:
+                added.append(link)
+            num_added += 1
+        return num_found, num_added
+
+    def _enqueue(self, link, urgent=False):
+        self._link_queue.add(link, urgent=urgent)
+        self._new_in_queue(link)
+        self.events.added_to_queue(link)
+
+    def _withdraw(self, links):
+        """Take ``links`` out of the queue again, see :meth:`_stream_html`.
+        """
+        if not links:
+            return
+        self._link_queue.withdraw(links)
+        for link in links:
+            self.events.withdrawn_from_queue(link)
+
+    def _new_in_queue(self, link):
+        # Have the robots.txt file ready by the time we need it
+        if self.rules.respect_robots(self) and \
+                not isinstance(link, LocalFile) and \
+                not link.info.get('do-not-follow'):
+            self.robots.prefetch(link.original_url)
+
     def loop(self):
-        while len(self._link_queue):
+        started = self.clock()
+        if self._started_at is None:
+            self._started_at = datetime.datetime.utcnow()
+        while len(self) and not self._out_of_budget(started):
             self.process_one()
+        self.shutdown()
+        self._save_frontier()
         if self.mirror:
-            self.mirror.finish()
+            self.mirror.finish(self.events)
+
+    def shutdown(self):
+        """Stop any work going on in the background. Documents still
+        being parsed are waited for, their links are added to the queue.
+        """
+        for url in list(self._parsing):
+            self._continue_after_parsing(url)
+        if hasattr(self, '_parse_pool'):
+            self._parse_pool.shutdown()
+            del self._parse_pool
+        if hasattr(self, '_robots'):
+            self._robots.close()
+            del self._robots
+
+    def _out_of_budget(self, started):
+        self.limit_reached = self.budget.exceeded(
+            self.stats['requests'], self.stats['bytes'],
+            self.clock() - started)
+        if self.limit_reached:
+            self.events.limit_reached(self.limit_reached)
+            return True
+        return False
 
     def process_one(self):
-        link = self._link_queue.pop()
+        # With nothing else to do, wait for a document being parsed
+        self._finish_parsing(wait=not len(self._link_queue))
+        link = self._next_link()
+        if link is None:
+            return
         self.events.taken_by_processor(link)
-        add_again = self._process_link(link)
+        try:
+            add_again = self._process_link(link)
+        finally:
+            link.release(self)
+        if add_again is PARSING:
+            # Completed once the document has been parsed
+            return
         self.events.completed(link)
         if add_again:
-            self._link_queue.appendleft(link)
+            # No point in trying again before the host is ready
+            due = self.clock() + self._retry_delay(link)
+            self._delay_link(link, max(due, self.get_host(link).ready_at()))
+            self.events.added_to_queue(link)
+
+    @property
+    def parse_pool(self):
+        if not hasattr(self, '_parse_pool'):
+            self._parse_pool = ProcessPoolExecutor(self.parse_workers)
+        return self._parse_pool
+
+    def _parse_elsewhere(self, link, response):
+        """Have the urls in the document of ``response`` found by the
+        process pool, if it is worth it. Processing of the link
+        continues in :meth:`_continue_after_parsing`.
+        """
+        parser = response.parsed
+        if not self.parse_workers or not parser or \
+                len(response.content) < self.min_offload_size:
+            return False
+        # A mirror converting the links of the document as it saves it
+        # would otherwise parse it again, here.
+        with_elements = bool(self.mirror) and self.mirror.write_at_once \
+            and self.mirror.convert_links
+        future = self.parse_pool.submit(
+            find_urls, type(parser), parser.data, parser.base_url,
+            parser.encoding, with_elements)
+        self._parsing[link.url] = (future, link, response, with_elements)
+        return True
+
+    def _finish_parsing(self, wait=False):
+        """Continue with the links whose documents have been parsed
+        in the meantime. With ``wait``, wait for at least one.
+        """
+        if not self._parsing:
+            return
+        futures = [entry[0] for entry in self._parsing.values()]
+        done, _ = concurrent_wait(
+            futures, timeout=None if wait else 0,
+            return_when=FIRST_COMPLETED)
+        for url in [url for url, entry in self._parsing.items()
+                    if entry[0] in done]:
+            self._continue_after_parsing(url)
+
+    def _continue_after_parsing(self, url):
+        future, link, response, with_elements = self._parsing.pop(url)
+        if with_elements:
+            response.parsed.found_urls, response.parsed._elements = \
+                future.result()
+        else:
+            response.parsed.found_urls = future.result()
+        self._complete_link(link, response, False, False)
+        self.events.completed(link)
+
+    def resume(self):
+        """Add the links that a previous run, stopped by its budget, did
+        not get to. Returns the number of links.
+        """
+        links = self.mirror.frontier.pop('links', [])
+        started = self.mirror.frontier.pop('started', None)
+        if started is not None:
+            # The urls the stopped run did get to need not be fetched
+            # again, nor be deleted as not encountered.
+            self._started_at = started
+            for url, url_info in self.mirror.url_info.items():
+                checked = url_info.get('checked') or url_info.get('fetched')
+                if checked and checked >= started:
+                    self._known_urls.add(url)
+                    if url in self.mirror.stored_urls:
+                        self.mirror.encounter_url(Link(url))
+        for link in links:
+            self._link_queue.add(link)
             self.events.added_to_queue(link)
+        return len(links)
+
+    def _drain_frontier(self):
+        """Remove all links we did not get to, return them in the order
+        in which they would have been processed.
+        """
+        links = []
+        while len(self._link_queue):
+            links.append(self._link_queue.pop())
+        while self._delayed_links:
+            links.append(heapq.heappop(self._delayed_links)[2])
+        links.extend(self._exhausted_links)
+        del self._exhausted_links[:]
+        return links
+
+    def _save_frontier(self):
+        """Store the links we did not get to in the mirror.
+        """
+        links = self._drain_frontier()
+        if self.mirror is None:
+            return
+        if links:
+            self.mirror.frontier['links'] = links
+            self.mirror.frontier['started'] = self._started_at
+        else:
+            self.mirror.frontier.pop('links', None)
+            self.mirror.frontier.pop('started', None)
+
+    def get_host(self, link):
+        """Return the :class:`HostState` for the host of the link.
+        """
+        name = link.parsed.netloc
+        if not name in self._hosts:
+            self._hosts[name] = HostState(name, self)
+        return self._hosts[name]
+
+    def _host_state_changed(self, host):
+        now = self.clock()
+        self.events.host_state_changed(
+            host, throttled=host.is_throttled(now), delay=host.delay,
+            blocked_for=max(0, host.blocked_until - now))
+
+    def _next_link(self):
+        """Take the next link off the queue.
+
+        Links whose host is currently blocked are set aside until it
+        no longer is. If only delayed links are left, wait for them.
+        Links of hosts that are out of budget are set aside for good;
+        returns ``None`` if nothing else is left.
+        """
+        while True:
+            now = self.clock()
+            while self._delayed_links and self._delayed_links[0][0] <= now:
+                # Those that are due go back into the queue, in their
+                # place by the order of the frontier
+                self._link_queue.add(heapq.heappop(self._delayed_links)[2])
+
+            if not len(self._link_queue):
+                if not self._delayed_links:
+                    return None
+                self.sleep(max(0, self._delayed_links[0][0] - now))
+                continue
+
+            link = self._link_queue.pop()
+
+            # Links that will not cause a request do not need to wait
+            if link.info.get('do-not-follow') or \
+                    link.url in self._known_urls or link.url in self._parsing:
+                return link
+
+            host = self.get_host(link)
+            limit = host.budget_exceeded(now)
+            if limit:
+                if not host.limit_reached:
+                    host.limit_reached = limit
+                    self.events.limit_reached(limit, host=host)
+                self._exhausted_links.append(link)
+                continue
+
+            if self.rules.respect_robots(self) and host.crawl_delay is None \
+                    and host.last_request is not None:
+                # Only matters from the second request on, so by now
+                # the robots.txt file has usually arrived.
+                host.crawl_delay = self.robots.crawl_delay(link.original_url)
+            ready_at = host.ready_at()
+            if ready_at > now:
+                self._delay_link(link, ready_at)
+                continue
+            return link
+
+    def _delay_link(self, link, due):
+        heapq.heappush(
+            self._delayed_links, (due, next(self._delayed_counter), link))
+
+    def _retry_delay(self, link):
+        """Exponential backoff, with jitter so that urls which failed
+        together do not all come back at the same time.
+        """
+        delay = min(self.max_retry_delay,
+                    self.retry_delay * 2 ** max(link.retries - 1, 0))
+        return delay / 2 + random.uniform(0, delay / 2)
 
     def _process_link(self, link):
         # Some links we are not supposed to follow, like <form action=>
@@ -508,13 +1482,18 @@ class Spider(object):
             self.events.follow_state_changed(link, skipped='no-download')
             return
 
-        # Do not bother to process the same url twice
+        # Do not bother to process the same url twice. If it is still
+        # being parsed, we need to know how that ends first.
+        if link.url in self._parsing:
+            self._continue_after_parsing(link.url)
         if link.url in self._known_urls:
             self.events.follow_state_changed(link, skipped='duplicate')
             return
 
-        # Test whether this is a link that we should even follow
-        if link.source != 'user' and not self.rules.follow(link, self):
+        # Test whether this is a link that we should even follow. Urls
+        # from a sitemap are starting points, just like the user's own.
+        if link.source not in ('user', 'sitemap') and \
+                not self.rules.follow(link, self):
             self.events.follow_state_changed(link, skipped='rule-deny')
             return
 
@@ -528,6 +1507,9 @@ class Spider(object):
             if response is False:
                 # This request failed at the connection stage
                 if link.exception:
+                    host = self.get_host(link)
+                    if host.failed(self.clock()):
+                        self._host_state_changed(host)
                     if link.retries <= self.max_retries:
                         self.events.follow_state_changed(
                             link, failed='connect-error', exception=link.exception)
@@ -538,27 +1520,39 @@ class Spider(object):
                     self.events.follow_state_changed(link, failed='redirect-error')
                     return False
 
+            # Let the host tell us whether we should slow down
+            if not getattr(response, 'from_mirror', False):
+                host = self.get_host(link)
+                if host.responded(self.clock(), response):
+                    self._host_state_changed(host)
+
             # If we have been redirected to a different url, add that
             # url to the queue again.
             if response.redirects:
                 redir_link = Link(
                     response.redirects[-1].url, previous=link.previous,
                     redirect_from=link.url, **link.info)
-                self._link_queue.append(redir_link)
-                self.events.added_to_queue(redir_link)
-                response.close()
+                self._enqueue(redir_link, urgent=True)
 
                 # The mirror needs to know about the redirect. The status
                 # code if the first redirect in a chain determines the type
                 # (i.e. permanent, temporary etc)
                 self.mirror.add_redirect(
-                    link, redir_link, response.status_code)
+                    link, redir_link, response.status_code, response=response)
 
                 self.events.follow_state_changed(link, failed='redirect')
                 return
 
             # Do not follow errors
             if response.status_code >= 400:
+                # Unless the server merely asked us to slow down; then
+                # we come back when the host is ready again.
+                if response.status_code in THROTTLE_CODES and \
+                        link.retries <= self.max_retries:
+                    self.events.follow_state_changed(
+                        link, failed='throttled', response=response)
+                    link.retry()
+                    return True
                 self.events.follow_state_changed(link, failed='http-error')
                 return
 
@@ -573,19 +1567,93 @@ class Spider(object):
             # We did not download this url
             self.events.follow_state_changed(link, failed='not-expired')
             response = False
+            response_was_304 = False
+
+        # A test might have stopped reading the body early (a size test
+        # only needs so much of it). Since we are following the url,
+        # continue the stream rather than fetching the url again.
+        if response and not response_was_304 and \
+                getattr(response, 'truncated', False):
+            read_content(response)
 
         # Attach a link parser now, which will start to work when needed.
         # The mirror might need the links during save, or the spider when
         # the @stop rules pass. Or we might get away without parsing.
         if response and not response_was_304:
-            parser_class = get_parser_for_mimetype(get_content_type(response))
-            if parser_class:
+            parser_class = self.get_parser_class(response)
+            if parser_class is HTMLParser and self.stream_html and \
+                    not self.parse_workers:
+                self._stream_html(link, response)
+            elif parser_class:
+                read_content(response)
                 response.parsed = parser_class(response.content, response.url,
                                                encoding=response.encoding)
             else:
                 response.parsed = None
             response.links_parsed = HeaderLinkParser(response)
 
+            if self._parse_elsewhere(link, response):
+                return PARSING
+
+        return self._complete_link(
+            link, response, skip_download, response_was_304)
+
+    def _stream_html(self, link, response):
+        """Read the HTML document of ``response``, adding the links in it
+        to the queue while it downloads, rather than once it is done.
+
+        Those links are provisional. The @stop rules need the complete
+        response; if they refuse the page, :meth:`_save_and_follow`
+        withdraws them. A frontier that cannot withdraw links (one
+        sharing them with other processes) gets them once the page is
+        done, as usual.
+        """
+        if not hasattr(self._link_queue, 'withdraw'):
+            for _ in read_html(response):
+                pass
+            return
+
+        added = []
+        try:
+            num_found, num_added = self._add_many(
+                read_html(response), link, added)
+        except BaseException:
+            self._withdraw(added)
+            raise
+        response.links_streamed = num_found, num_added, added
+
+    def get_parser_class(self, response):
+        """Return the parser for the document in ``response``, or
+        ``None``. If the server did not say what the document is, we
+        guess; :meth:`Mirror.add` records the guess as ``sniffed_type``.
+
+        Guessing only reads the start of the body. Unless a parser is
+        found, or the document is saved, the rest is never downloaded.
+        """
+        mimetype = get_content_type(response)
+        parser_class = parsers.get(mimetype, self.max_parse_cost)
+        if parser_class is None and mimetype in parsers.generic_mimetypes:
+            parser_class = parsers.sniff(
+                peek_content(response, parsers.sniff_size),
+                self.max_parse_cost)
+            if parser_class:
+                response.sniffed_type = parser_class.mimetypes[0]
+        return parser_class
+
+    def _complete_link(self, link, response, skip_download, response_was_304):
+        """Save the link and follow the links it contains, once its
+        response is ready.
+        """
+        try:
+            return self._save_and_follow(
+                link, response, skip_download, response_was_304)
+        finally:
+            # The document has been parsed once, for both the mirror
+            # and us; now the urls are all we need of it.
+            if response and getattr(response, 'parsed', None):
+                response.parsed.discard_elements()
+
+    def _save_and_follow(self, link, response, skip_download, response_was_304):
         # Save the file locally?
         add_to_known_list = True
         if self.mirror:
@@ -596,6 +1664,8 @@ class Spider(object):
                     self.events.save_state_changed(link, saved=False)
                     add_to_known_list = False
                 elif self.rules.save(link, self):
+                    # We might only have looked at the start of the body
+                    read_content(response)
                     self.mirror.add(link, response)
                     self.events.save_state_changed(link, saved=True)
                 else:
@@ -611,7 +1681,8 @@ class Spider(object):
             else:
                 # Mirror still needs to know we found this url so
                 # it won't be deleted during cleanup.
-                self.mirror.encounter_url(link)
+                self.mirror.encounter_url(
+                    link, revalidated=not skip_download)
                 self.events.save_state_changed(link, saved=True)
 
         # No need to process this url again
@@ -620,9 +1691,21 @@ class Spider(object):
             if link.info.get('redirect_from'):
                 self._known_urls.add(link.info.get('redirect_from'))
 
+        # The links found while the page downloaded, if any. Links to
+        # the page itself were not duplicates then, but are now.
+        streamed = getattr(response, 'links_streamed', None)
+        if streamed:
+            num_found, num_added, added = streamed
+            known = [other for other in added if other.url in self._known_urls]
+            self._withdraw(known)
+            added = [other for other in added if not other in known]
+            streamed = num_found, num_added - len(known), added
+
         # Run a hook that makes it possible to stop now and ignore
         # all the urls contained in this page.
         if self.rules.stop(link, self):
+            if streamed:
+                self._withdraw(streamed[2])
             self.events.bail_state_changed(link, bail=True)
             return
 
@@ -630,23 +1713,18 @@ class Spider(object):
         #
         # If we didn't properly download a full response, then the mirror
         # can tell us the urls that this page is pointing to.
-        num_links_followed = num_links_total = 0
         if skip_download or response_was_304:
-            for link_url, info in self.mirror.url_info[link.url]['links']:
-                num_links_total += 1
-                if self._add(link_url, previous=link, **info):
-                    num_links_followed += 1
-
+            found = self.mirror.url_info[link.url]['links']
+        elif streamed:
+            # Those of the content have been added already
+            found = response.links_parsed
         else:
             # Add links from the parsed content + the http headers
-            for link_url, opts in chain(
-                    response.links_parsed,
-                    response.parsed or ()):
-                # Put together a url object with all the info that
-                # we have ad that tests can use.
-                num_links_total += 1
-                if self._add(link_url, previous=link, **opts):
-                    num_links_followed += 1
+            found = chain(response.links_parsed, response.parsed or ())
+        num_links_total, num_links_followed = self._add_many(found, link)
+        if streamed:
+            num_links_total += streamed[0]
+            num_links_followed += streamed[1]
 
         # Publish bail state. Include the number of links only if we found
         # some (say a http header link) or if this url was parsed for links
@@ -1,8 +1,12 @@
-from http.cookiejar import CookieJar, CookiePolicy
+from functools import lru_cache
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+import re
 import shelve
+from urllib.parse import urljoin, urlsplit
 
 
-__all__ = ('ShelvedCookieJar', 'RefuseAll', 'NoneDict')
+__all__ = ('ShelvedCookieJar', 'RefuseAll', 'NoneDict', 'url_cache',
+           'url_cache_stats', 'cached_urljoin', 'surt')
 
 
 class ShelvedCookieJar(CookieJar):
@@ -48,7 +52,7 @@ class ShelvedCookieJar(CookieJar):
             self._cookies[domain] = self._cookies[domain]
 
 
-class RefuseAll(CookiePolicy):
+class RefuseAll(DefaultCookiePolicy):
     def set_ok(self, cookie, request):
         return False
 
@@ -58,3 +62,68 @@ class NoneDict(dict):
         return dict.get(self, key)
 
 
+# The same urls, like "/" or "../style.css", appear on every page of a
+# site, and are joined and normalized over and over again, by both the
+# spider and the mirror. How many results to remember, per function:
+URL_CACHE_SIZE = 50000
+
+_url_caches = {}
+
+
+def url_cache(func):
+    """Memoize ``func``, a function of urls, in a bounded LRU cache,
+    shared by everything in the process; see :func:`url_cache_stats`.
+    """
+    cached = lru_cache(maxsize=URL_CACHE_SIZE)(func)
+    _url_caches[func.__name__] = cached
+    return cached
+
+
+def url_cache_stats():
+    """Return the hits, misses, size and hit rate of each url cache,
+    by function name.
+    """
+    stats = {}
+    for name, cached in _url_caches.items():
+        info = cached.cache_info()
+        lookups = info.hits + info.misses
+        stats[name] = {
+            'hits': info.hits, 'misses': info.misses, 'size': info.currsize,
+            'hit_rate': info.hits / lookups if lookups else 0.0}
+    return stats
+
+
+cached_urljoin = url_cache(urljoin)
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def surt(url):
+    """Return the *Sort-friendly URI Reordering Transform* of ``url``,
+    the key under which archives index it::
+
+        http://www.Example.org:8080/Path?b=2&a=1
+        org,example:8080)/path?a=1&b=2
+
+    The host is reversed, so the urls of a domain and its subdomains
+    sort together. Like the usual implementation, this also drops the
+    scheme, ``www.``, a default port and the fragment, lowercases, and
+    sorts the query.
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').strip('.')
+    labels = host.split('.')
+    if len(labels) > 2 and re.match(r'www\d*$', labels[0]):
+        labels = labels[1:]
+    key = ','.join(reversed(labels))
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != DEFAULT_PORTS.get(parts.scheme):
+        key += ':{}'.format(port)
+    key += ')' + (parts.path or '/')
+    if parts.query:
+        key += '?' + '&'.join(sorted(parts.query.split('&')))
+    return key.lower()
@@ -0,0 +1,336 @@
+"""Storing a crawl as WARC files (ISO 28500), the format of web archives,
+rather than as a browsable copy of the site.
+
+A WARC file is a series of records: the request we sent, the response
+we got, with its headers, as received. Each record is compressed as a
+gzip member of its own, so a record can be read without decompressing
+the file up to it. The offsets of the records are kept in a CDX index,
+a text file sorted by url (in its :func:`track.utils.surt` form), which
+the usual archival tools understand.
+"""
+
+import base64
+import datetime
+import hashlib
+import heapq
+import os
+from os import path
+import re
+import tempfile
+from urllib.parse import urlparse
+import uuid
+import zlib
+import track
+from track.mirror import Mirror
+from track.spider import get_content_type
+from track.utils import surt
+
+
+__all__ = ('WarcMirror', 'read_record')
+
+
+# The CDX fields we write: url key, date, url, mimetype, status code,
+# payload digest, redirect target, meta tags, record length, offset
+# and WARC filename.
+CDX_HEADER = ' CDX N b a m s k r M S V g\n'
+
+# Headers that describe the body as sent, not as we store it; requests
+# decodes the body for us.
+TRANSPORT_HEADERS = ('content-encoding', 'transfer-encoding',
+                     'content-length')
+
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+def _digest(*parts):
+    sha1 = hashlib.sha1()
+    for part in parts:
+        sha1.update(part)
+    return 'sha1:' + base64.b32encode(sha1.digest()).decode('ascii')
+
+
+def _warc_date(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _http_response_head(response, content_length):
+    version = getattr(response.raw, 'version', 11)
+    lines = ['HTTP/{}.{} {} {}'.format(
+        version // 10, version % 10, response.status_code,
+        response.reason or '')]
+    # The original spelling and order of the headers, if we have it
+    headers = getattr(response.raw, 'headers', None) or response.headers
+    for name, value in headers.items():
+        if name.lower() not in TRANSPORT_HEADERS:
+            lines.append('{}: {}'.format(name, value))
+    lines.append('Content-Length: {}'.format(content_length))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1', 'replace')
+
+
+def _http_request(request):
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    lines = ['{} {} HTTP/1.1'.format(request.method, request.path_url)]
+    if not 'host' in request.headers:
+        lines.append('Host: {}'.format(urlparse(request.url).netloc))
+    for name, value in request.headers.items():
+        lines.append('{}: {}'.format(name, value))
+    head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1', 'replace')
+    return head, body
+
+
+class WarcMirror(Mirror):
+    """Writes the responses of a crawl to ``directory`` as WARC files,
+    named ``<prefix>-00000.warc.gz``, ``<prefix>-00001.warc.gz`` etc. A
+    file is closed once it has reached ``max_segment_size`` bytes, and
+    every run starts a new one. ``<prefix>.cdx`` is the index.
+
+    The databases of a :class:`Mirror` are kept as well, so a crawl can
+    be updated or resumed; a url is stored at a *location* of the form
+    ``<warc filename>:<offset>``. Links are not converted, an archive
+    keeps what the server sent, and nothing is ever deleted.
+
+    What we store is not quite what went over the wire: the body has
+    been decoded, so ``Content-Encoding`` is dropped from the headers,
+    and the body of a redirect is not kept.
+    """
+
+    prefix = 'track'
+    max_segment_size = 1024 * 1024 * 1024
+    # How many CDX lines to sort in memory at once, see :meth:`_write_cdx`
+    cdx_sort_size = 100000
+
+    def __init__(self, directory, prefix=None, max_segment_size=None):
+        Mirror.__init__(self, directory, write_at_once=False,
+                        convert_links=False)
+        if prefix is not None:
+            self.prefix = prefix
+        if max_segment_size is not None:
+            self.max_segment_size = max_segment_size
+
+        self._segment = None
+        self._segment_name = None
+        self._next_segment_number = self._find_next_segment_number()
+        # The index entries of this run, unsorted, until :meth:`finish`
+        self._pending_cdx = None
+
+    @property
+    def cdx_filename(self):
+        return path.join(self.directory, '{}.cdx'.format(self.prefix))
+
+    def add(self, link, response):
+        """Write the request and the response to the current WARC file.
+        """
+        location = self._write_exchange(link, response, response.content)
+        self._record_url(link, response, location)
+        self.flush()
+
+    def add_redirect(self, link, target_link, code, response=None):
+        Mirror.add_redirect(self, link, target_link, code)
+        # A redirect the mirror told us about, rather than the server,
+        # is in an earlier WARC file already.
+        if response is not None and not getattr(response, 'from_mirror', False):
+            self._write_exchange(link, response, b'',
+                                 redirect=target_link.original_url)
+
+    def finish(self, events=None):
+        self._close_segment()
+        self._write_cdx()
+        self._update_url_index()
+        self.flush()
+
+    def delete_unencountered(self):
+        """Forget the urls not encountered in this run; their records
+        stay in the WARC files, which are never changed once written.
+        """
+        self._update_url_index()
+        for url in [entry.url for entry in self.url_index
+                    if entry.url not in self.encountered_urls]:
+            del self.stored_urls[url]
+            del self.url_info[url]
+            self._url_changed(url)
+        self._update_url_index()
+        self.url_usage = {}
+        for url, data in self.url_info.items():
+            self._insert_into_url_usage(url, data['links'])
+
+    def _index_entry(self, url):
+        entry = Mirror._index_entry(self, url)
+        if entry is not None:
+            # Locations from before the offset was part of them have none
+            filename, sep, offset = entry.filename.rpartition(':')
+            if sep and offset.isdigit():
+                entry = entry._replace(filename=filename, offset=int(offset))
+        return entry
+
+    def _find_next_segment_number(self):
+        pattern = re.compile(
+            r'^{}-(\d+)\.warc\.gz$'.format(re.escape(self.prefix)))
+        numbers = [-1]
+        if path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                match = pattern.match(name)
+                if match:
+                    numbers.append(int(match.group(1)))
+        return max(numbers) + 1
+
+    def _open_segment(self):
+        self._segment_name = '{}-{:05d}.warc.gz'.format(
+            self.prefix, self._next_segment_number)
+        self._next_segment_number += 1
+        self._segment = self.open(self._segment_name, 'wb')
+
+        fields = 'software: track/{}\r\nformat: WARC File Format 1.0\r\n'.format(
+            '.'.join(map(str, track.__version__))).encode('utf-8')
+        self._write_record([
+            ('WARC-Type', 'warcinfo'),
+            ('WARC-Date', _warc_date(datetime.datetime.utcnow())),
+            ('WARC-Filename', self._segment_name),
+            ('Content-Type', 'application/warc-fields'),
+        ], [fields])
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def _write_record(self, headers, parts, record_id=None):
+        """Append a record with ``headers`` and a block made of
+        ``parts``. Returns its offset and its length in the file.
+        """
+        if self._segment is None:
+            self._open_segment()
+
+        length = sum(len(part) for part in parts)
+        head = ['WARC/1.0', 'WARC-Record-ID: <urn:uuid:{}>'.format(
+            record_id or uuid.uuid4())]
+        head.extend('{}: {}'.format(name, value) for name, value in headers)
+        head.append('WARC-Block-Digest: {}'.format(_digest(*parts)))
+        head.append('Content-Length: {}'.format(length))
+
+        offset = self._segment.tell()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        write = self._segment.write
+        write(compressor.compress(
+            ('\r\n'.join(head) + '\r\n\r\n').encode('utf-8')))
+        for part in parts:
+            part = memoryview(part)
+            for i in range(0, len(part), WRITE_CHUNK_SIZE):
+                write(compressor.compress(part[i:i+WRITE_CHUNK_SIZE]))
+        write(compressor.compress(b'\r\n\r\n'))
+        write(compressor.flush())
+        return offset, self._segment.tell() - offset
+
+    def _write_exchange(self, link, response, content, redirect=None):
+        """Write the request and the response records for ``link``;
+        returns the location of the response.
+        """
+        if self._segment is not None and \
+                self._segment.tell() >= self.max_segment_size:
+            self._close_segment()
+
+        url = response.url or link.original_url
+        date = _warc_date(datetime.datetime.utcnow())
+        response_id = uuid.uuid4()
+        http_head = _http_response_head(response, len(content))
+        payload_digest = _digest(content)
+        offset, length = self._write_record([
+            ('WARC-Type', 'response'),
+            ('WARC-Date', date),
+            ('WARC-Target-URI', url),
+            ('WARC-Payload-Digest', payload_digest),
+            ('Content-Type', 'application/http; msgtype=response'),
+        ], [http_head, content], record_id=response_id)
+        filename = self._segment_name
+
+        request = getattr(response, 'request', None)
+        if request is not None:
+            self._write_record([
+                ('WARC-Type', 'request'),
+                ('WARC-Date', date),
+                ('WARC-Target-URI', url),
+                ('WARC-Concurrent-To', '<urn:uuid:{}>'.format(response_id)),
+                ('Content-Type', 'application/http; msgtype=request'),
+            ], list(_http_request(request)))
+
+        self._add_to_cdx(
+            url, date, get_content_type(response), response.status_code,
+            payload_digest, redirect, length, offset, filename)
+        return '{}:{}'.format(filename, offset)
+
+    def _add_to_cdx(self, url, date, mimetype, status, digest, redirect,
+                    length, offset, filename):
+        if self._pending_cdx is None:
+            self._pending_cdx = self.open(
+                path.join('.track', 'cdx-pending'), 'a')
+        fields = [surt(url), re.sub(r'\D', '', date), url, mimetype or '-',
+                  status, digest[len('sha1:'):], redirect or '-', '-',
+                  length, offset, filename]
+        self._pending_cdx.write(' '.join(
+            str(field).replace(' ', '%20').replace('\n', '%0A')
+            for field in fields) + '\n')
+
+    def _write_cdx(self):
+        """Merge the index entries of this run into the index file. They
+        are sorted in batches of ``cdx_sort_size`` lines, so this needs
+        no more memory for a large crawl.
+        """
+        if self._pending_cdx is not None:
+            self._pending_cdx.close()
+            self._pending_cdx = None
+        pending = path.join(self.directory, '.track', 'cdx-pending')
+        if not path.exists(pending):
+            return
+
+        sources = []
+        try:
+            with open(pending, 'r') as f:
+                while True:
+                    lines = [line for _, line in zip(
+                        range(self.cdx_sort_size), f)]
+                    if not lines:
+                        break
+                    lines.sort()
+                    batch = tempfile.TemporaryFile('w+')
+                    sources.append(batch)
+                    batch.writelines(lines)
+                    batch.seek(0)
+
+            if path.exists(self.cdx_filename):
+                existing = open(self.cdx_filename, 'r')
+                sources.append(existing)
+                if existing.readline() != CDX_HEADER:
+                    existing.seek(0)
+            new_filename = self.cdx_filename + '.new'
+            with open(new_filename, 'w') as f:
+                f.write(CDX_HEADER)
+                f.writelines(heapq.merge(*sources))
+            os.replace(new_filename, self.cdx_filename)
+        finally:
+            for source in sources:
+                source.close()
+        os.unlink(pending)
+
+
+def read_record(filename, offset):
+    """Return the WARC headers, as a dict, and the block of the record at
+    ``offset`` in the WARC file ``filename``; for example, with the
+    offset from a CDX line.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = []
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while not decompressor.eof:
+            chunk = f.read(WRITE_CHUNK_SIZE)
+            if not chunk:
+                break
+            data.append(decompressor.decompress(chunk))
+
+    head, _, block = b''.join(data).partition(b'\r\n\r\n')
+    headers = {}
+    for line in head.decode('utf-8').split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip()] = value.strip()
+    return headers, block[:int(headers.get('Content-Length', len(block)))]